@@ -0,0 +1,58 @@
+# analytics.py
+from collections import namedtuple
+
+# Счетчики ведутся триггерами на appointments (миграция 14 в database.py):
+# каждая новая запись и смена статуса сразу меняют по строке в каждом
+# измерении, поэтому сводка не требует просмотра записей.
+Counters = namedtuple("Counters", ["booked", "paid", "expired", "cancelled", "lead_minutes"])
+
+EMPTY = Counters(0, 0, 0, 0, 0)
+
+
+def add(first, second):
+    """Сумма счетчиков"""
+    return Counters(*(a + b for a, b in zip(first, second)))
+
+
+def active(counters):
+    """Записи, не отмененные и не просроченные"""
+    return counters.booked - counters.expired - counters.cancelled
+
+
+def rate(part, counters):
+    """Доля от числа записей (0, если записей нет)"""
+    return part / counters.booked if counters.booked else 0.0
+
+
+def lead_days(counters):
+    """Средний срок между созданием записи и визитом, дней"""
+    return counters.lead_minutes / counters.booked / 1440 if counters.booked else 0.0
+
+
+class Stats:
+    """Сводка из строк Database.get_stats().
+
+    total - все время; recent - сумма по дням с since; weekdays - по дню
+    недели (0 - воскресенье, как strftime('%w')); hours - по времени слота.
+    """
+
+    def __init__(self, rows):
+        self.total = EMPTY
+        self.recent = EMPTY
+        self.weekdays = {}
+        self.hours = {}
+        for dimension, key, *values in rows:
+            counters = Counters(*values)
+            if dimension == "total":
+                self.total = counters
+            elif dimension == "day":
+                self.recent = add(self.recent, counters)
+            elif dimension == "weekday":
+                self.weekdays[int(key)] = counters
+            elif dimension == "hour":
+                self.hours[key] = counters
+
+    def occupancy(self, days, slots_per_day):
+        """Загрузка за последние days дней: активные записи / все слоты"""
+        capacity = days * slots_per_day
+        return active(self.recent) / capacity if capacity else 0.0
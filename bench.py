@@ -0,0 +1,680 @@
+# bench.py
+"""Нагрузочный прогон бота без Telegram.
+
+Настоящие обработчики из bot.py вызываются с поддельными Update на
+временной БД, заполненной историей; вместо Telegram - заглушка,
+которая записывает вызовы API. N клиентов одновременно проходят запись
+(start -> дата -> время -> имя -> телефон -> "Мои записи"), затем админ
+подтверждает и отменяет записи, смотрит списки, и запускаются фоновые
+задачи.
+
+Отчет: задержка p50/p95/p99 по обработчикам, пропускная способность,
+SQL-запросов и вызовов Telegram на апдейт. Результат дописывается в
+bench_results.jsonl вместе с коммитом, --compare сравнивает с прошлым
+прогоном с теми же параметрами.
+
+--startup N вместо этого N раз запускает serve.py (или --entry bot.py)
+отдельным процессом с заглушкой Bot API и меряет холодный старт: когда
+открылся порт, когда обработан первый апдейт, присланный сразу после
+этого, и когда зарегистрирован вебхук. Первый запуск - на новой БД.
+
+    python bench.py --clients 200 --compare
+    python bench.py --startup 5
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import signal
+import socket
+import argparse
+import itertools
+import contextvars
+import subprocess
+import tempfile
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from http import HTTPStatus
+from statistics import median
+from urllib.parse import parse_qs
+
+# bot.py не запускается с токеном по умолчанию; в Telegram прогон не ходит
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+
+from telegram import CallbackQuery, Chat, Contact, Message, Update, User  # noqa: E402
+
+import bot  # noqa: E402
+from webserver import HttpServer  # noqa: E402
+
+RESULTS_PATH = "bench_results.jsonl"
+
+# Счетчики апдейта, который сейчас обрабатывается (None - фоновая работа)
+current_sample = contextvars.ContextVar("current_sample", default=None)
+
+
+class Sample:
+    """SQL-запросы и вызовы Telegram за один вызов обработчика"""
+
+    __slots__ = ("sql", "tg")
+
+    def __init__(self):
+        self.sql = 0
+        self.tg = 0
+
+
+class Report:
+    """Замеры по обработчикам"""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.sql = Counter()
+        self.tg = Counter()
+        self.background_sql = 0
+        self.background_tg = 0
+
+    def add(self, name, seconds, sample):
+        self.latencies[name].append(seconds)
+        self.sql[name] += sample.sql
+        self.tg[name] += sample.tg
+
+    def updates(self):
+        return sum(len(values) for values in self.latencies.values())
+
+
+def percentile(values, q):
+    """Перцентиль по ближайшему рангу"""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))]
+
+
+# ================== ЗАГЛУШКИ TELEGRAM ==================
+class RecordingBot:
+    """Бот-заглушка: считает вызовы API и запоминает последнюю клавиатуру чата"""
+
+    defaults = None
+
+    def __init__(self, report, latency=0.0):
+        self.report = report
+        self.latency = latency
+        self.calls = Counter()
+        self.keyboards = {}
+        self._message_ids = itertools.count(1)
+
+    def __getattr__(self, method):
+        async def call(*args, **kwargs):
+            return await self._call(method, args, kwargs)
+        return call
+
+    async def _call(self, method, args, kwargs):
+        self.calls[method] += 1
+        sample = current_sample.get()
+        if sample is not None:
+            sample.tg += 1
+        else:
+            self.report.background_tg += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        chat_id = kwargs.get("chat_id", args[0] if args else None)
+        if chat_id is not None and kwargs.get("reply_markup") is not None:
+            self.keyboards[chat_id] = kwargs["reply_markup"]
+        if method in ("send_message", "edit_message_text"):
+            text = kwargs.get("text", args[1] if len(args) > 1 else "")
+            return self.message(chat_id or 0, text)
+        return True
+
+    def message(self, chat_id, text, contact=None):
+        message = Message(
+            next(self._message_ids), datetime.now(), Chat(chat_id, Chat.PRIVATE),
+            from_user=User(chat_id, f"Клиент {chat_id}", False), text=text, contact=contact,
+        )
+        message.set_bot(self)
+        return message
+
+    def buttons(self, chat_id):
+        """Тексты кнопок последней клавиатуры чата (кроме отмены)"""
+        markup = self.keyboards.get(chat_id)
+        rows = getattr(markup, "keyboard", None) or getattr(markup, "inline_keyboard", ())
+        return [button.text for row in rows for button in row if button.text != "❌ Отмена"]
+
+
+class FakeJob:
+    def __init__(self, jobs, name, data):
+        self.jobs = jobs
+        self.name = name
+        self.data = data
+
+    def schedule_removal(self):
+        if self in self.jobs.get(self.name, []):
+            self.jobs[self.name].remove(self)
+
+
+class FakeJobQueue:
+    """JobQueue-заглушка: таймеры только запоминаются"""
+
+    def __init__(self):
+        self.jobs = defaultdict(list)
+
+    def run_once(self, callback, when, data=None, name=None, **kwargs):
+        job = FakeJob(self.jobs, name, data)
+        self.jobs[name].append(job)
+        return job
+
+    def run_repeating(self, *args, **kwargs):
+        return None
+
+    def get_jobs_by_name(self, name):
+        return list(self.jobs.get(name, ()))
+
+
+class FakeContext:
+    """То, что обработчики берут из CallbackContext"""
+
+    def __init__(self, fake_bot, job_queue, user_data, args=(), job=None):
+        self.bot = fake_bot
+        self.job_queue = job_queue
+        self.user_data = user_data
+        self.args = list(args)
+        self.job = job
+
+
+# ================== БД ==================
+def instrument_db(db, report):
+    """Подсчет SQL-запросов: trace callback на каждом соединении, разница - на вызов"""
+    counts = {}
+    connect = db._connect
+
+    def traced_connect():
+        conn = connect()
+        key = id(conn)
+        counts[key] = 0
+
+        def trace(sql):
+            # Запросы триггеров приходят с префиксом "--"
+            if not sql.startswith("--"):
+                counts[key] += 1
+        conn.set_trace_callback(trace)
+        return conn
+
+    def counted(fn):
+        def run(conn, *args):
+            before = counts.get(id(conn), 0)
+            result = fn(conn, *args)
+            return result, counts.get(id(conn), 0) - before
+        return run
+
+    def record(statements):
+        sample = current_sample.get()
+        if sample is not None:
+            sample.sql += statements
+        else:
+            report.background_sql += statements
+
+    read, write = db.read, db.write
+
+    async def traced_read(fn, *args):
+        result, statements = await read(counted(fn), *args)
+        record(statements)
+        return result
+
+    async def traced_write(fn, *args):
+        result, statements = await write(counted(fn), *args)
+        record(statements + 1)  # COMMIT
+        return result
+
+    db._connect = traced_connect
+    db.read = traced_read
+    db.write = traced_write
+
+
+def seed(path, rng, users, messages, history):
+    """История: пользователи, сообщения, прошлые записи и часть будущих слотов"""
+    conn = bot.db._connect()
+    conn.set_trace_callback(None)
+    conn.executemany(
+        "INSERT INTO bot_users (chat_id, username, first_name) VALUES (?, ?, ?)",
+        ((1_000_000 + i, f"user{i}", f"Клиент {i}") for i in range(users)),
+    )
+    words = "маникюр запись перенос оплата время гель лак дизайн покрытие снятие цена адрес".split()
+    conn.executemany(
+        "INSERT INTO messages (client_chat_id, client_name, message_text, is_from_client) VALUES (?, ?, ?, ?)",
+        ((1_000_000 + rng.randrange(users or 1), "Клиент", " ".join(rng.choices(words, k=10)), rng.random() < 0.7)
+         for _ in range(messages)),
+    )
+    today = datetime.now()
+    rows = []
+    for i in range(history):
+        date = bot.format_date_for_storage(today - timedelta(days=1 + i // len(bot.TIME_SLOTS)))
+        time_slot = bot.TIME_SLOTS[i % len(bot.TIME_SLOTS)]
+        status = rng.choice(("confirmed", "confirmed", "cancelled", "expired"))
+        rows.append((f"Клиент {i}", f"+7999{i:07d}", date, time_slot, 1_000_000 + i % max(users, 1), status))
+    # Треть будущих слотов уже занята
+    for date in bot.get_booking_dates()[1:]:
+        for time_slot in bot.TIME_SLOTS:
+            if rng.random() < 0.33:
+                rows.append(("Клиент", "+79990000000", date, time_slot, 1_000_000, "confirmed"))
+    conn.executemany(
+        """INSERT INTO appointments (client_name, client_phone, appointment_date, appointment_time,
+                                     client_chat_id, status, payment_status, phone_normalized, phone_reversed)
+           VALUES (?, ?, ?, ?, ?, ?, 'paid', '', '')""",
+        rows,
+    )
+    conn.commit()
+    conn.close()
+
+
+# ================== СЦЕНАРИИ ==================
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.report = Report()
+        self.bot = RecordingBot(self.report, latency=args.tg_latency / 1000)
+        self.job_queue = FakeJobQueue()
+
+    async def call(self, name, handler, *args):
+        sample = Sample()
+        token = current_sample.set(sample)
+        started = time.perf_counter()
+        try:
+            return await handler(*args)
+        finally:
+            self.report.add(name, time.perf_counter() - started, sample)
+            current_sample.reset(token)
+
+    def message_update(self, chat_id, text, contact=None):
+        return Update(next(self.bot._message_ids), message=self.bot.message(chat_id, text, contact))
+
+    def callback_update(self, chat_id, data):
+        message = self.bot.message(chat_id, "")
+        query = CallbackQuery(str(next(self.bot._message_ids)), User(chat_id, "Админ", False), "bench",
+                              message=message, data=data)
+        query.set_bot(self.bot)
+        return Update(next(self.bot._message_ids), callback_query=query)
+
+    async def think(self):
+        if self.args.think:
+            await asyncio.sleep(self.rng.random() * self.args.think / 1000)
+
+    async def client(self, chat_id):
+        """Один клиент: запись от /start до "Мои записи" """
+        context = FakeContext(self.bot, self.job_queue, {})
+        steps = {
+            bot.SELECT_DATE: ("select_date", bot.select_date),
+            bot.SELECT_TIME: ("select_time", bot.select_time),
+            bot.ENTER_NAME: ("enter_name", bot.enter_name),
+            bot.ENTER_PHONE: ("enter_phone", bot.enter_phone),
+        }
+        await self.call("start_command", bot.start_command, self.message_update(chat_id, "/start"), context)
+        await self.think()
+        state = await self.call("start_booking", bot.start_booking,
+                                self.message_update(chat_id, "📅 Записаться на маникюр"), context)
+        for _ in range(12):
+            if state not in steps:
+                break
+            await self.think()
+            name, handler = steps[state]
+            contact = None
+            if state in (bot.SELECT_DATE, bot.SELECT_TIME):
+                buttons = self.bot.buttons(chat_id)
+                text = self.rng.choice(buttons) if buttons else "❌ Отмена"
+            elif state == bot.ENTER_NAME:
+                text = f"Клиент {chat_id}"
+            else:
+                text = None
+                contact = Contact(f"+7 999 {chat_id % 10_000_000:07d}", f"Клиент {chat_id}")
+            state = await self.call(name, handler, self.message_update(chat_id, text, contact), context)
+        await self.think()
+        await self.call("show_my_appointments", bot.show_my_appointments,
+                        self.message_update(chat_id, "📋 Мои записи"), context)
+
+    async def admin(self, created):
+        """Админ: подтверждения, отмены, списки и поиск"""
+        admin_id = bot.ADMIN_ID
+        context = FakeContext(self.bot, self.job_queue, {})
+        for i, appointment_id in enumerate(created):
+            name, code = ("admin_cancel", "x") if i % 4 == 3 else ("confirm_payment", "c")
+            await self.call(f"admin:{name}", bot.route_callback,
+                            self.callback_update(admin_id, bot.make_callback_data(code, appointment_id)), context)
+        views = [
+            ("admin:all_appointments", bot.show_all_appointments, "📋 Все записи"),
+            ("admin:today", bot.show_today_appointments, "📅 Записи на сегодня"),
+            ("admin:by_date", bot.show_appointments_by_date, "🗓️ Записи по дате"),
+            ("admin:client_messages", bot.show_client_messages, "✉️ Сообщения от клиентов"),
+            ("admin:phone_search", bot.handle_phone_search, "4567"),
+        ]
+        for _ in range(self.args.admin_rounds):
+            for name, handler, text in views:
+                await self.call(name, handler, self.message_update(admin_id, text), context)
+            for listing in ("apps", "msgs"):
+                # Кнопка "▶" первой страницы; этот запрос в замеры не входит
+                token = current_sample.set(Sample())
+                page = await bot.load_listing_page(listing)
+                current_sample.reset(token)
+                if page and page[1]:
+                    data = page[1].inline_keyboard[0][-1].callback_data
+                    await self.call(f"admin:page_{listing}", bot.route_callback,
+                                    self.callback_update(admin_id, data), context)
+            await self.call("admin:search", bot.search_messages_command,
+                            self.message_update(admin_id, "/search перенос"),
+                            FakeContext(self.bot, self.job_queue, {}, args=["перенос"]))
+
+    async def jobs(self):
+        """Фоновые задачи"""
+        context = FakeContext(self.bot, self.job_queue, {})
+        await self.call("job:check_expired_payments", bot.check_expired_payments, context)
+        await self.call("job:send_reminders", bot.send_reminders, context)
+        jobs = [job for name_jobs in self.job_queue.jobs.values() for job in name_jobs]
+        for job in jobs[:self.args.job_runs]:
+            callback = bot.send_reminder if job.name.startswith("reminder_") else bot.expire_payment
+            await self.call(f"job:{callback.__name__}", callback,
+                            FakeContext(self.bot, self.job_queue, {}, job=job))
+
+    async def run(self):
+        args = self.args
+        tmp = tempfile.mkdtemp(prefix="bench-")
+        bot.db.path = os.path.join(tmp, "bench.db")
+        instrument_db(bot.db, self.report)
+        bot.db.init_database()
+        seed(bot.db.path, self.rng, args.users, args.messages, args.history)
+        bot.outbox.start(self.bot)
+
+        started = time.perf_counter()
+        chat_ids = [2_000_000 + i for i in range(args.clients)]
+        await asyncio.gather(*(self.client(chat_id) for chat_id in chat_ids))
+        booking_seconds = time.perf_counter() - started
+
+        created = [
+            row[0] for row in await bot.db.read(
+                lambda conn: conn.execute(
+                    "SELECT id FROM appointments WHERE client_chat_id >= 2000000 AND status = 'pending'"
+                ).fetchall()
+            )
+        ]
+        await self.admin(created)
+        await self.jobs()
+        await bot.outbox.stop()
+        await bot.db.write_behind.flush()
+        total_seconds = time.perf_counter() - started
+        bot.db.close()
+        return self.summary(created, booking_seconds, total_seconds)
+
+    def summary(self, created, booking_seconds, total_seconds):
+        report = self.report
+        handlers = {}
+        for name, values in sorted(report.latencies.items()):
+            handlers[name] = {
+                "count": len(values),
+                "p50_ms": round(percentile(values, 50) * 1000, 3),
+                "p95_ms": round(percentile(values, 95) * 1000, 3),
+                "p99_ms": round(percentile(values, 99) * 1000, 3),
+                "sql_per_call": round(report.sql[name] / len(values), 2),
+                "tg_per_call": round(report.tg[name] / len(values), 2),
+            }
+        updates = report.updates()
+        client_updates = sum(
+            len(values) for name, values in report.latencies.items() if not name.startswith(("admin:", "job:"))
+        )
+        return {
+            "handlers": handlers,
+            "totals": {
+                "updates": updates,
+                "bookings": len(created),
+                "booking_seconds": round(booking_seconds, 3),
+                "total_seconds": round(total_seconds, 3),
+                "client_updates_per_sec": round(client_updates / booking_seconds, 1),
+                "sql_per_update": round((sum(report.sql.values()) + report.background_sql) / updates, 2),
+                "tg_per_update": round((sum(report.tg.values()) + report.background_tg) / updates, 2),
+                "background_tg": report.background_tg,
+            },
+        }
+
+
+# ================== ХОЛОДНЫЙ СТАРТ ==================
+STARTUP_TOKEN = "0:startup"
+STARTUP_CHAT_ID = 3_000_000
+
+
+class FakeTelegramApi:
+    """Заглушка Bot API для бота в отдельном процессе.
+
+    Отвечает на методы, которые бот вызывает при запуске и на /start,
+    помнит адрес вебхука между запусками (как Telegram) и момент первого
+    вызова каждого метода в текущем запуске.
+    """
+
+    def __init__(self, token):
+        self.server = HttpServer()
+        self.port = None
+        self.webhook_url = ""
+        self.calls = {}
+        self.replied = asyncio.Event()
+        self._message_ids = itertools.count(1)
+        for method in ("getMe", "getWebhookInfo", "setWebhook", "deleteWebhook", "sendMessage"):
+            self.server.route("POST", f"/bot{token}/{method}", self._handler(method))
+
+    async def start(self):
+        self.port = free_port()
+        await self.server.start("127.0.0.1", self.port)
+
+    def reset(self):
+        self.calls.clear()
+        self.replied.clear()
+
+    def _handler(self, method):
+        async def handle(body, headers):
+            self.calls.setdefault(method, time.perf_counter())
+            params = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+            payload = {"ok": True, "result": self._result(method, params)}
+            return HTTPStatus.OK, "application/json", json.dumps(payload).encode()
+        return handle
+
+    def _result(self, method, params):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        if method == "getWebhookInfo":
+            return {"url": self.webhook_url, "has_custom_certificate": False, "pending_update_count": 0}
+        if method == "setWebhook":
+            self.webhook_url = params.get("url", "")
+        if method != "sendMessage":
+            return True
+        chat_id = int(params["chat_id"])
+        if chat_id == STARTUP_CHAT_ID:
+            self.replied.set()
+        return {
+            "message_id": next(self._message_ids), "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"}, "text": params.get("text", ""),
+        }
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def http_request(port, method, path, body=b""):
+    """Код ответа на HTTP-запрос к локальному порту"""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(
+        f"{method} {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Length: {len(body)}\r\n"
+        f"Connection: close\r\n\r\n".encode() + body
+    )
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return int(response.split(b" ", 2)[1])
+
+
+def start_update(update_id):
+    """Апдейт /start, как его присылает Telegram"""
+    user = {"id": STARTUP_CHAT_ID, "is_bot": False, "first_name": "Клиент"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": int(time.time()), "from": user,
+            "chat": {"id": STARTUP_CHAT_ID, "type": "private"}, "text": "/start",
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+        },
+    }
+
+
+async def measure_startup(api, entry, workdir, run, timeout=60):
+    """Один запуск бота: моменты от старта процесса, мс"""
+    port = free_port()
+    env = dict(
+        os.environ, BOT_TOKEN=STARTUP_TOKEN, PORT=str(port), RENDER_EXTERNAL_HOSTNAME=f"127.0.0.1:{port}",
+        TELEGRAM_API_URL=f"http://127.0.0.1:{api.port}/bot",
+    )
+    api.reset()
+    started = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), entry),
+        cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        deadline = started + timeout
+        while True:
+            try:
+                health = await http_request(port, "GET", "/health")
+                break
+            except OSError:
+                if time.perf_counter() > deadline or process.returncode is not None:
+                    raise RuntimeError(f"{entry} не открыл порт")
+                await asyncio.sleep(0.002)
+        port_open = time.perf_counter()
+        # Апдейт, разбудивший инстанс, приходит сразу после открытия порта
+        body = json.dumps(start_update(run)).encode()
+        delivery = asyncio.create_task(http_request(port, "POST", f"/{STARTUP_TOKEN}", body))
+        await asyncio.wait_for(api.replied.wait(), deadline - time.perf_counter())
+        first_update = time.perf_counter()
+        while "getWebhookInfo" not in api.calls and time.perf_counter() < deadline:
+            await asyncio.sleep(0.01)
+        delivered = await delivery
+    finally:
+        if process.returncode is None:
+            process.send_signal(signal.SIGTERM)
+        await process.wait()
+    webhook = api.calls.get("setWebhook", api.calls.get("getWebhookInfo"))
+    return {
+        "port_ms": round((port_open - started) * 1000, 1),
+        "first_update_ms": round((first_update - started) * 1000, 1),
+        "webhook_ms": round((webhook - started) * 1000, 1) if webhook else None,
+        "health": health,
+        "delivery": delivered,
+    }
+
+
+async def startup_bench(args):
+    api = FakeTelegramApi(STARTUP_TOKEN)
+    await api.start()
+    workdir = tempfile.mkdtemp(prefix="bench-startup-")
+    runs = []
+    try:
+        for run in range(1, args.startup + 1):
+            runs.append(await measure_startup(api, args.entry, workdir, run))
+    finally:
+        await api.server.stop()
+    warm = runs[1:] or runs
+    return {
+        "runs": runs,
+        "median": {
+            key: median(result[key] for result in warm)
+            for key in ("port_ms", "first_update_ms", "webhook_ms") if all(result[key] for result in warm)
+        },
+    }
+
+
+# ================== ОТЧЕТ ==================
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(result, previous=None):
+    print(f"\n{'обработчик':<30}{'N':>6}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}{'SQL':>7}{'TG':>6}")
+    for name, row in result["handlers"].items():
+        line = (f"{name:<30}{row['count']:>6}{row['p50_ms']:>10.2f}{row['p95_ms']:>10.2f}"
+                f"{row['p99_ms']:>10.2f}{row['sql_per_call']:>7.1f}{row['tg_per_call']:>6.1f}")
+        old = previous and previous["handlers"].get(name)
+        if old and old["p95_ms"]:
+            line += f"   p95 {(row['p95_ms'] / old['p95_ms'] - 1) * 100:+.0f}%"
+        print(line)
+    print()
+    for key, value in result["totals"].items():
+        line = f"{key:<26}{value}"
+        old = previous and previous["totals"].get(key)
+        if old:
+            line += f"   (было {old})"
+        print(line)
+
+
+def print_startup_report(result, previous=None):
+    print(f"\n{'запуск':<16}{'порт мс':>10}{'апдейт мс':>12}{'вебхук мс':>12}{'health':>8}")
+    for number, run in enumerate(result["runs"], 1):
+        label = f"{number} (новая БД)" if number == 1 else str(number)
+        webhook = run["webhook_ms"] if run["webhook_ms"] is not None else "-"
+        print(f"{label:<16}{run['port_ms']:>10}{run['first_update_ms']:>12}{webhook:>12}{run['health']:>8}")
+    print()
+    for key, value in result["median"].items():
+        line = f"median {key:<19}{value}"
+        old = previous and previous["startup"]["median"].get(key)
+        if old:
+            line += f"   (было {old})"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон сценария записи")
+    parser.add_argument("--clients", type=int, default=100, help="клиентов одновременно")
+    parser.add_argument("--users", type=int, default=20_000, help="пользователей бота в БД")
+    parser.add_argument("--messages", type=int, default=50_000, help="сообщений в БД")
+    parser.add_argument("--history", type=int, default=5_000, help="прошлых записей в БД")
+    parser.add_argument("--admin-rounds", type=int, default=20, help="повторов админских экранов")
+    parser.add_argument("--job-runs", type=int, default=50, help="сколько таймеров записей выполнить")
+    parser.add_argument("--think", type=float, default=0, help="пауза клиента между шагами, мс (до)")
+    parser.add_argument("--tg-latency", type=float, default=0, help="задержка ответа Telegram, мс")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--results", default=RESULTS_PATH, help="куда дописать результат")
+    parser.add_argument("--compare", action="store_true", help="сравнить с прошлым прогоном")
+    parser.add_argument("--startup", type=int, default=0, help="вместо нагрузки: N запусков бота (холодный старт)")
+    parser.add_argument("--entry", default="serve.py", help="чем запускать бота для --startup")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    if args.startup:
+        result = {"startup": asyncio.run(startup_bench(args))}
+        params = {"startup": args.startup, "entry": args.entry}
+    else:
+        result = asyncio.run(Bench(args).run())
+        params = {
+            key: value for key, value in vars(args).items()
+            if key not in ("results", "compare", "startup", "entry")
+        }
+
+    previous = None
+    if args.compare and os.path.exists(args.results):
+        with open(args.results, encoding="utf-8") as f:
+            runs = [json.loads(line) for line in f if line.strip()]
+        previous = next((run for run in reversed(runs) if run["params"] == params), None)
+        if previous:
+            print(f"Сравнение с прогоном {previous['date']} (коммит {previous['commit']})")
+
+    if args.startup:
+        print_startup_report(result["startup"], previous)
+    else:
+        print_report(result, previous)
+    record = {"commit": git_commit(), "date": datetime.now().isoformat(timespec="seconds"), "params": params, **result}
+    with open(args.results, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
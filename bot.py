@@ -1,9 +1,13 @@
 # bot.py
 import os
-import sqlite3
+import json
+import signal
 import asyncio
+import time
 import logging
-from datetime import datetime, timedelta
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+from http import HTTPStatus
 
 from telegram import (
     Update,
@@ -12,6 +16,7 @@ from telegram import (
     InlineKeyboardButton,
     InlineKeyboardMarkup,
 )
+from telegram.error import BadRequest
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -20,8 +25,22 @@ from telegram.ext import (
     ContextTypes,
     ConversationHandler,
     CallbackQueryHandler,
+    TypeHandler,
+    ApplicationHandlerStop,
 )
 
+import analytics
+from broadcast import BroadcastEngine
+from cache import AvailabilityCache
+from database import AppointmentStatus, Database
+from export import ExportWriter
+from metrics import JOB_ERRORS, JOB_SECONDS, THROTTLED, Gauge, instrument_handlers, render as render_metrics, timed
+from outbox import PRIORITY_INTERACTIVE, OutboundRateLimiter, Outbox
+from persistence import SQLitePersistence
+from processor import ChatOrderedUpdateProcessor
+from ratelimit import ALLOW, LIMITED, ChatThrottle
+from webserver import HttpServer
+
 # ================== НАСТРОЙКИ ==================
 BOT_TOKEN = os.environ.get("BOT_TOKEN", "8312388794:AAEBvJwzbz750q3AckSocpdGYSK9Gbv2eUI")
 ADMIN_ID = int(os.environ.get("ADMIN_ID", "465630314"))
@@ -52,368 +71,294 @@ DB_PATH = "appointments.db"
     BROADCAST_MESSAGE,
 ) = range(8)
 
+# Названия состояний для метрик (в том же порядке)
+STATE_NAMES = dict(enumerate((
+    "SELECT_DATE",
+    "SELECT_TIME",
+    "ENTER_NAME",
+    "ENTER_PHONE",
+    "ADMIN_SEARCH_CLIENT",
+    "CLIENT_TO_ADMIN_MESSAGE",
+    "ADMIN_TO_CLIENT_MESSAGE",
+    "BROADCAST_MESSAGE",
+)))
+
 RUSSIAN_WEEKDAYS = {0: "Пн", 1: "Вт", 2: "Ср", 3: "Чт", 4: "Пт", 5: "Сб", 6: "Вс"}
 YUMMY_PAYMENT_LINK = "https://yoomoney.ru/..."  # Замените на реальную ссылку
+PAYMENT_TIMEOUT_SECONDS = 600  # Время на оплату записи
+REMINDER_OFFSET_HOURS = float(os.environ.get("REMINDER_OFFSET_HOURS", "24"))  # За сколько часов напоминать
+REMINDER_KIND = "before_visit"
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", "25"))  # Сообщений в секунду при рассылке
+BROADCAST_CONCURRENCY = 8  # Одновременных запросов при рассылке
+SEND_RATE = float(os.environ.get("SEND_RATE", "25"))  # Общий лимит сообщений в секунду
+OUTBOX_WORKERS = 4  # Воркеров очереди уведомлений
+PORT = int(os.environ.get("PORT", 10000))  # Порт вебхука и /metrics на Render
+APP_NAME = os.environ.get("RENDER_EXTERNAL_HOSTNAME")  # Задан - запуск через webhook
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9100"))  # Локальный /metrics в режиме polling
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org/bot")  # Свой сервер Bot API
+UPDATE_CONCURRENCY = int(os.environ.get("UPDATE_CONCURRENCY", "16"))  # Апдейтов разных чатов одновременно
+FLOOD_RATE = float(os.environ.get("FLOOD_RATE", "1"))  # Токенов в секунду на чат
+FLOOD_BURST = 20  # Запас токенов чата
+FLOOD_COOLDOWN_SECONDS = 30  # Пауза для чата, исчерпавшего токены
+FLOOD_COALESCE_SECONDS = 3  # Одинаковые запросы чаще этого обрабатываются один раз
+FLOOD_DEFAULT_COST = 1
+FLOOD_COSTS = {  # Цена апдейта по обработчику: клавиатура дат, запись в БД, уведомление мастеру
+    "start_booking": 4,
+    "select_date": 3,
+    "select_time": 3,
+    "enter_phone": 3,
+    "show_my_appointments": 2,
+    "handle_client_to_admin_message": 2,
+    "client_cancel_appointment": 2,
+}
+APPOINTMENTS_PAGE_SIZE = 10  # Записей на странице списка админа
+MESSAGES_PAGE_SIZE = 5  # Сообщений на странице списка админа
+MESSAGE_PREVIEW_LENGTH = 500  # Сообщения длиннее обрезаются в списке
+CLIENT_NAME_MAX_LENGTH = 64  # Длиннее имя не принимается при записи и обрезается в списке
+CLIENT_PHONE_PREVIEW_LENGTH = 32  # Телефон, введенный текстом, обрезается в списке
+STATS_DAYS = 30  # За сколько последних дней считается загрузка
+SEARCH_RESULTS_LIMIT = 10  # Результатов поиска по сообщениям
+PHONE_SEARCH_LIMIT = 30  # Записей в истории клиента при поиске по телефону
+EXPORT_MAX_BYTES = 50 * 1024 * 1024  # Лимит Telegram на файл, отправленный ботом
+ADMIN_NAME = "Мастер"  # Автор ответов мастера в переписке
+SLOT_HOLD_SECONDS = 600  # Сколько слот удерживается за клиентом при оформлении
+TIME_SLOTS = (
+    "09:00", "10:00", "11:00", "12:00", "13:00", "14:00",
+    "15:00", "16:00", "17:00", "18:00", "19:00", "20:00",
+)
 
 # ================== БАЗА ДАННЫХ ==================
-def init_database():
-    """Инициализация базы данных"""
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-
-        # Таблица записей
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS appointments (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                client_name TEXT NOT NULL,
-                client_phone TEXT NOT NULL,
-                appointment_date TEXT NOT NULL,
-                appointment_time TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                status TEXT DEFAULT 'pending',
-                client_chat_id INTEGER,
-                payment_status TEXT DEFAULT 'not_paid'
-            )
-        ''')
-
-        # Таблица сообщений
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                client_chat_id INTEGER NOT NULL,
-                client_name TEXT NOT NULL,
-                message_text TEXT NOT NULL,
-                is_from_client BOOLEAN NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-
-        # Таблица заблокированных слотов
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS blocked_slots (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                blocked_date TEXT NOT NULL,
-                blocked_time TEXT,
-                is_all_day BOOLEAN DEFAULT 0,
-                reason TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-
-        # Таблица пользователей бота
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS bot_users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                chat_id INTEGER UNIQUE NOT NULL,
-                username TEXT,
-                first_name TEXT,
-                last_name TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+db = Database(DB_PATH)
 
-        conn.commit()
-        conn.close()
-        logger.info("✅ База данных инициализирована")
-    except Exception as e:
-        logger.error(f"❌ Ошибка инициализации БД: {e}")
-
-def save_bot_user(chat_id, username=None, first_name=None, last_name=None):
-    """Сохранение пользователя бота"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT OR REPLACE INTO bot_users (chat_id, username, first_name, last_name) VALUES (?, ?, ?, ?)",
-        (chat_id, username, first_name, last_name)
-    )
-    conn.commit()
-    conn.close()
-
-def get_all_bot_users():
-    """Получение всех пользователей бота"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM bot_users")
-    users = cursor.fetchall()
-    conn.close()
-    return users
-
-def save_appointment_to_db(name, phone, date, time_slot, chat_id):
-    """Сохранение записи в БД"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        """INSERT INTO appointments (client_name, client_phone, appointment_date, appointment_time, client_chat_id) 
-           VALUES (?, ?, ?, ?, ?)""",
-        (name, phone, date, time_slot, chat_id)
-    )
-    conn.commit()
-    appointment_id = cursor.lastrowid
-    conn.close()
-    return appointment_id
-
-def get_client_appointments(chat_id):
-    """Получение записей клиента"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        """SELECT * FROM appointments 
-           WHERE client_chat_id = ? AND status IN ('pending', 'confirmed')
-           ORDER BY appointment_date, appointment_time""",
-        (chat_id,)
-    )
-    appointments = cursor.fetchall()
-    conn.close()
-    return appointments
-
-def get_all_appointments():
-    """Получение всех записей"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        """SELECT * FROM appointments 
-           WHERE status IN ('pending', 'confirmed')
-           ORDER BY appointment_date, appointment_time"""
-    )
-    appointments = cursor.fetchall()
-    conn.close()
-    return appointments
-
-def get_appointment_by_id(appointment_id):
-    """Получение записи по ID"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM appointments WHERE id = ?", (appointment_id,))
-    appointment = cursor.fetchone()
-    conn.close()
-    return appointment
-
-def confirm_payment(appointment_id):
-    """Подтверждение оплаты"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        "UPDATE appointments SET status = 'confirmed', payment_status = 'paid' WHERE id = ?",
-        (appointment_id,)
-    )
-    conn.commit()
-    conn.close()
-    return get_appointment_by_id(appointment_id)
-
-def cancel_appointment(appointment_id):
-    """Отмена записи"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("UPDATE appointments SET status = 'cancelled' WHERE id = ?", (appointment_id,))
-    conn.commit()
-    conn.close()
-    return get_appointment_by_id(appointment_id)
-
-def expire_appointment(appointment_id):
-    """Просрочка записи"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("UPDATE appointments SET status = 'expired' WHERE id = ?", (appointment_id,))
-    conn.commit()
-    conn.close()
-    return get_appointment_by_id(appointment_id)
-
-def get_pending_appointments():
-    """Получение ожидающих оплаты записей"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT * FROM appointments WHERE status = 'pending' AND payment_status = 'not_paid'"
-    )
-    appointments = cursor.fetchall()
-    conn.close()
-    return appointments
-
-def add_blocked_slot(date, time_slot=None, reason=""):
-    """Добавление заблокированного слота"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    is_all_day = 1 if time_slot is None else 0
-    cursor.execute(
-        "INSERT INTO blocked_slots (blocked_date, blocked_time, is_all_day, reason) VALUES (?, ?, ?, ?)",
-        (date, time_slot, is_all_day, reason)
-    )
-    conn.commit()
-    conn.close()
-
-def get_blocked_slots(date=None):
-    """Получение заблокированных слотов"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    if date:
-        cursor.execute("SELECT * FROM blocked_slots WHERE blocked_date = ?", (date,))
-    else:
-        cursor.execute("SELECT * FROM blocked_slots")
-    slots = cursor.fetchall()
-    conn.close()
-    return slots
-
-def is_slot_blocked(date, time_slot):
-    """Проверка заблокирован ли слот"""
-    blocked_slots = get_blocked_slots(date)
-    for slot in blocked_slots:
-        if slot[3]:  # is_all_day
-            return True
-        elif slot[2] == time_slot:
-            return True
-    return False
-
-def remove_blocked_slot(slot_id):
-    """Удаление заблокированного слота"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM blocked_slots WHERE id = ?", (slot_id,))
-    conn.commit()
-    conn.close()
-
-def is_time_slot_taken(date, time_slot):
-    """Проверка занятости времени"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        """SELECT COUNT(*) FROM appointments 
-           WHERE appointment_date = ? AND appointment_time = ? AND status IN ('pending', 'confirmed')""",
-        (date, time_slot)
-    )
-    count = cursor.fetchone()[0]
-    conn.close()
-    return count > 0
-
-def save_message(client_chat_id, client_name, message_text, is_from_client):
-    """Сохранение сообщения"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        """INSERT INTO messages (client_chat_id, client_name, message_text, is_from_client) 
-           VALUES (?, ?, ?, ?)""",
-        (client_chat_id, client_name, message_text, is_from_client)
-    )
-    conn.commit()
-    conn.close()
-
-def get_client_messages(limit=20):
-    """Получение сообщений от клиентов"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        """SELECT * FROM messages 
-           WHERE is_from_client = 1 
-           ORDER BY created_at DESC 
-           LIMIT ?""",
-        (limit,)
-    )
-    messages = cursor.fetchall()
-    conn.close()
-    return messages
+# Кэш доступности по датам, сбрасывается при каждой записи в БД
+availability_cache = AvailabilityCache(max_size=64)
+db.add_listener(availability_cache.invalidate)
+
+# Все запросы к Telegram проходят через общий ограничитель частоты,
+# уведомления отправляются из очереди, не задерживая обработчики
+rate_limiter = OutboundRateLimiter(global_rate=SEND_RATE)
+outbox = Outbox(db, workers=OUTBOX_WORKERS)
+
+# Апдейты разных чатов обрабатываются параллельно, одного чата - по порядку
+update_processor = ChatOrderedUpdateProcessor(max_concurrent_updates=UPDATE_CONCURRENCY)
+
+# Флуд из одного чата отсекается до обработчиков (группа -1)
+chat_throttle = ChatThrottle(
+    rate=FLOOD_RATE, capacity=FLOOD_BURST, cooldown=FLOOD_COOLDOWN_SECONDS, coalesce=FLOOD_COALESCE_SECONDS
+)
+
+# Состояния разговоров и user_data переживают перезапуск бота
+persistence = SQLitePersistence(db)
+
+# Рассылки: ~BROADCAST_RATE сообщений в секунду, несколько запросов одновременно
+broadcast_engine = BroadcastEngine(db, rate=BROADCAST_RATE, concurrency=BROADCAST_CONCURRENCY)
+
+# ================== МЕТРИКИ ==================
+# /metrics в формате Prometheus: на порту вебхука или на локальном METRICS_PORT при polling
+http_server = HttpServer()
+
+Gauge("bot_updates_in_flight", "Апдейтов в обработке", lambda: update_processor.in_flight)
+Gauge("bot_updates_waiting", "Апдейтов ждут своей очереди в чате", lambda: update_processor.waiting)
+Gauge("bot_outbox_queue", "Уведомлений в очереди отправки", lambda: outbox.qsize())
+Gauge("bot_outbox_dead_total", "Недоставленных уведомлений с запуска", lambda: outbox.dead)
+Gauge("bot_rate_limiter_queue", "Запросов ждут лимита Telegram", lambda: rate_limiter.queue_depth())
+Gauge("bot_availability_cache_hit_ratio", "Доля попаданий кэша доступности",
+      lambda: availability_cache.stats()["hit_rate"])
+
+async def metrics_endpoint(body, headers):
+    """GET /metrics"""
+    return HTTPStatus.OK, "text/plain; version=0.0.4; charset=utf-8", render_metrics().encode()
+
+http_server.route("GET", "/metrics", metrics_endpoint)
 
 # ================== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ==================
+# Даты хранятся в БД в формате ISO (YYYY-MM-DD), время - HH:MM.
+# Формат "Пн 05.10" используется только для кнопок и сообщений.
 def format_date_for_storage(dt):
     """Форматирование даты для хранения"""
-    weekday_russian = RUSSIAN_WEEKDAYS[dt.weekday()]
-    return f"{weekday_russian} {dt.strftime('%d.%m')}"
+    return dt.strftime("%Y-%m-%d")
+
+def format_datetime_for_storage(dt):
+    """Момент времени в формате колонки starts_at"""
+    return dt.strftime("%Y-%m-%d %H:%M")
 
-def parse_day_month_from_button(selected_date):
-    """Парсинг даты из кнопки"""
+def format_date_for_display(date_str):
+    """Форматирование даты из БД для кнопок и сообщений"""
     try:
-        parts = selected_date.split(" ")
-        if len(parts) < 2:
-            raise ValueError("Неверный формат даты")
-        day_part = parts[1]
-        day, month = day_part.split(".")
-        return int(day), int(month)
-    except Exception:
-        raise
+        dt = datetime.strptime(date_str, "%Y-%m-%d")
+    except (TypeError, ValueError):
+        return date_str
+    return f"{RUSSIAN_WEEKDAYS[dt.weekday()]} {dt.strftime('%d.%m')}"
+
+def format_appointment_date(appointment):
+    """Дата записи для сообщений (без повторного разбора строки)"""
+    if appointment.starts is None:
+        return format_date_for_display(appointment.date)
+    return f"{RUSSIAN_WEEKDAYS[appointment.starts.weekday()]} {appointment.starts:%d.%m}"
+
+def parse_date_from_button(button_text, days_ahead=30):
+    """Дата хранения по тексту кнопки из окна записи (или None)"""
+    for date_str in get_booking_dates(days_ahead):
+        if format_date_for_display(date_str) == button_text:
+            return date_str
+    return None
 
 def is_valid_datetime(selected_date, selected_time):
     """Проверка валидности даты и времени"""
-    try:
-        now = datetime.now()
-        day, month = parse_day_month_from_button(selected_date)
-        year = now.year
-        selected_month = int(month)
-        current_month = now.month
-        
-        if selected_month < current_month and (current_month - selected_month) > 6:
-            year += 1
-            
-        selected_datetime = datetime(year, selected_month, day)
-        hours, minutes = map(int, selected_time.split(":"))
-        selected_datetime = selected_datetime.replace(hour=hours, minute=minutes)
-        return selected_datetime > now
-    except Exception:
-        return False
+    selected_datetime = get_slot_datetime(selected_date, selected_time)
+    return selected_datetime is not None and selected_datetime > datetime.now()
 
 def is_future_date(selected_date):
     """Проверка что дата в будущем"""
     try:
-        now = datetime.now()
-        day, month = parse_day_month_from_button(selected_date)
-        year = now.year
-        selected_month = int(month)
-        current_month = now.month
-        
-        if selected_month < current_month and (current_month - selected_month) > 6:
-            year += 1
-            
-        selected_datetime = datetime(year, selected_month, day)
-        return selected_datetime.date() >= now.date()
-    except Exception:
+        selected = datetime.strptime(selected_date, "%Y-%m-%d").date()
+    except (TypeError, ValueError):
         return False
+    return selected >= datetime.now().date()
 
-def get_appointment_datetime(appointment):
-    """Получение datetime записи"""
+def get_slot_datetime(date_str, time_str):
+    """Получение datetime слота по дате хранения и времени"""
     try:
-        date_str = appointment[3]
-        time_str = appointment[4]
-        day, month = parse_day_month_from_button(date_str)
-        year = datetime.now().year
-        
-        if month < datetime.now().month and (datetime.now().month - month) > 6:
-            year += 1
-            
-        hours, minutes = map(int, time_str.split(":"))
-        return datetime(year, month, day, hours, minutes)
-    except Exception:
+        return datetime.strptime(f"{date_str} {time_str}", "%Y-%m-%d %H:%M")
+    except (TypeError, ValueError):
         return None
 
+# ================== ДОСТУПНОСТЬ ==================
+# Свободные слоты одной даты: closed - день заблокирован целиком,
+# free - свободное время в порядке TIME_SLOTS
+DaySlots = namedtuple("DaySlots", ["closed", "free"])
+
+def get_booking_dates(days_ahead=30):
+    """Даты окна записи в формате хранения"""
+    today = datetime.now()
+    return [format_date_for_storage(today + timedelta(days=i)) for i in range(days_ahead)]
+
+async def get_availability(dates):
+    """Свободные слоты на набор дат: {дата: DaySlots}.
+
+    Даты берутся из кэша, недостающие загружаются двумя запросами,
+    независимо от числа дат и слотов.
+    """
+    now = time.time()
+    cached = {}
+    missing = []
+    for date_text in dates:
+        entry = availability_cache.get(date_text, now)
+        if entry is None:
+            missing.append(date_text)
+        else:
+            cached[date_text] = entry.value
+
+    if missing:
+        versions = {date_text: availability_cache.version(date_text) for date_text in missing}
+        taken, blocked, holds_until = await db.get_occupancy(missing)
+        for date_text in missing:
+            day = compute_day_slots(
+                taken.get(date_text, set()), blocked.get(date_text, set()), date_text
+            )
+            cached[date_text] = day
+            availability_cache.put(
+                date_text, day, versions[date_text],
+                expires_at=get_slots_expiry(date_text, day, holds_until.get(date_text))
+            )
+
+    return {date_text: cached[date_text] for date_text in dates}
+
+def compute_day_slots(taken_times, blocked_times, date_text):
+    """Свободные слоты даты по занятому и заблокированному времени"""
+    if None in blocked_times:
+        return DaySlots(closed=True, free=())
+    busy = taken_times | blocked_times
+    free = tuple(
+        time_slot for time_slot in TIME_SLOTS
+        if time_slot not in busy and is_valid_datetime(date_text, time_slot)
+    )
+    return DaySlots(closed=False, free=free)
+
+def get_slots_expiry(date_text, day, hold_until=None):
+    """Момент, когда доступность даты изменится сама по себе (timestamp):
+    первый свободный слот уйдет в прошлое или закончится удержание"""
+    moments = [hold_until] if hold_until else []
+    if day.free:
+        first_slot = get_slot_datetime(date_text, day.free[0])
+        if first_slot:
+            moments.append(first_slot.timestamp())
+    return min(moments) if moments else None
+
+def get_time_keyboard(date_text, day):
+    """Клавиатура со временем для даты (из кэша, если есть)"""
+    return availability_cache.get_keyboard(date_text, lambda: create_time_keyboard(day.free))
+
+# ================== CALLBACK-КНОПКИ ==================
+# callback_data: "<версия><код действия>:<аргумент>", например "1c:42".
+# Версия меняется вместе со смыслом кодов или аргументов; кнопки
+# старого формата ("confirm_payment_42", "page:apps:>:42") остаются в
+# чатах и разбираются через LEGACY_CALLBACKS.
+CALLBACK_VERSION = "1"
+LEGACY_CALLBACKS = {
+    "confirm_payment": "c",
+    "admin_cancel": "x",
+    "client_cancel": "k",
+    "back_to_main": "m",
+    "page": "p",
+    "day": "d",
+    "days": "w",
+    "admin_reply": "r",
+}
+
+# Код -> действие; handler(query, context, аргумент) возвращает текст
+# всплывающего ответа на нажатие (или None)
+CallbackAction = namedtuple("CallbackAction", ["handler", "admin_only"])
+CALLBACK_ACTIONS = {}
+
+def callback_action(code, admin_only=False):
+    """Регистрация действия inline-кнопки под кодом code"""
+    def register(handler):
+        CALLBACK_ACTIONS[code] = CallbackAction(handler, admin_only)
+        return handler
+    return register
+
+def make_callback_data(code, arg=""):
+    """callback_data кнопки действия code"""
+    return f"{CALLBACK_VERSION}{code}:{arg}"
+
+def callback_pattern(code):
+    """pattern для CallbackQueryHandler: кнопки действия code в любом формате"""
+    return lambda data: parse_callback_data(data)[0] == code
+
+def parse_callback_data(data):
+    """(код действия, аргумент) по callback_data; код None - неизвестная кнопка"""
+    if data.startswith(CALLBACK_VERSION):
+        code, _, arg = data[len(CALLBACK_VERSION):].partition(":")
+        return code, arg
+    name, separator, arg = data.partition(":")
+    if not separator:
+        name, _, arg = data.rpartition("_")
+        if not arg.isdigit():
+            name, arg = data, ""
+    return LEGACY_CALLBACKS.get(name), arg
+
 # ================== КЛАВИАТУРЫ ==================
-def create_dates_keyboard(days_ahead=30):
+def create_dates_keyboard(availability):
     """Клавиатура с датами"""
-    buttons = []
-    today = datetime.now()
-    
-    for i in range(days_ahead):
-        current_date = today + timedelta(days=i)
-        if current_date.date() < today.date():
-            continue
-        date_text = format_date_for_storage(current_date)
-        if not is_slot_blocked(date_text, None):
-            buttons.append(KeyboardButton(date_text))
+    buttons = [
+        KeyboardButton(format_date_for_display(date_text))
+        for date_text, day in availability.items()
+        if day.free
+    ]
     
     rows = [buttons[i:i+4] for i in range(0, len(buttons), 4)]
     rows.append([KeyboardButton("❌ Отмена")])
     return ReplyKeyboardMarkup(rows, resize_keyboard=True)
 
-def create_time_keyboard(selected_date):
+async def build_dates_keyboard(days_ahead=30):
+    """Клавиатура с датами на окно записи"""
+    availability = await get_availability(get_booking_dates(days_ahead))
+    open_dates = tuple(date_text for date_text, day in availability.items() if day.free)
+    return availability_cache.get_dates_keyboard(open_dates, lambda: create_dates_keyboard(availability))
+
+def create_time_keyboard(available_slots):
     """Клавиатура со временем"""
-    all_time_slots = [
-        "09:00", "10:00", "11:00", "12:00", "13:00", "14:00", 
-        "15:00", "16:00", "17:00", "18:00", "19:00", "20:00"
-    ]
-    
-    available_slots = []
-    for time_slot in all_time_slots:
-        if (not is_time_slot_taken(selected_date, time_slot) and 
-            is_valid_datetime(selected_date, time_slot) and 
-            not is_slot_blocked(selected_date, time_slot)):
-            available_slots.append(time_slot)
-    
     time_keyboard = []
     row = []
     for i, time_slot in enumerate(available_slots):
@@ -423,20 +368,20 @@ def create_time_keyboard(selected_date):
             row = []
     
     time_keyboard.append([KeyboardButton("❌ Отмена")])
-    return ReplyKeyboardMarkup(time_keyboard, resize_keyboard=True), available_slots
+    return ReplyKeyboardMarkup(time_keyboard, resize_keyboard=True)
 
 def create_my_appointments_keyboard(appointments):
     """Клавиатура записей клиента"""
     keyboard = []
     for app in appointments:
-        status_icon = "✅" if app[6] == "confirmed" else "⏳"
+        status_icon = "✅" if app.status is AppointmentStatus.CONFIRMED else "⏳"
         keyboard.append([
             InlineKeyboardButton(
-                f"{status_icon} {app[3]} {app[4]} (Отменить)",
-                callback_data=f"client_cancel_{app[0]}"
+                f"{status_icon} {format_appointment_date(app)} {app.time} (Отменить)",
+                callback_data=make_callback_data("k", app.id)
             )
         ])
-    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")])
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data=make_callback_data("m"))])
     return InlineKeyboardMarkup(keyboard)
 
 def create_admin_main_keyboard():
@@ -445,7 +390,8 @@ def create_admin_main_keyboard():
         [KeyboardButton("📋 Все записи"), KeyboardButton("📅 Записи на сегодня")],
         [KeyboardButton("🗓️ Записи по дате"), KeyboardButton("🔍 Поиск по телефону")],
         [KeyboardButton("✉️ Сообщения от клиентов"), KeyboardButton("🚫 Управление выходными")],
-        [KeyboardButton("📢 Сделать рассылку"), KeyboardButton("❌ Закрыть админ-панель")],
+        [KeyboardButton("📢 Сделать рассылку"), KeyboardButton("📊 Статистика")],
+        [KeyboardButton("❌ Закрыть админ-панель")],
     ]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
@@ -462,7 +408,7 @@ def create_main_keyboard():
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /start"""
     user = update.message.from_user
-    save_bot_user(
+    await db.save_bot_user(
         chat_id=update.message.chat.id,
         username=user.username,
         first_name=user.first_name,
@@ -485,40 +431,156 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=create_admin_main_keyboard()
     )
 
+async def cache_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /cache - статистика кэша доступности"""
+    if update.message.chat.id != ADMIN_ID:
+        return
+        
+    stats = availability_cache.stats()
+    await update.message.reply_text(
+        f"🗄 КЭШ ДОСТУПНОСТИ\n\n"
+        f"Записей: {stats['size']} из {stats['max_size']}\n"
+        f"Попаданий: {stats['hits']}\n"
+        f"Промахов: {stats['misses']}\n"
+        f"Доля попаданий: {stats['hit_rate']:.0%}\n"
+        f"Сбросов: {stats['invalidations']}\n"
+        f"Вытеснений: {stats['evictions']}"
+    )
+
+async def queues_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /queues - загрузка обработки апдейтов и очередей отправки"""
+    if update.message.chat.id != ADMIN_ID:
+        return
+        
+    updates = update_processor.stats()
+    sending = outbox.stats()
+    await update.message.reply_text(
+        f"⚙️ ОЧЕРЕДИ\n\n"
+        f"Апдейтов в обработке: {updates['in_flight']} из {updates['limit']}\n"
+        f"Ждут своей очереди: {updates['waiting']} (чатов: {updates['chats']})\n"
+        f"Обработано: {updates['processed']}\n\n"
+        f"Очередь уведомлений: {sending['queued']} (ждут повтора: {sending['delayed']})\n"
+        f"Ждут лимита Telegram: {rate_limiter.queue_depth()}\n"
+        f"Отправлено: {sending['sent']}, не доставлено: {sending['dead']}\n\n"
+        f"{format_throttle_stats(chat_throttle.stats())}"
+    )
+
+EXPORT_USAGE = (
+    "📤 ВЫГРУЗКА\n\n"
+    "/export appointments [дата [дата]] [статус] [xlsx]\n"
+    "/export users [xlsx]\n"
+    "/export messages [дата [дата]] [xlsx]\n\n"
+    "Даты: 2025-10-01 или 01.10.2025, одна дата - только этот день.\n"
+    "Статусы: pending, confirmed, cancelled, expired."
+)
+
+def parse_export_date(text):
+    """Дата хранения из YYYY-MM-DD или DD.MM.YYYY (или None)"""
+    for fmt in ("%Y-%m-%d", "%d.%m.%Y"):
+        try:
+            return format_date_for_storage(datetime.strptime(text, fmt))
+        except ValueError:
+            pass
+    return None
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /export - выгрузка записей, пользователей или переписки файлом"""
+    if update.message.chat.id != ADMIN_ID:
+        return
+        
+    args = [arg.lower() for arg in context.args]
+    if not args or args[0] not in ("appointments", "users", "messages"):
+        await update.message.reply_text(EXPORT_USAGE)
+        return
+        
+    kind, dates, status, fmt = args[0], [], None, "csv"
+    statuses = {status.value for status in AppointmentStatus} if kind == "appointments" else set()
+    for arg in args[1:]:
+        date = parse_export_date(arg) if kind != "users" else None
+        if arg in ("csv", "xlsx"):
+            fmt = arg
+        elif arg in statuses:
+            status = arg
+        elif date and len(dates) < 2:
+            dates.append(date)
+        else:
+            await update.message.reply_text(f"❌ Непонятный параметр «{arg}»\n\n{EXPORT_USAGE}")
+            return
+    date_from = dates[0] if dates else None
+    date_to = dates[-1] if dates else None
+    
+    try:
+        writer = ExportWriter(fmt)
+    except ImportError:
+        await update.message.reply_text("Для XLSX не установлен openpyxl, выгружаю в CSV.")
+        fmt = "csv"
+        writer = ExportWriter(fmt)
+        
+    await update.message.reply_text("⏳ Готовлю выгрузку...")
+    try:
+        if kind == "appointments":
+            rows = await db.export_appointments(writer, date_from, date_to, status)
+        elif kind == "users":
+            rows = await db.export_users(writer)
+        else:
+            rows = await db.export_messages(writer, date_from, date_to)
+        # Сохранение XLSX собирает файл целиком - не в цикле событий
+        document = await asyncio.get_running_loop().run_in_executor(None, writer.finish)
+        
+        if writer.size() > EXPORT_MAX_BYTES:
+            await update.message.reply_text(
+                "❌ Файл больше 50 МБ, Telegram его не примет. Сузьте период или выберите статус."
+            )
+            return
+            
+        await update.message.reply_document(
+            document,
+            filename=f"{kind}_{datetime.now():%Y%m%d_%H%M}.{fmt}",
+            caption=f"📤 Строк: {rows}",
+        )
+    except Exception as e:
+        logger.error(f"Ошибка выгрузки {kind}: {e}")
+        await update.message.reply_text("❌ Не удалось подготовить выгрузку.")
+    finally:
+        writer.close()
+
 # ================== ПРОЦЕСС ЗАПИСИ ==================
 async def start_booking(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Начало процесса записи"""
     await update.message.reply_text(
         "Выберите удобную дату (доступны даты на месяц вперед):",
-        reply_markup=create_dates_keyboard()
+        reply_markup=await build_dates_keyboard()
     )
     return SELECT_DATE
 
 async def select_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Выбор даты"""
-    selected_date = update.message.text
+    date_text = update.message.text
     
-    if selected_date == "❌ Отмена":
+    if date_text == "❌ Отмена":
         await update.message.reply_text("Запись отменена.", reply_markup=create_main_keyboard())
         return ConversationHandler.END
         
-    if not is_future_date(selected_date):
-        await update.message.reply_text("Нельзя выбрать прошедшую дату. Выберите другую дату:", reply_markup=create_dates_keyboard())
+    selected_date = parse_date_from_button(date_text)
+    if not selected_date or not is_future_date(selected_date):
+        await update.message.reply_text("Нельзя выбрать прошедшую дату. Выберите другую дату:", reply_markup=await build_dates_keyboard())
         return SELECT_DATE
         
-    if is_slot_blocked(selected_date, None):
-        await update.message.reply_text("На эту дату запись невозможна. Выберите другую дату:", reply_markup=create_dates_keyboard())
+    day = (await get_availability([selected_date]))[selected_date]
+    if day.closed:
+        await update.message.reply_text("На эту дату запись невозможна. Выберите другую дату:", reply_markup=await build_dates_keyboard())
         return SELECT_DATE
         
     context.user_data["selected_date"] = selected_date
-    time_keyboard, available_slots = create_time_keyboard(selected_date)
+    available_slots = day.free
+    time_keyboard = get_time_keyboard(selected_date, day)
     
     if not available_slots:
-        await update.message.reply_text(f"На {selected_date} нет свободного времени. Выберите другую дату.", reply_markup=create_dates_keyboard())
+        await update.message.reply_text(f"На {date_text} нет свободного времени. Выберите другую дату.", reply_markup=await build_dates_keyboard())
         return SELECT_DATE
         
     await update.message.reply_text(
-        f"Вы выбрали: {selected_date}\nСвободное время:",
+        f"Вы выбрали: {date_text}\nСвободное время:",
         reply_markup=time_keyboard
     )
     return SELECT_TIME
@@ -534,15 +596,18 @@ async def select_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
     selected_date = context.user_data.get("selected_date")
     
     if not is_valid_datetime(selected_date, selected_time):
-        await update.message.reply_text("Это время уже прошло. Пожалуйста, выберите другое время.", reply_markup=create_dates_keyboard())
-        return SELECT_DATE
-        
-    if is_time_slot_taken(selected_date, selected_time):
-        await update.message.reply_text("Это время только что заняли. Пожалуйста, выберите другое время.", reply_markup=create_dates_keyboard())
+        await update.message.reply_text("Это время уже прошло. Пожалуйста, выберите другое время.", reply_markup=await build_dates_keyboard())
         return SELECT_DATE
         
-    if is_slot_blocked(selected_date, selected_time):
-        await update.message.reply_text("Это время недоступно для записи. Пожалуйста, выберите другое время.", reply_markup=create_dates_keyboard())
+    # Слот удерживается за клиентом, пока он вводит имя и телефон
+    held = selected_time in TIME_SLOTS and await db.hold_slot(
+        selected_date, selected_time, update.message.chat.id, SLOT_HOLD_SECONDS
+    )
+    if not held:
+        if selected_time not in TIME_SLOTS or await db.is_slot_blocked(selected_date, selected_time):
+            await update.message.reply_text("Это время недоступно для записи. Пожалуйста, выберите другое время.", reply_markup=await build_dates_keyboard())
+        else:
+            await update.message.reply_text("Это время только что заняли. Пожалуйста, выберите другое время.", reply_markup=await build_dates_keyboard())
         return SELECT_DATE
         
     context.user_data["selected_time"] = selected_time
@@ -557,9 +622,16 @@ async def enter_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     client_name = update.message.text
     
     if client_name == "❌ Отмена":
+        await db.release_hold(update.message.chat.id)
         await update.message.reply_text("Запись отменена.", reply_markup=create_main_keyboard())
         return ConversationHandler.END
         
+    if len(client_name) > CLIENT_NAME_MAX_LENGTH:
+        await update.message.reply_text(
+            f"Имя слишком длинное (больше {CLIENT_NAME_MAX_LENGTH} символов). Введите имя покороче:"
+        )
+        return ENTER_NAME
+        
     context.user_data["client_name"] = client_name
     await update.message.reply_text(
         "Введите ваш номер телефона:",
@@ -578,6 +650,7 @@ async def enter_phone(update: Update, context: ContextTypes.DEFAULT_TYPE):
         client_phone = update.message.text
         
     if client_phone == "❌ Отмена":
+        await db.release_hold(update.message.chat.id)
         await update.message.reply_text("Запись отменена.", reply_markup=create_main_keyboard())
         context.user_data.clear()
         return ConversationHandler.END
@@ -587,35 +660,41 @@ async def enter_phone(update: Update, context: ContextTypes.DEFAULT_TYPE):
     selected_time = context.user_data.get("selected_time")
     client_chat_id = update.message.chat.id
     
-    appointment_id = save_appointment_to_db(client_name, client_phone, selected_date, selected_time, client_chat_id)
+    appointment_id = await db.save_appointment_to_db(client_name, client_phone, selected_date, selected_time, client_chat_id)
     
-    # Уведомление админу
-    try:
-        await context.bot.send_message(
-            ADMIN_ID,
-            f"📋 НОВАЯ ЗАПИСЬ!\n\n"
-            f"👤 Клиент: {client_name}\n"
-            f"📞 Телефон: {client_phone}\n"
-            f"📅 Дата: {selected_date}\n"
-            f"⏰ Время: {selected_time}\n"
-            f"🆔 Номер записи: #{appointment_id}",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("✅ Подтвердить оплату", callback_data=f"confirm_payment_{appointment_id}"),
-                InlineKeyboardButton("❌ Отменить запись", callback_data=f"admin_cancel_{appointment_id}")
-            ]])
+    if appointment_id is None:
+        await update.message.reply_text(
+            "К сожалению, это время уже заняли. Пожалуйста, выберите другую дату:",
+            reply_markup=await build_dates_keyboard()
         )
-    except Exception as e:
-        logger.error(f"Ошибка уведомления админа: {e}")
+        return SELECT_DATE
+        
+    schedule_payment_expiry(context.job_queue, appointment_id, PAYMENT_TIMEOUT_SECONDS)
+    
+    # Уведомление админу
+    outbox.send_message(
+        ADMIN_ID,
+        f"📋 НОВАЯ ЗАПИСЬ!\n\n"
+        f"👤 Клиент: {client_name}\n"
+        f"📞 Телефон: {client_phone}\n"
+        f"📅 Дата: {format_date_for_display(selected_date)}\n"
+        f"⏰ Время: {selected_time}\n"
+        f"🆔 Номер записи: #{appointment_id}",
+        reply_markup=InlineKeyboardMarkup([[
+            InlineKeyboardButton("✅ Подтвердить оплату", callback_data=make_callback_data("c", appointment_id)),
+            InlineKeyboardButton("❌ Отменить запись", callback_data=make_callback_data("x", appointment_id))
+        ]])
+    )
     
     await update.message.reply_text(
         f"✅ ЗАПИСЬ СОЗДАНА!\n\n"
         f"👤 Имя: {client_name}\n"
         f"📞 Телефон: {client_phone}\n"
-        f"📅 Дата: {selected_date}\n"
+        f"📅 Дата: {format_date_for_display(selected_date)}\n"
         f"⏰ Время: {selected_time}\n\n"
         f"💳 Для подтверждения записи необходимо внести предоплату.\n"
         f"Ссылка для оплаты: {YUMMY_PAYMENT_LINK}\n\n"
-        f"⏰ Время на оплату: 10 минут\n"
+        f"⏰ Время на оплату: {PAYMENT_TIMEOUT_SECONDS // 60} минут\n"
         f"После оплаты мастер подтвердит вашу запись.",
         reply_markup=create_main_keyboard()
     )
@@ -627,7 +706,7 @@ async def enter_phone(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def show_my_appointments(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать записи клиента"""
     client_chat_id = update.message.chat.id
-    appointments = get_client_appointments(client_chat_id)
+    appointments = await db.get_client_appointments(client_chat_id, since=format_datetime_for_storage(datetime.now()))
     
     if not appointments:
         await update.message.reply_text("У вас нет активных записей.", reply_markup=create_main_keyboard())
@@ -635,44 +714,36 @@ async def show_my_appointments(update: Update, context: ContextTypes.DEFAULT_TYP
         
     message = "📋 ВАШИ АКТИВНЫЕ ЗАПИСИ:\n\n"
     for app in appointments:
-        status_icon = "✅" if app[6] == "confirmed" else "⏳"
-        message += f"{status_icon} {app[3]} {app[4]}\n"
-        message += f"Статус: {'Подтверждена' if app[6] == 'confirmed' else 'Ожидает оплаты'}\n\n"
+        status_icon = "✅" if app.status is AppointmentStatus.CONFIRMED else "⏳"
+        message += f"{status_icon} {format_appointment_date(app)} {app.time}\n"
+        message += f"Статус: {'Подтверждена' if app.status is AppointmentStatus.CONFIRMED else 'Ожидает оплаты'}\n\n"
         
     await update.message.reply_text(message, reply_markup=create_my_appointments_keyboard(appointments))
 
-async def client_cancel_appointment(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@callback_action("k")
+async def client_cancel_appointment(query, context, arg):
     """Отмена записи клиентом"""
-    query = update.callback_query
-    await query.answer()
-    
-    appointment_id = int(query.data.split("_")[-1])
-    appointment = get_appointment_by_id(appointment_id)
-    
+    appointment_id = int(arg)
+    appointment = await db.cancel_appointment(appointment_id, chat_id=query.from_user.id)
     if not appointment:
-        await query.edit_message_text("Запись не найдена.")
-        return
+        return "Запись уже отменена или не найдена."
         
-    cancelled_appointment = cancel_appointment(appointment_id)
+    cancel_payment_expiry(context.job_queue, appointment_id)
+    cancel_reminder(context.job_queue, appointment_id)
     
     # Уведомление админу
-    try:
-        await context.bot.send_message(
-            ADMIN_ID,
-            f"❌ КЛИЕНТ ОТМЕНИЛ ЗАПИСЬ\n\n"
-            f"🆔 Номер записи: #{appointment[0]}\n"
-            f"👤 Клиент: {appointment[1]}\n"
-            f"📞 Телефон: {appointment[2]}\n"
-            f"📅 Дата: {appointment[3]}\n"
-            f"⏰ Время: {appointment[4]}"
-        )
-    except Exception as e:
-        logger.error(f"Ошибка уведомления админа: {e}")
-        
-    await query.edit_message_text(
-        "✅ Запись успешно отменена.",
-        reply_markup=create_main_keyboard()
+    outbox.send_message(
+        ADMIN_ID,
+        f"❌ КЛИЕНТ ОТМЕНИЛ ЗАПИСЬ\n\n"
+        f"🆔 Номер записи: #{appointment.id}\n"
+        f"👤 Клиент: {appointment.client_name}\n"
+        f"📞 Телефон: {appointment.client_phone}\n"
+        f"📅 Дата: {format_appointment_date(appointment)}\n"
+        f"⏰ Время: {appointment.time}"
     )
+        
+    await query.edit_message_text("✅ Запись успешно отменена.")
+    return None
 
 # ================== СООБЩЕНИЯ ==================
 async def start_client_to_admin_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -693,29 +764,23 @@ async def handle_client_to_admin_message(update: Update, context: ContextTypes.D
     client_chat_id = update.message.chat.id
     client_name = update.message.from_user.first_name or "Клиент"
     
-    save_message(client_chat_id, client_name, client_message, is_from_client=True)
+    await db.save_message(client_chat_id, client_name, client_message, is_from_client=True)
     
-    try:
-        await context.bot.send_message(
-            ADMIN_ID,
-            f"💬 НОВОЕ СООБЩЕНИЕ ОТ КЛИЕНТА\n\n"
-            f"👤 Клиент: {client_name}\n"
-            f"🆔 Chat ID: {client_chat_id}\n"
-            f"💭 Сообщение:\n{client_message}",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("✉️ Ответить", callback_data=f"admin_reply_{client_chat_id}")
-            ]])
-        )
-        await update.message.reply_text(
-            "✅ Ваше сообщение отправлено мастеру. Ожидайте ответа здесь же.",
-            reply_markup=create_main_keyboard()
-        )
-    except Exception as e:
-        await update.message.reply_text(
-            "❌ Ошибка отправки сообщения. Попробуйте позже.",
-            reply_markup=create_main_keyboard()
-        )
-        logger.error(f"Ошибка отправки сообщения админу: {e}")
+    outbox.send_message(
+        ADMIN_ID,
+        f"💬 НОВОЕ СООБЩЕНИЕ ОТ КЛИЕНТА\n\n"
+        f"👤 Клиент: {client_name}\n"
+        f"🆔 Chat ID: {client_chat_id}\n"
+        f"💭 Сообщение:\n{client_message}\n\n"
+        f"🧵 Переписка: /thread_{client_chat_id}",
+        reply_markup=InlineKeyboardMarkup([[
+            InlineKeyboardButton("✉️ Ответить", callback_data=make_callback_data("r", client_chat_id))
+        ]])
+    )
+    await update.message.reply_text(
+        "✅ Ваше сообщение отправлено мастеру. Ожидайте ответа здесь же.",
+        reply_markup=create_main_keyboard()
+    )
         
     return ConversationHandler.END
 
@@ -723,9 +788,11 @@ async def start_admin_to_client_message(update: Update, context: ContextTypes.DE
     """Начало ответа клиенту"""
     query = update.callback_query
     await query.answer()
-    
-    client_chat_id = int(query.data.split("_")[-1])
-    context.user_data["admin_message_client_id"] = client_chat_id
+    if query.from_user.id != ADMIN_ID:
+        return ConversationHandler.END
+        
+    _, arg = parse_callback_data(query.data)
+    context.user_data["admin_message_client_id"] = int(arg)
     
     await query.message.reply_text(
         f"💬 ОТВЕТ КЛИЕНТУ\n\nНапишите ваше сообщение:",
@@ -742,19 +809,22 @@ async def handle_admin_to_client_message(update: Update, context: ContextTypes.D
         await update.message.reply_text("Ошибка: не найден ID клиента.")
         return ConversationHandler.END
         
-    try:
-        await context.bot.send_message(
-            client_chat_id,
-            f"💬 СООБЩЕНИЕ ОТ МАСТЕРА:\n\n{admin_message}",
-            reply_markup=create_main_keyboard()
-        )
+    # Админ ждет результата, поэтому ответ идет с приоритетом интерактивного
+    sent = await outbox.send_message(
+        client_chat_id,
+        f"💬 СООБЩЕНИЕ ОТ МАСТЕРА:\n\n{admin_message}",
+        priority=PRIORITY_INTERACTIVE,
+        reply_markup=create_main_keyboard()
+    )
+    if sent:
+        await db.save_message(client_chat_id, ADMIN_NAME, admin_message, is_from_client=False)
         await update.message.reply_text(
             "✅ Сообщение отправлено клиенту.",
             reply_markup=create_admin_main_keyboard()
         )
-    except Exception as e:
+    else:
         await update.message.reply_text(
-            f"❌ Ошибка отправки сообщения клиенту: {e}",
+            "❌ Не удалось отправить сообщение клиенту.",
             reply_markup=create_admin_main_keyboard()
         )
         
@@ -762,173 +832,656 @@ async def handle_admin_to_client_message(update: Update, context: ContextTypes.D
     return ConversationHandler.END
 
 # ================== АДМИН-ФУНКЦИИ ==================
+def create_page_keyboard(listing, rows, has_prev, has_next):
+    """Кнопки листания ◀ ▶ (курсор - ID первой/последней строки страницы)"""
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton("◀", callback_data=make_callback_data("p", f"{listing}:<:{rows[0][0]}")))
+    if has_next:
+        buttons.append(InlineKeyboardButton("▶", callback_data=make_callback_data("p", f"{listing}:>:{rows[-1][0]}")))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+def format_appointments_page(appointments):
+    """Текст страницы активных записей"""
+    message = "📋 ВСЕ АКТИВНЫЕ ЗАПИСИ:\n\n"
+    for app in appointments:
+        status_icon = "✅" if app.status is AppointmentStatus.CONFIRMED else "⏳"
+        payment_status = "💳 Оплачено" if app.paid else "❌ Ожидает оплаты"
+        client_name = shorten(app.client_name, CLIENT_NAME_MAX_LENGTH)
+        message += f"{status_icon} {format_appointment_date(app)} {app.time} - {client_name}\n"
+        message += f"📞 {shorten(app.client_phone, CLIENT_PHONE_PREVIEW_LENGTH)} | {payment_status}\n"
+        message += f"🆔 #{app.id}\n\n"
+    return message
+
+def shorten(text, limit):
+    """Текст не длиннее limit символов (с многоточием, если обрезан)"""
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+def preview_message_text(text):
+    """Текст сообщения, обрезанный для списка"""
+    return text if len(text) <= MESSAGE_PREVIEW_LENGTH else text[:MESSAGE_PREVIEW_LENGTH] + "…"
+
+def format_messages_page(messages):
+    """Текст страницы сообщений от клиентов"""
+    message = "💬 СООБЩЕНИЯ ОТ КЛИЕНТОВ:\n\n"
+    for msg in messages:
+        message += f"👤 {msg[2]} (ID: {msg[1]})\n"
+        message += f"💭 {preview_message_text(msg[3])}\n"
+        message += f"📅 {msg[5]} | 🧵 /thread_{msg[1]}\n\n"
+    return message
+
+def format_thread_page(messages):
+    """Текст страницы переписки с клиентом"""
+    message = f"🧵 ПЕРЕПИСКА С КЛИЕНТОМ {messages[0][1]}:\n\n"
+    for msg in messages:
+        author = f"👤 {msg[2]}" if msg[4] else f"💅 {ADMIN_NAME}"
+        message += f"{author} | 📅 {msg[5]}\n"
+        message += f"💭 {preview_message_text(msg[3])}\n\n"
+    return message
+
+async def load_listing_page(listing, cursor_id=None, backward=False):
+    """Страница списка для админа: (текст, клавиатура) или None, если список пуст"""
+    if listing == "apps":
+        rows, has_more = await db.get_active_appointments_page(
+            format_datetime_for_storage(datetime.now()), cursor_id, backward, limit=APPOINTMENTS_PAGE_SIZE
+        )
+        format_page = format_appointments_page
+    elif listing == "msgs":
+        rows, has_more = await db.get_messages_page(
+            cursor_id=cursor_id, backward=backward, limit=MESSAGES_PAGE_SIZE
+        )
+        format_page = format_messages_page
+    else:
+        # Переписка с клиентом: listing = "thread.<chat_id>"
+        rows, has_more = await db.get_messages_page(
+            int(listing.split(".")[1]), cursor_id, backward, limit=MESSAGES_PAGE_SIZE
+        )
+        format_page = format_thread_page
+    if not rows:
+        return None
+    if cursor_id is None:
+        has_prev, has_next = False, has_more
+    elif backward:
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = True, has_more
+    return format_page(rows), create_page_keyboard(listing, rows, has_prev, has_next)
+
 async def show_all_appointments(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать все записи"""
     if update.message.chat.id != ADMIN_ID:
         return
         
-    appointments = get_all_appointments()
+    page = await load_listing_page("apps")
     
-    if not appointments:
+    if not page:
         await update.message.reply_text("Нет активных записей.", reply_markup=create_admin_main_keyboard())
         return
         
-    message = "📋 ВСЕ АКТИВНЫЕ ЗАПИСИ:\n\n"
-    for app in appointments:
-        status_icon = "✅" if app[6] == "confirmed" else "⏳"
-        payment_status = "💳 Оплачено" if app[8] == "paid" else "❌ Ожидает оплаты"
-        message += f"{status_icon} {app[3]} {app[4]} - {app[1]}\n"
-        message += f"📞 {app[2]} | {payment_status}\n"
-        message += f"🆔 #{app[0]}\n\n"
-        
-    await update.message.reply_text(message)
+    text, keyboard = page
+    await update.message.reply_text(text, reply_markup=keyboard)
 
 async def show_client_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать сообщения от клиентов"""
     if update.message.chat.id != ADMIN_ID:
         return
         
-    messages = get_client_messages(limit=10)
+    page = await load_listing_page("msgs")
     
-    if not messages:
+    if not page:
         await update.message.reply_text("Нет сообщений от клиентов.", reply_markup=create_admin_main_keyboard())
         return
         
-    message = "💬 ПОСЛЕДНИЕ СООБЩЕНИЯ ОТ КЛИЕНТОВ:\n\n"
-    for msg in messages:
-        message += f"👤 {msg[2]} (ID: {msg[1]})\n"
-        message += f"💭 {msg[3]}\n"
-        message += f"📅 {msg[5]}\n\n"
+    text, keyboard = page
+    await update.message.reply_text(text, reply_markup=keyboard)
+
+STATUS_LABELS = {
+    AppointmentStatus.PENDING: "⏳ Ожидает оплаты",
+    AppointmentStatus.CONFIRMED: "✅ Подтверждена",
+    AppointmentStatus.CANCELLED: "❌ Отменена",
+    AppointmentStatus.EXPIRED: "⌛ Не оплачена вовремя",
+}
+
+async def start_phone_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Начало поиска клиента по телефону"""
+    if update.message.chat.id != ADMIN_ID:
+        return ConversationHandler.END
         
-    await update.message.reply_text(message[:4000])
-
-# ================== CALLBACK ОБРАБОТЧИКИ ==================
-async def handle_admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработка callback от админ-кнопок"""
-    query = update.callback_query
-    await query.answer()
-    data = query.data
+    await update.message.reply_text(
+        "🔍 ПОИСК ПО ТЕЛЕФОНУ\n\nВведите номер целиком, его начало или последние цифры (не меньше 3):",
+        reply_markup=ReplyKeyboardMarkup([[KeyboardButton("❌ Отмена")]], resize_keyboard=True)
+    )
+    return ADMIN_SEARCH_CLIENT
 
-    if data == "admin_back":
-        await query.edit_message_text(
-            "🔧 АДМИН-ПАНЕЛЬ\n\nВыберите действие:",
+async def handle_phone_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Поиск записей клиента по телефону"""
+    if update.message.text == "❌ Отмена":
+        await update.message.reply_text("Поиск отменен.", reply_markup=create_admin_main_keyboard())
+        return ConversationHandler.END
+        
+    query_text = update.message.text
+    if sum(ch.isdigit() for ch in query_text) < 3:
+        await update.message.reply_text("Введите хотя бы 3 цифры номера:")
+        return ADMIN_SEARCH_CLIENT
+        
+    appointments = await db.find_appointments_by_phone(query_text, limit=PHONE_SEARCH_LIMIT)
+    
+    if not appointments:
+        await update.message.reply_text(
+            f"🔍 По номеру «{query_text}» записей не найдено.",
             reply_markup=create_admin_main_keyboard()
         )
+        return ConversationHandler.END
+        
+    message = f"🔍 ЗАПИСИ ПО НОМЕРУ «{query_text}»:\n\n"
+    for app in appointments:
+        message += f"{format_appointment_date(app)} {app.time} - {app.client_name}\n"
+        message += f"📞 {app.client_phone} | {STATUS_LABELS[app.status]}\n"
+        message += f"🆔 #{app.id} | 🧵 /thread_{app.chat_id}\n\n"
+        
+    await update.message.reply_text(message[:4096], reply_markup=create_admin_main_keyboard())
+    return ConversationHandler.END
+
+async def show_client_thread(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /thread_<chat_id> - переписка с клиентом"""
+    if update.message.chat.id != ADMIN_ID:
         return
+        
+    client_chat_id = int(context.matches[0].group(1))
+    page = await load_listing_page(f"thread.{client_chat_id}")
+    
+    if not page:
+        await update.message.reply_text("Нет сообщений с этим клиентом.")
+        return
+        
+    text, keyboard = page
+    await update.message.reply_text(text, reply_markup=keyboard)
 
-    if data == "back_to_main":
-        await query.edit_message_text(
-            "Главное меню:",
-            reply_markup=create_main_keyboard()
-        )
+async def search_messages_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /search <текст> - поиск по сообщениям"""
+    if update.message.chat.id != ADMIN_ID:
         return
+        
+    query_text = " ".join(context.args)
+    if not query_text:
+        await update.message.reply_text("Использование: /search <текст>")
+        return
+        
+    results = await db.search_messages(query_text, limit=SEARCH_RESULTS_LIMIT)
+    
+    if not results:
+        await update.message.reply_text(f"🔎 По запросу «{query_text}» ничего не найдено.")
+        return
+        
+    message = f"🔎 РЕЗУЛЬТАТЫ ПОИСКА «{query_text}»:\n\n"
+    for msg in results:
+        author = f"👤 {msg[2]}" if msg[4] else f"💅 {ADMIN_NAME} → {msg[1]}"
+        message += f"{author} | 📅 {msg[5]}\n"
+        message += f"💭 {msg[6]}\n"
+        message += f"🧵 /thread_{msg[1]}\n\n"
+    await update.message.reply_text(message[:4096])
+
+def format_day_summary(date, summary):
+    """Строка сводки дня: записи, оплаты, выходные"""
+    booked, pending, paid, blocked, closed = summary or (0, 0, 0, 0, 0)
+    line = f"{format_date_for_display(date)}: 📋 {booked}"
+    if booked:
+        line += f" (⏳ {pending}, 💳 {paid})"
+    if closed:
+        line += " | 🚫 выходной"
+    elif blocked:
+        line += f" | 🚫 {blocked} сл."
+    return line
+
+async def render_week(start_date):
+    """Сводка за 7 дней с start_date: (текст, клавиатура с переходом к дням)"""
+    start = datetime.strptime(start_date, "%Y-%m-%d")
+    dates = [format_date_for_storage(start + timedelta(days=i)) for i in range(7)]
+    summaries = await db.get_day_summaries(dates)
+    
+    message = "🗓️ ЗАПИСИ ПО ДАТАМ:\n\n"
+    message += "\n".join(format_day_summary(date, summaries.get(date)) for date in dates)
+    
+    day_buttons = [
+        InlineKeyboardButton(format_date_for_display(date), callback_data=make_callback_data("d", date))
+        for date in dates
+    ]
+    keyboard = [day_buttons[:4], day_buttons[4:], [
+        InlineKeyboardButton("◀", callback_data=make_callback_data("w", format_date_for_storage(start - timedelta(days=7)))),
+        InlineKeyboardButton("▶", callback_data=make_callback_data("w", format_date_for_storage(start + timedelta(days=7)))),
+    ]]
+    return message, InlineKeyboardMarkup(keyboard)
+
+async def render_day(date):
+    """Записи на дату: (текст, клавиатура)"""
+    summaries, appointments = await asyncio.gather(
+        db.get_day_summaries([date]), db.get_day_appointments(date)
+    )
+    
+    message = f"📅 {format_day_summary(date, summaries.get(date))}\n\n"
+    if not appointments:
+        message += "Нет активных записей."
+    for app in appointments:
+        status_icon = "✅" if app.status is AppointmentStatus.CONFIRMED else "⏳"
+        message += f"{status_icon} {app.time} - {app.client_name}\n"
+        message += f"📞 {app.client_phone} | 🆔 #{app.id}\n\n"
+        
+    keyboard = [[InlineKeyboardButton("🗓️ К неделе", callback_data=make_callback_data("w", date))]]
+    return message[:4096], InlineKeyboardMarkup(keyboard)
 
-    if data.startswith("confirm_payment_"):
-        appointment_id = int(data.split("_")[-1])
-        appointment = confirm_payment(appointment_id)
+async def show_today_appointments(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Показать записи на сегодня"""
+    if update.message.chat.id != ADMIN_ID:
+        return
         
-        if appointment:
-            # Уведомление клиенту
-            try:
-                await context.bot.send_message(
-                    appointment[7],
-                    f"✅ ОПЛАТА ПОДТВЕРЖДЕНА!\n\n"
-                    f"Ваша запись подтверждена:\n"
-                    f"📅 Дата: {appointment[3]}\n"
-                    f"⏰ Время: {appointment[4]}\n\n"
-                    f"Ждем вас в салоне!",
-                    reply_markup=create_main_keyboard()
-                )
-            except Exception as e:
-                logger.error(f"Ошибка уведомления клиента: {e}")
-                
-            await query.edit_message_text(
-                f"✅ Оплата для записи #{appointment_id} подтверждена! Клиент уведомлен."
-            )
+    text, keyboard = await render_day(format_date_for_storage(datetime.now()))
+    await update.message.reply_text(text, reply_markup=keyboard)
+
+async def show_appointments_by_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Показать сводку записей на неделю вперед"""
+    if update.message.chat.id != ADMIN_ID:
+        return
+        
+    text, keyboard = await render_week(format_date_for_storage(datetime.now()))
+    await update.message.reply_text(text, reply_markup=keyboard)
+
+@callback_action("d", admin_only=True)
+async def show_day_callback(query, context, date):
+    """Записи на день из сводки недели (редактирует то же сообщение)"""
+    text, keyboard = await render_day(date)
+    await query.edit_message_text(text, reply_markup=keyboard)
+
+@callback_action("w", admin_only=True)
+async def show_week_callback(query, context, date):
+    """Переход между неделями расписания (редактирует то же сообщение)"""
+    text, keyboard = await render_week(date)
+    await query.edit_message_text(text, reply_markup=keyboard)
+
+# ================== СТАТИСТИКА ==================
+def format_stats_bar(value, maximum, width=10):
+    """Полоска из блоков длиной пропорционально value"""
+    return "▇" * round(width * value / maximum) if maximum else ""
+
+def format_stats(stats):
+    """Текст сводки по счетчикам аналитики"""
+    total = stats.total
+    message = (
+        f"📊 СТАТИСТИКА\n\n"
+        f"Всего записей: {total.booked}\n"
+        f"💳 Оплачено: {total.paid} ({analytics.rate(total.paid, total):.0%})\n"
+        f"⌛ Не оплачено вовремя: {total.expired} ({analytics.rate(total.expired, total):.0%})\n"
+        f"❌ Отменено: {total.cancelled} ({analytics.rate(total.cancelled, total):.0%})\n"
+        f"⏳ Запись в среднем за {analytics.lead_days(total):.1f} дн. до визита\n\n"
+        f"За {STATS_DAYS} дней: записей {stats.recent.booked}, "
+        f"загрузка {stats.occupancy(STATS_DAYS, len(TIME_SLOTS)):.0%}\n"
+    )
+    
+    weekdays = [(weekday, analytics.active(stats.weekdays.get((weekday + 1) % 7, analytics.EMPTY)))
+                for weekday in range(7)]
+    busiest = max(count for _, count in weekdays)
+    message += "\nПо дням недели (активные записи):\n"
+    for weekday, count in weekdays:
+        message += f"{RUSSIAN_WEEKDAYS[weekday]} {count:>4} {format_stats_bar(count, busiest)}\n"
+        
+    hours = [(time_slot, analytics.active(stats.hours.get(time_slot, analytics.EMPTY))) for time_slot in TIME_SLOTS]
+    busiest = max(count for _, count in hours)
+    message += "\nПо времени:\n"
+    for time_slot, count in hours:
+        message += f"{time_slot} {count:>4} {format_stats_bar(count, busiest)}\n"
+    return message
+
+async def show_statistics(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Показать статистику записей"""
+    if update.message.chat.id != ADMIN_ID:
         return
+        
+    today = datetime.now()
+    rows = await db.get_stats(
+        format_date_for_storage(today - timedelta(days=STATS_DAYS)), format_date_for_storage(today)
+    )
+    await update.message.reply_text(format_stats(analytics.Stats(rows)))
 
-    if data.startswith("admin_cancel_"):
-        appointment_id = int(data.split("_")[-1])
-        appointment = cancel_appointment(appointment_id)
+@callback_action("p", admin_only=True)
+async def handle_page_callback(query, context, arg):
+    """Листание списков админа (редактирует то же сообщение)"""
+    listing, direction, cursor_id = arg.split(":")
+    page = await load_listing_page(listing, int(cursor_id), backward=direction == "<")
+    
+    if not page:
+        await query.edit_message_text("Список пуст.")
+        return None
         
-        if appointment:
-            # Уведомление клиенту
-            try:
-                await context.bot.send_message(
-                    appointment[7],
-                    f"⚠️ ВАЖНОЕ УВЕДОМЛЕНИЕ\n\n"
-                    f"Мастер отменил вашу запись:\n"
-                    f"📅 Дата: {appointment[3]}\n"
-                    f"⏰ Время: {appointment[4]}\n\n"
-                    f"Для уточнения деталей напишите мастеру.",
-                    reply_markup=create_main_keyboard()
-                )
-            except Exception as e:
-                logger.error(f"Ошибка уведомления клиента: {e}")
-                
-            await query.edit_message_text(
-                f"✅ Запись #{appointment_id} отменена! Клиент уведомлен."
+    text, keyboard = page
+    await query.edit_message_text(text, reply_markup=keyboard)
+    return None
+
+# ================== РАССЫЛКА ==================
+def format_broadcast_progress(broadcast):
+    """Текст прогресса рассылки для админа"""
+    processed = broadcast["sent"] + broadcast["failed"] + broadcast["blocked"]
+    title = "✅ РАССЫЛКА ЗАВЕРШЕНА" if broadcast["status"] == "done" else "📢 ИДЕТ РАССЫЛКА"
+    return (
+        f"{title}\n\n"
+        f"Обработано: {processed} из {broadcast['total']}\n"
+        f"✅ Доставлено: {broadcast['sent']}\n"
+        f"❌ Ошибок: {broadcast['failed']}\n"
+        f"🚫 Заблокировали бота: {broadcast['blocked']}"
+    )
+
+async def run_broadcast(bot, broadcast_id):
+    """Фоновая отправка рассылки с обновлением прогресса у админа"""
+    async def show_progress(broadcast):
+        if not broadcast["progress_message_id"]:
+            return
+        try:
+            await bot.edit_message_text(
+                format_broadcast_progress(broadcast),
+                chat_id=broadcast["admin_chat_id"],
+                message_id=broadcast["progress_message_id"],
             )
-        return
+        except Exception as e:
+            logger.warning(f"Не удалось обновить прогресс рассылки: {e}")
+
+    try:
+        await broadcast_engine.run(bot, broadcast_id, on_progress=show_progress)
+    except Exception as e:
+        logger.error(f"❌ Ошибка рассылки #{broadcast_id}: {e}")
+
+async def resume_broadcasts(application):
+    """Продолжение рассылок, прерванных перезапуском"""
+    try:
+        for broadcast_id in await db.get_running_broadcasts():
+            logger.info(f"📢 Продолжение рассылки #{broadcast_id}")
+            application.create_task(run_broadcast(application.bot, broadcast_id))
+    except Exception as e:
+        logger.error(f"Ошибка восстановления рассылок: {e}")
+
+async def start_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Начало рассылки"""
+    if update.message.chat.id != ADMIN_ID:
+        return ConversationHandler.END
+        
+    await update.message.reply_text(
+        "📢 РАССЫЛКА\n\nНапишите сообщение, которое получат все пользователи бота:",
+        reply_markup=ReplyKeyboardMarkup([[KeyboardButton("❌ Отмена")]], resize_keyboard=True)
+    )
+    return BROADCAST_MESSAGE
+
+async def handle_broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Запуск рассылки"""
+    if update.message.text == "❌ Отмена":
+        await update.message.reply_text("Рассылка отменена.", reply_markup=create_admin_main_keyboard())
+        return ConversationHandler.END
+        
+    broadcast_id = await db.create_broadcast(update.message.text, update.message.chat.id)
+    broadcast = await db.get_broadcast(broadcast_id)
+    progress_message = await update.message.reply_text(
+        format_broadcast_progress(broadcast),
+        reply_markup=create_admin_main_keyboard()
+    )
+    await db.set_broadcast_progress_message(broadcast_id, progress_message.message_id)
+    
+    # Рассылка идет в фоне и не блокирует обработку других сообщений
+    context.application.create_task(run_broadcast(context.bot, broadcast_id))
+    return ConversationHandler.END
+
+# ================== CALLBACK ОБРАБОТЧИКИ ==================
+async def route_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Все inline-кнопки: действие выбирается по коду из callback_data"""
+    query = update.callback_query
+    code, arg = parse_callback_data(query.data or "")
+    action = CALLBACK_ACTIONS.get(code)
+    text = None
+    try:
+        if action is None or (action.admin_only and query.from_user.id != ADMIN_ID):
+            # Устаревшая, чужая или неизвестная кнопка
+            return
+        text = await action.handler(query, context, arg)
+    except (ValueError, IndexError) as e:
+        logger.warning(f"⚠️ Испорченная кнопка {query.data!r}: {e}")
+    except BadRequest as e:
+        # Повторное нажатие ◀/▶ или дня: сообщение уже такое же
+        if "not modified" not in str(e).lower():
+            raise
+    finally:
+        # Без ответа у пользователя крутится индикатор загрузки
+        await query.answer(text)
+
+@callback_action("m")
+async def back_to_main_callback(query, context, arg):
+    """Возврат в главное меню из списка записей клиента"""
+    await query.edit_message_text("Главное меню:")
+    return None
+
+@callback_action("c", admin_only=True)
+async def confirm_payment_callback(query, context, arg):
+    """Подтверждение оплаты; повторное нажатие ничего не отправляет"""
+    appointment_id = int(arg)
+    appointment = await db.confirm_payment(appointment_id)
+    if not appointment:
+        return f"Запись #{appointment_id} уже не ожидает оплаты."
+        
+    cancel_payment_expiry(context.job_queue, appointment_id)
+    schedule_reminder(context.job_queue, appointment)
+    
+    # Уведомление клиенту
+    outbox.send_message(
+        appointment.chat_id,
+        f"✅ ОПЛАТА ПОДТВЕРЖДЕНА!\n\n"
+        f"Ваша запись подтверждена:\n"
+        f"📅 Дата: {format_appointment_date(appointment)}\n"
+        f"⏰ Время: {appointment.time}\n\n"
+        f"Ждем вас в салоне!",
+        reply_markup=create_main_keyboard()
+    )
+        
+    await query.edit_message_text(
+        f"✅ Оплата для записи #{appointment_id} подтверждена! Клиент уведомлен."
+    )
+    return None
+
+@callback_action("x", admin_only=True)
+async def admin_cancel_callback(query, context, arg):
+    """Отмена записи мастером; повторное нажатие ничего не отправляет"""
+    appointment_id = int(arg)
+    appointment = await db.cancel_appointment(appointment_id)
+    if not appointment:
+        return f"Запись #{appointment_id} уже отменена или просрочена."
+        
+    cancel_payment_expiry(context.job_queue, appointment_id)
+    cancel_reminder(context.job_queue, appointment_id)
+    
+    # Уведомление клиенту
+    outbox.send_message(
+        appointment.chat_id,
+        f"⚠️ ВАЖНОЕ УВЕДОМЛЕНИЕ\n\n"
+        f"Мастер отменил вашу запись:\n"
+        f"📅 Дата: {format_appointment_date(appointment)}\n"
+        f"⏰ Время: {appointment.time}\n\n"
+        f"Для уточнения деталей напишите мастеру.",
+        reply_markup=create_main_keyboard()
+    )
+        
+    await query.edit_message_text(
+        f"✅ Запись #{appointment_id} отменена! Клиент уведомлен."
+    )
+    return None
 
 # ================== ФОНОВЫЕ ЗАДАЧИ ==================
+def get_payment_deadline(appointment):
+    """Срок оплаты записи (created_at - в UTC)"""
+    return appointment.created_at + timedelta(seconds=PAYMENT_TIMEOUT_SECONDS)
+
+def schedule_payment_expiry(job_queue, appointment_id, delay):
+    """Таймер просрочки оплаты записи через delay секунд"""
+    if not job_queue:
+        return
+    job_queue.run_once(
+        expire_payment,
+        when=max(delay, 0),
+        data=appointment_id,
+        name=f"payment_expiry_{appointment_id}",
+    )
+
+def cancel_payment_expiry(job_queue, appointment_id):
+    """Снятие таймера просрочки (запись оплачена или отменена)"""
+    if not job_queue:
+        return
+    for job in job_queue.get_jobs_by_name(f"payment_expiry_{appointment_id}"):
+        job.schedule_removal()
+
+def notify_payment_expired(appointment):
+    """Уведомление клиента о просрочке оплаты"""
+    outbox.send_message(
+        appointment.chat_id,
+        f"⏰ ВРЕМЯ ОПЛАТЫ ИСТЕКЛО\n\n"
+        f"К сожалению, время на оплату записи истекло:\n"
+        f"📅 Дата: {format_appointment_date(appointment)}\n"
+        f"⏰ Время: {appointment.time}\n\n"
+        f"Вы можете создать новую запись.",
+        reply_markup=create_main_keyboard()
+    )
+
+@timed(JOB_SECONDS, JOB_ERRORS, job="expire_payment")
+async def expire_payment(context: ContextTypes.DEFAULT_TYPE):
+    """Просрочка оплаты одной записи по таймеру"""
+    try:
+        appointment = await db.expire_appointment(context.job.data)
+        if appointment:
+            notify_payment_expired(appointment)
+    except Exception as e:
+        logger.error(f"Ошибка просрочки оплаты: {e}")
+
+@timed(JOB_SECONDS, JOB_ERRORS, job="check_expired_payments")
 async def check_expired_payments(context: ContextTypes.DEFAULT_TYPE):
-    """Проверка просроченных оплат"""
+    """Догоняющая проверка просроченных оплат (при запуске и для страховки)"""
     try:
-        pending_appointments = get_pending_appointments()
-        now = datetime.now()
-        
-        for appointment in pending_appointments:
-            created_at = datetime.strptime(appointment[5], "%Y-%m-%d %H:%M:%S")
-            if (now - created_at).total_seconds() > 600:  # 10 minutes
-                expired_appointment = expire_appointment(appointment[0])
-                
-                # Уведомление клиенту
-                try:
-                    await context.bot.send_message(
-                        appointment[7],
-                        f"⏰ ВРЕМЯ ОПЛАТЫ ИСТЕКЛО\n\n"
-                        f"К сожалению, время на оплату записи истекло:\n"
-                        f"📅 Дата: {appointment[3]}\n"
-                        f"⏰ Время: {appointment[4]}\n\n"
-                        f"Вы можете создать новую запись.",
-                        reply_markup=create_main_keyboard()
-                    )
-                except Exception as e:
-                    logger.error(f"Ошибка уведомления клиента: {e}")
-                    
+        expired = await db.expire_overdue_payments(PAYMENT_TIMEOUT_SECONDS)
+        for appointment in expired:
+            notify_payment_expired(appointment)
+        if expired:
+            logger.info(f"⏰ Просрочено записей: {len(expired)}")
     except Exception as e:
         logger.error(f"Ошибка проверки просроченных оплат: {e}")
 
+async def restore_payment_timers(application):
+    """Восстановление таймеров оплаты после перезапуска"""
+    try:
+        now = datetime.now(timezone.utc)
+        for appointment in await db.get_pending_appointments():
+            delay = (get_payment_deadline(appointment) - now).total_seconds()
+            schedule_payment_expiry(application.job_queue, appointment.id, delay)
+    except Exception as e:
+        logger.error(f"Ошибка восстановления таймеров оплаты: {e}")
+
+def schedule_reminder(job_queue, appointment):
+    """Таймер напоминания за REMINDER_OFFSET_HOURS до записи"""
+    if not job_queue:
+        return
+    starts_at = appointment.starts
+    now = datetime.now()
+    if not starts_at or starts_at <= now:
+        return
+    remind_at = starts_at - timedelta(hours=REMINDER_OFFSET_HOURS)
+    job_queue.run_once(
+        send_reminder,
+        when=max((remind_at - now).total_seconds(), 0),
+        data=appointment.id,
+        name=f"reminder_{appointment.id}",
+    )
+
+def cancel_reminder(job_queue, appointment_id):
+    """Снятие таймера напоминания (запись отменена)"""
+    if not job_queue:
+        return
+    for job in job_queue.get_jobs_by_name(f"reminder_{appointment_id}"):
+        job.schedule_removal()
+
+async def deliver_reminders(appointments):
+    """Отправка напоминаний через очередь отправки.
+
+    Каждое напоминание сначала отмечается в журнале, поэтому повторный
+    запуск (таймер, догоняющая проверка, перезапуск бота) его не продублирует.
+    Повторы при ошибках и учет недоставленных берет на себя очередь.
+    """
+    appointments = [appointment for appointment in appointments if appointment.chat_id]
+    if not appointments:
+        return 0
+    claimed = await db.claim_reminders([appointment.id for appointment in appointments], REMINDER_KIND)
+    results = await asyncio.gather(*(
+        outbox.send_message(
+            appointment.chat_id,
+            f"🔔 НАПОМИНАНИЕ О ЗАПИСИ\n\n"
+            f"Напоминаем, что у вас запись на маникюр:\n"
+            f"📅 Дата: {format_appointment_date(appointment)}\n"
+            f"⏰ Время: {appointment.time}\n\n"
+            f"Ждем вас в салоне!"
+        )
+        for appointment in appointments if appointment.id in claimed
+    ))
+    return sum(1 for message in results if message is not None)
+
+@timed(JOB_SECONDS, JOB_ERRORS, job="send_reminder")
+async def send_reminder(context: ContextTypes.DEFAULT_TYPE):
+    """Напоминание по одной записи по таймеру"""
+    try:
+        appointment = await db.get_appointment_by_id(context.job.data)
+        if appointment and appointment.status is AppointmentStatus.CONFIRMED:
+            await deliver_reminders([appointment])
+    except Exception as e:
+        logger.error(f"Ошибка отправки напоминания: {e}")
+
+@timed(JOB_SECONDS, JOB_ERRORS, job="send_reminders")
 async def send_reminders(context: ContextTypes.DEFAULT_TYPE):
-    """Отправка напоминаний"""
+    """Догоняющая отправка напоминаний, которые должны были уйти по таймерам"""
     try:
-        tomorrow_dt = datetime.now() + timedelta(days=1)
-        tomorrow = format_date_for_storage(tomorrow_dt)
-        
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT * FROM appointments WHERE appointment_date = ? AND status = 'confirmed'",
-            (tomorrow,)
+        now = datetime.now()
+        appointments = await db.get_due_reminders(
+            REMINDER_KIND,
+            format_datetime_for_storage(now),
+            format_datetime_for_storage(now + timedelta(hours=REMINDER_OFFSET_HOURS)),
         )
-        appointments = cursor.fetchall()
-        conn.close()
-        
-        for appointment in appointments:
-            if appointment[7]:
-                await context.bot.send_message(
-                    appointment[7],
-                    f"🔔 НАПОМИНАНИЕ О ЗАПИСИ\n\n"
-                    f"Напоминаем, что завтра у вас запись на маникюр:\n"
-                    f"📅 Дата: {appointment[3]}\n"
-                    f"⏰ Время: {appointment[4]}\n\n"
-                    f"Ждем вас в салоне!"
-                )
-                
+        sent = await deliver_reminders(appointments)
+        if sent:
+            logger.info(f"🔔 Отправлено напоминаний: {sent}")
     except Exception as e:
         logger.error(f"Ошибка отправки напоминаний: {e}")
 
+async def restore_reminder_timers(application):
+    """Восстановление таймеров напоминаний после перезапуска"""
+    try:
+        appointments = await db.get_confirmed_appointments(since=format_datetime_for_storage(datetime.now()))
+        for appointment in appointments:
+            schedule_reminder(application.job_queue, appointment)
+    except Exception as e:
+        logger.error(f"Ошибка восстановления таймеров напоминаний: {e}")
+
+async def report_double_bookings():
+    """Сообщение мастеру о слотах, занятых несколькими записями (остались с версий до миграции 4)"""
+    try:
+        appointments = await db.get_double_bookings()
+    except Exception as e:
+        logger.error(f"Ошибка проверки дублей записей: {e}")
+        return
+    if not appointments:
+        return
+        
+    lines = [
+        f"#{app.id} {format_appointment_date(app)} {app.time} - {app.client_name}, {app.client_phone} "
+        f"({STATUS_LABELS[app.status]}{', оплачена' if app.paid else ''})"
+        for app in appointments
+    ]
+    outbox.send_message(
+        ADMIN_ID,
+        "⚠️ НА ОДНО ВРЕМЯ НЕСКОЛЬКО ЗАПИСЕЙ\n\n"
+        + "\n".join(lines)
+        + "\n\nОтмените лишние записи - клиент получит уведомление.",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton(f"❌ Отменить #{app.id}", callback_data=make_callback_data("x", app.id))]
+            for app in appointments
+        ])
+    )
+
 # ================== CONVERSATION HANDLERS ==================
 def setup_conversation_handlers(application):
     """Настройка обработчиков разговоров"""
@@ -943,6 +1496,8 @@ def setup_conversation_handlers(application):
             ENTER_PHONE: [MessageHandler(filters.TEXT | filters.CONTACT, enter_phone)],
         },
         fallbacks=[MessageHandler(filters.Regex("^❌ Отмена$"), start_command)],
+        name="booking",
+        persistent=True,
     )
 
     # Сообщения клиента мастеру
@@ -952,69 +1507,278 @@ def setup_conversation_handlers(application):
             CLIENT_TO_ADMIN_MESSAGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_client_to_admin_message)]
         },
         fallbacks=[MessageHandler(filters.Regex("^❌ Отмена$"), start_command)],
+        name="client_to_admin",
+        persistent=True,
     )
 
     # Ответы мастера клиенту
     admin_to_client_handler = ConversationHandler(
-        entry_points=[CallbackQueryHandler(start_admin_to_client_message, pattern="^admin_reply_")],
+        # Ответ - шаг разговора, поэтому кнопка "r" ловится здесь, а не в CALLBACK_ACTIONS
+        entry_points=[CallbackQueryHandler(start_admin_to_client_message, pattern=callback_pattern("r"))],
         states={
             ADMIN_TO_CLIENT_MESSAGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_admin_to_client_message)]
         },
         fallbacks=[MessageHandler(filters.Regex("^❌ Отмена$"), admin_command)],
+        name="admin_to_client",
+        persistent=True,
+    )
+
+    # Поиск клиента по телефону
+    phone_search_handler = ConversationHandler(
+        entry_points=[MessageHandler(filters.Regex("^🔍 Поиск по телефону$"), start_phone_search)],
+        states={
+            ADMIN_SEARCH_CLIENT: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_phone_search)]
+        },
+        fallbacks=[MessageHandler(filters.Regex("^❌ Отмена$"), admin_command)],
+        name="phone_search",
+        persistent=True,
+    )
+
+    # Рассылка
+    broadcast_handler = ConversationHandler(
+        entry_points=[MessageHandler(filters.Regex("^📢 Сделать рассылку$"), start_broadcast)],
+        states={
+            BROADCAST_MESSAGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_broadcast_message)]
+        },
+        fallbacks=[MessageHandler(filters.Regex("^❌ Отмена$"), admin_command)],
+        name="broadcast",
+        persistent=True,
     )
 
     application.add_handler(booking_handler)
     application.add_handler(client_to_admin_handler)
     application.add_handler(admin_to_client_handler)
+    application.add_handler(phone_search_handler)
+    application.add_handler(broadcast_handler)
+
+# ================== ЗАЩИТА ОТ ФЛУДА ==================
+def match_handler(application, update):
+    """Обработчик, который получит апдейт (с учетом состояния разговора), или None"""
+    for group in sorted(application.handlers):
+        if group < 0:
+            continue
+        for handler in application.handlers[group]:
+            check = handler.check_update(update)
+            if check is None or check is False:
+                continue
+            if isinstance(handler, ConversationHandler):
+                # (состояние, ключ разговора, обработчик шага, результат проверки)
+                return check[2]
+            return handler
+    return None
+
+def throttle_name(handler, update):
+    """Имя обработчика для цены и метрик; для кнопок - имя действия"""
+    callback = handler.callback
+    # Сравнение по имени: instrument_handlers подменяет callback оберткой
+    if callback.__name__ == route_callback.__name__:
+        code, _ = parse_callback_data(update.callback_query.data or "")
+        action = CALLBACK_ACTIONS.get(code)
+        if action is not None:
+            callback = action.handler
+    return callback.__name__
+
+async def flood_guard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Ограничение частоты запросов из чата до вызова обработчиков"""
+    chat = update.effective_chat
+    if chat is None or chat.id == ADMIN_ID:
+        return
+    handler = match_handler(context.application, update)
+    if handler is None:
+        return
+        
+    name = throttle_name(handler, update)
+    # Одинаковые нажатия склеиваются, в каком бы шаге разговора ни был чат
+    query = update.callback_query
+    if query:
+        key = query.data
+    elif update.message and update.message.text:
+        key = update.message.text
+    else:
+        key = None
+    verdict = chat_throttle.check(chat.id, key, FLOOD_COSTS.get(name, FLOOD_DEFAULT_COST))
+    if verdict == ALLOW:
+        return
+        
+    THROTTLED.inc(handler=name, reason=verdict)
+    text = None
+    if verdict == LIMITED:
+        logger.warning(f"🚦 Чат {chat.id} превысил лимит запросов ({name}), пауза {FLOOD_COOLDOWN_SECONDS} с")
+        text = f"⏳ Слишком много запросов. Подождите {FLOOD_COOLDOWN_SECONDS} секунд и попробуйте снова."
+    if query:
+        await query.answer(text)
+    elif text:
+        await update.effective_message.reply_text(text)
+    raise ApplicationHandlerStop
+
+def format_throttle_stats(stats):
+    """Счетчики защиты от флуда для /queues"""
+    text = (
+        f"🚦 Защита от флуда (чатов: {stats['chats']}, на паузе: {stats['cooling']})\n"
+        f"Пропущено: {stats['allowed']}, повторов склеено: {stats['coalesced']}\n"
+        f"Отказов: {stats['limited']}, отброшено на паузе: {stats['cooldown']}"
+    )
+    if stats["top"]:
+        text += "\nЧаще всего: " + ", ".join(f"{chat_id} ({count})" for chat_id, count in stats["top"])
+    return text
 
 # ================== ОСНОВНАЯ ФУНКЦИЯ ==================
+async def post_init(application):
+    """Подготовка после инициализации приложения"""
+    outbox.start(application.bot)
+    await restore_payment_timers(application)
+    await restore_reminder_timers(application)
+    await resume_broadcasts(application)
+    await report_double_bookings()
+    if not APP_NAME:
+        await http_server.start("127.0.0.1", METRICS_PORT)
+
+async def post_stop(application):
+    """Досылка очереди уведомлений, пока HTTP-клиент бота еще открыт"""
+    await outbox.stop()
+
+async def post_shutdown(application):
+    """Освобождение ресурсов при остановке бота"""
+    await http_server.stop()
+    await db.write_behind.flush()
+    db.close()
+
+def webhook_handler(application):
+    """Обработчик POST вебхука: апдейт кладется в очередь приложения.
+
+    Очередь создается вместе с приложением, поэтому апдейты можно
+    принимать еще до initialize(); обработаются они после start().
+    """
+    async def receive_update(body, headers):
+        await application.update_queue.put(Update.de_json(json.loads(body), application.bot))
+        return HTTPStatus.OK, "text/plain", b""
+    return receive_update
+
+async def ensure_webhook(bot):
+    """Регистрация вебхука, только если Telegram знает другой адрес.
+
+    При совпадении адреса накопившиеся апдейты (в том числе тот, что
+    разбудил инстанс) не сбрасываются.
+    """
+    url = f"https://{APP_NAME}/{BOT_TOKEN}"
+    info = await bot.get_webhook_info()
+    if info.url != url:
+        await bot.set_webhook(url, drop_pending_updates=True)
+        logger.info("🔗 Вебхук зарегистрирован")
+
+async def warm_up(application):
+    """Работа после запуска, которая не должна задерживать первые апдейты"""
+    try:
+        await ensure_webhook(application.bot)
+    except Exception as e:
+        logger.error(f"❌ Ошибка регистрации вебхука: {e}")
+    try:
+        # Кэш доступности на все окно записи - одним запросом
+        await get_availability(get_booking_dates())
+    except Exception as e:
+        logger.error(f"Ошибка прогрева кэша доступности: {e}")
+
+async def run_webhook(application, server=http_server):
+    """Запуск через webhook: вебхук Telegram и /metrics на одном порту PORT.
+
+    server может быть уже запущен (serve.py открывает порт до импорта
+    бота); тогда на него добавляются маршруты бота.
+    """
+    if server is not http_server:
+        server.routes.update(http_server.routes)
+    server.route("POST", f"/{BOT_TOKEN}", webhook_handler(application))
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    warm_up_task = None
+    try:
+        if not server.serving:
+            await server.start("0.0.0.0", PORT)
+        await application.initialize()
+        await application.post_init(application)
+        await application.start()
+        warm_up_task = asyncio.create_task(warm_up(application))
+        await stop.wait()
+    finally:
+        if warm_up_task:
+            warm_up_task.cancel()
+        await server.stop()
+        if application.running:
+            await application.stop()
+        # run_polling делает то же: post_stop до shutdown(), закрывающего HTTP-клиент
+        await application.post_stop(application)
+        await application.shutdown()
+        await application.post_shutdown(application)
+
+def build_application():
+    """Создание приложения со всеми обработчиками и фоновыми задачами"""
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .base_url(TELEGRAM_API_URL)
+        .rate_limiter(rate_limiter)
+        .persistence(persistence)
+        .concurrent_updates(update_processor)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+    
+    # Базовые команды
+    application.add_handler(CommandHandler("start", start_command))
+    application.add_handler(CommandHandler("admin", admin_command))
+    application.add_handler(CommandHandler("cache", cache_stats_command))
+    application.add_handler(CommandHandler("queues", queues_command))
+    application.add_handler(CommandHandler("export", export_command))
+    application.add_handler(CommandHandler("search", search_messages_command))
+    application.add_handler(MessageHandler(filters.Regex(r"^/thread_(\d+)(@\w+)?$"), show_client_thread))
+    
+    # Настройка обработчиков разговоров
+    setup_conversation_handlers(application)
+    
+    # Обработчики кнопок
+    application.add_handler(MessageHandler(filters.Regex("^📋 Мои записи$"), show_my_appointments))
+    application.add_handler(MessageHandler(filters.Regex("^📋 Все записи$"), show_all_appointments))
+    application.add_handler(MessageHandler(filters.Regex("^📅 Записи на сегодня$"), show_today_appointments))
+    application.add_handler(MessageHandler(filters.Regex("^🗓️ Записи по дате$"), show_appointments_by_date))
+    application.add_handler(MessageHandler(filters.Regex("^✉️ Сообщения от клиентов$"), show_client_messages))
+    application.add_handler(MessageHandler(filters.Regex("^📊 Статистика$"), show_statistics))
+    
+    # Callback обработчики
+    application.add_handler(CallbackQueryHandler(route_callback))
+    
+    # Настройка фоновых задач
+    job_queue = application.job_queue
+    if job_queue:
+        # Просрочка оплат идет по таймерам записей; здесь только догоняющая проверка
+        job_queue.run_repeating(check_expired_payments, interval=1800, first=0)  # При запуске и каждые 30 минут
+        job_queue.run_repeating(send_reminders, interval=3600, first=60)  # Страховка для таймеров, каждый час
+    
+    # Замер всех обработчиков (bot_handler_seconds)
+    instrument_handlers(application, STATE_NAMES)
+    
+    # Защита от флуда - после замера: ее ApplicationHandlerStop не ошибка обработчика
+    application.add_handler(TypeHandler(Update, flood_guard), group=-1)
+    return application
+
 def main():
     """Основная функция запуска бота"""
     logger.info("🚀 Запуск бота маникюрного салона...")
     
     # Инициализация базы данных
-    init_database()
+    db.init_database()
     
     try:
-        # Создание приложения
-        application = Application.builder().token(BOT_TOKEN).build()
-        
-        # Базовые команды
-        application.add_handler(CommandHandler("start", start_command))
-        application.add_handler(CommandHandler("admin", admin_command))
-        
-        # Настройка обработчиков разговоров
-        setup_conversation_handlers(application)
-        
-        # Обработчики кнопок
-        application.add_handler(MessageHandler(filters.Regex("^📋 Мои записи$"), show_my_appointments))
-        application.add_handler(MessageHandler(filters.Regex("^📋 Все записи$"), show_all_appointments))
-        application.add_handler(MessageHandler(filters.Regex("^✉️ Сообщения от клиентов$"), show_client_messages))
-        
-        # Callback обработчики
-        application.add_handler(CallbackQueryHandler(client_cancel_appointment, pattern="^client_cancel_"))
-        application.add_handler(CallbackQueryHandler(handle_admin_callback))
-        
-        # Настройка фоновых задач
-        job_queue = application.job_queue
-        if job_queue:
-            job_queue.run_repeating(check_expired_payments, interval=300, first=10)  # Каждые 5 минут
-            job_queue.run_repeating(send_reminders, interval=3600, first=60)  # Каждый час
+        application = build_application()
         
         # Определение способа запуска
-        PORT = int(os.environ.get("PORT", 10000))
-        APP_NAME = os.environ.get("RENDER_EXTERNAL_HOSTNAME")
-        
         if APP_NAME:
-            # Запуск на Render через webhook
+            # Запуск на Render через webhook; свой сервер, чтобы отдавать /metrics на том же порту
             logger.info(f"🌐 Запуск через Webhook на {APP_NAME}:{PORT}")
-            application.run_webhook(
-                listen="0.0.0.0",
-                port=PORT,
-                url_path=BOT_TOKEN,
-                webhook_url=f"https://{APP_NAME}/{BOT_TOKEN}",
-                drop_pending_updates=True
-            )
+            asyncio.run(run_webhook(application))
         else:
             # Локальный запуск через polling
             logger.info("🔍 Локальный запуск через Polling")
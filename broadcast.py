@@ -0,0 +1,107 @@
+# broadcast.py
+import time
+import asyncio
+import logging
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+from outbox import PRIORITY_BULK
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Результаты отправки одному получателю
+SENT, FAILED, BLOCKED = "sent", "failed", "blocked"
+
+
+class BroadcastEngine:
+    """Рассылка по всем пользователям бота.
+
+    Получатели читаются из bot_users порциями по ключу chat_id, без
+    загрузки всей таблицы. После каждой порции прогресс сохраняется
+    в таблицу broadcasts, поэтому после перезапуска рассылка
+    продолжается с места остановки.
+    """
+
+    def __init__(self, db, rate=25, concurrency=8, batch_size=100, max_attempts=3):
+        self.db = db
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self._running = set()
+
+    def is_running(self, broadcast_id):
+        """Идет ли рассылка в этом процессе"""
+        return broadcast_id in self._running
+
+    async def _send(self, bot, chat_id, text, semaphore):
+        async with semaphore:
+            for attempt in range(1, self.max_attempts + 1):
+                await self.bucket.acquire()
+                try:
+                    await bot.send_message(chat_id, text, rate_limit_args=PRIORITY_BULK)
+                    return SENT
+                except RetryAfter as e:
+                    # Telegram просит подождать - притормаживаем всю рассылку
+                    logger.warning(f"⏳ Рассылка: лимит Telegram, пауза {e.retry_after} с")
+                    self.bucket.pause(e.retry_after)
+                except Forbidden:
+                    return BLOCKED
+                except BadRequest as e:
+                    logger.error(f"Рассылка: не удалось отправить в чат {chat_id}: {e}")
+                    return FAILED
+                except NetworkError as e:
+                    if attempt == self.max_attempts:
+                        logger.error(f"Рассылка: ошибка сети для чата {chat_id}: {e}")
+                        return FAILED
+                    await asyncio.sleep(2 ** attempt)
+                except Exception as e:
+                    logger.error(f"Рассылка: ошибка отправки в чат {chat_id}: {e}")
+                    return FAILED
+            return FAILED
+
+    async def run(self, bot, broadcast_id, on_progress=None, progress_interval=3.0):
+        """Отправка рассылки с сохраненной позиции до конца.
+
+        on_progress(broadcast) вызывается не чаще раза в progress_interval
+        секунд и один раз в конце.
+        """
+        if broadcast_id in self._running:
+            return None
+        self._running.add(broadcast_id)
+        try:
+            broadcast = await self.db.get_broadcast(broadcast_id)
+            if not broadcast or broadcast["status"] != "running":
+                return broadcast
+            semaphore = asyncio.Semaphore(self.concurrency)
+            last_progress = time.monotonic()
+
+            while True:
+                chat_ids = await self.db.get_broadcast_recipients(broadcast["last_chat_id"], self.batch_size)
+                if not chat_ids:
+                    break
+                results = await asyncio.gather(
+                    *(self._send(bot, chat_id, broadcast["message_text"], semaphore) for chat_id in chat_ids)
+                )
+                broadcast["last_chat_id"] = chat_ids[-1]
+                broadcast["sent"] += results.count(SENT)
+                broadcast["failed"] += results.count(FAILED)
+                broadcast["blocked"] += results.count(BLOCKED)
+                await self.db.save_broadcast_progress(broadcast)
+
+                if on_progress and time.monotonic() - last_progress >= progress_interval:
+                    last_progress = time.monotonic()
+                    await on_progress(broadcast)
+
+            broadcast["status"] = "done"
+            await self.db.finish_broadcast(broadcast_id)
+            logger.info(
+                f"📢 Рассылка #{broadcast_id} завершена: доставлено {broadcast['sent']}, "
+                f"ошибок {broadcast['failed']}, заблокировали бота {broadcast['blocked']}"
+            )
+            if on_progress:
+                await on_progress(broadcast)
+            return broadcast
+        finally:
+            self._running.discard(broadcast_id)
@@ -0,0 +1,112 @@
+# cache.py
+import time
+from collections import OrderedDict
+
+
+class CacheEntry:
+    """Запись кэша доступности одной даты"""
+
+    __slots__ = ("value", "version", "expires_at", "keyboard")
+
+    def __init__(self, value, version, expires_at):
+        self.value = value
+        self.version = version
+        self.expires_at = expires_at
+        self.keyboard = None
+
+
+class AvailabilityCache:
+    """LRU-кэш доступности по датам.
+
+    У каждой даты есть счетчик версий: любая запись в БД, затрагивающая
+    дату, увеличивает его, и закэшированное значение перестает быть
+    действительным. Значение, загруженное из БД во время такой записи,
+    не попадет в кэш, потому что версия к моменту сохранения уже другая.
+    """
+
+    def __init__(self, max_size=64):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._dates_keyboard = (None, None)
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def version(self, date):
+        """Текущая версия даты"""
+        return self._versions.get(date, 0)
+
+    def get(self, date, now=None):
+        """Действительная запись для даты или None"""
+        entry = self._entries.get(date)
+        if entry is not None:
+            if now is None:
+                now = time.time()
+            if entry.version != self.version(date) or (
+                entry.expires_at is not None and now >= entry.expires_at
+            ):
+                del self._entries[date]
+                entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(date)
+        self.hits += 1
+        return entry
+
+    def put(self, date, value, version, expires_at=None):
+        """Сохранение значения, загруженного при версии version"""
+        if version != self.version(date):
+            return None
+        entry = CacheEntry(value, version, expires_at)
+        self._entries[date] = entry
+        self._entries.move_to_end(date)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return entry
+
+    def get_keyboard(self, date, build):
+        """Закэшированная клавиатура даты (строится при первом обращении)"""
+        entry = self._entries.get(date)
+        if entry is None or entry.version != self.version(date):
+            return build()
+        if entry.keyboard is None:
+            entry.keyboard = build()
+        return entry.keyboard
+
+    def get_dates_keyboard(self, dates, build):
+        """Клавиатура с датами; перестраивается только при смене набора дат"""
+        key, keyboard = self._dates_keyboard
+        if key != dates:
+            keyboard = build()
+            self._dates_keyboard = (dates, keyboard)
+        return keyboard
+
+    def invalidate(self, dates):
+        """Сброс дат после изменения данных"""
+        for date in dates:
+            self._versions[date] = self.version(date) + 1
+            self._entries.pop(date, None)
+            self.invalidations += 1
+
+    def clear(self):
+        """Полный сброс кэша"""
+        self.invalidate(list(self._versions))
+        self._entries.clear()
+        self._dates_keyboard = (None, None)
+
+    def stats(self):
+        """Счетчики кэша"""
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "invalidations": self.invalidations,
+            "evictions": self.evictions,
+        }
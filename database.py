@@ -0,0 +1,1431 @@
+# database.py
+import time
+import queue
+import sqlite3
+import asyncio
+import logging
+from enum import Enum
+from collections import namedtuple
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import DB_ERRORS, DB_SECONDS, timed
+
+logger = logging.getLogger(__name__)
+
+
+# ================== МИГРАЦИИ ==================
+# Вклад строки appointments (row = new/old) в сводку её дня; sign="-" - вычитание
+# IFNULL и IS, а не =: у старых строк status и payment_status бывают NULL
+_DAY_SUMMARY_ADD = """
+            INSERT INTO day_summary (day, booked, pending, paid)
+            VALUES ({row}.appointment_date,
+                    {sign}IFNULL({row}.status IN ('pending', 'confirmed'), 0),
+                    {sign}({row}.status IS 'pending'),
+                    {sign}({row}.status IS 'confirmed' AND {row}.payment_status IS 'paid'))
+            ON CONFLICT (day) DO UPDATE SET
+                booked = booked + excluded.booked,
+                pending = pending + excluded.pending,
+                paid = paid + excluded.paid;"""
+
+# Вклад строки appointments в счетчики аналитики по каждому измерению:
+# всего, день, день недели (0 - воскресенье), время слота
+_STATS_KEYS = {
+    "total": "''",
+    "day": "{row}.appointment_date",
+    "weekday": "strftime('%w', {row}.appointment_date)",
+    "hour": "{row}.appointment_time",
+}
+# booked, paid, expired, cancelled, lead_minutes (от создания записи до визита)
+_STATS_VALUES = (
+    "1",
+    # IS, а не =: у старых строк status и payment_status бывают NULL
+    "{row}.payment_status IS 'paid'",
+    "{row}.status IS 'expired'",
+    "{row}.status IS 'cancelled'",
+    "IFNULL(MAX(0, CAST(round((julianday({row}.appointment_date || ' ' || {row}.appointment_time)"
+    " - julianday({row}.created_at, 'localtime')) * 1440) AS INTEGER)), 0)",
+)
+# В счетчики попадают только строки с правильной датой: даты, которые
+# миграция 3 не смогла разобрать, остаются в таблице как есть, а
+# strftime/julianday от них - NULL
+_STATS_ROW_FILTER = "date({row}.appointment_date) IS NOT NULL"
+
+
+def _stats_add(row, sign):
+    """Upsert вклада строки row (new/old) в stats_counters; sign="-" - вычитание"""
+    values = ",\n                       ".join(
+        f"('{dimension}', {key.format(row=row)}, "
+        + ", ".join(f"{sign}({value.format(row=row)})" for value in _STATS_VALUES) + ")"
+        for dimension, key in _STATS_KEYS.items()
+    )
+    return f"""
+            INSERT INTO stats_counters (dimension, key, booked, paid, expired, cancelled, lead_minutes)
+            SELECT * FROM (VALUES {values})
+            WHERE {_STATS_ROW_FILTER.format(row=row)}
+            ON CONFLICT (dimension, key) DO UPDATE SET
+                booked = booked + excluded.booked,
+                paid = paid + excluded.paid,
+                expired = expired + excluded.expired,
+                cancelled = cancelled + excluded.cancelled,
+                lead_minutes = lead_minutes + excluded.lead_minutes;"""
+
+
+# Каждая миграция - (номер, описание, шаги). Шаг - SQL-строка или функция
+# fn(conn). Номер последней примененной миграции хранится в PRAGMA user_version.
+MIGRATIONS = [
+    (1, "базовая схема", [
+        '''
+        CREATE TABLE IF NOT EXISTS appointments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            client_name TEXT NOT NULL,
+            client_phone TEXT NOT NULL,
+            appointment_date TEXT NOT NULL,
+            appointment_time TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            status TEXT DEFAULT 'pending',
+            client_chat_id INTEGER,
+            payment_status TEXT DEFAULT 'not_paid'
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            client_chat_id INTEGER NOT NULL,
+            client_name TEXT NOT NULL,
+            message_text TEXT NOT NULL,
+            is_from_client BOOLEAN NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS blocked_slots (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            blocked_date TEXT NOT NULL,
+            blocked_time TEXT,
+            is_all_day BOOLEAN DEFAULT 0,
+            reason TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS bot_users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER UNIQUE NOT NULL,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    (2, "индексы для частых запросов", [
+        # is_time_slot_taken, send_reminders: покрывающий индекс по слоту
+        "CREATE INDEX IF NOT EXISTS idx_appointments_slot "
+        "ON appointments (appointment_date, appointment_time, status)",
+        # get_client_appointments
+        "CREATE INDEX IF NOT EXISTS idx_appointments_client "
+        "ON appointments (client_chat_id, status, appointment_date, appointment_time)",
+        # get_pending_appointments, get_all_appointments
+        "CREATE INDEX IF NOT EXISTS idx_appointments_status "
+        "ON appointments (status, payment_status)",
+        # get_blocked_slots, is_slot_blocked
+        "CREATE INDEX IF NOT EXISTS idx_blocked_slots_date "
+        "ON blocked_slots (blocked_date, blocked_time, is_all_day)",
+        # get_client_messages
+        "CREATE INDEX IF NOT EXISTS idx_messages_from_client "
+        "ON messages (is_from_client, created_at)",
+    ]),
+    (3, "даты в формате ISO и индекс по времени записи", [
+        lambda conn: _backfill_iso_dates(conn, "appointments", "appointment_date"),
+        lambda conn: _backfill_iso_dates(conn, "blocked_slots", "blocked_date"),
+        "ALTER TABLE appointments ADD COLUMN starts_at TEXT "
+        "GENERATED ALWAYS AS (appointment_date || ' ' || appointment_time) VIRTUAL",
+        "DROP INDEX IF EXISTS idx_appointments_client",
+        # get_client_appointments: ближайшие записи клиента
+        "CREATE INDEX IF NOT EXISTS idx_appointments_client "
+        "ON appointments (client_chat_id, status, starts_at)",
+        # get_all_appointments и выборки по диапазону времени
+        "CREATE INDEX IF NOT EXISTS idx_appointments_starts "
+        "ON appointments (status, starts_at)",
+    ]),
+
+    (4, "атомарное бронирование слотов и временные удержания", [
+        # Подтвержденные дубли слота, оставленные до решения мастера (см. _cancel_duplicate_bookings)
+        "ALTER TABLE appointments ADD COLUMN double_booked INTEGER NOT NULL DEFAULT 0",
+        lambda conn: _cancel_duplicate_bookings(conn),
+        # Не более одной активной записи на слот
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_appointments_active_slot "
+        "ON appointments (appointment_date, appointment_time) "
+        "WHERE status IN ('pending', 'confirmed') AND NOT double_booked",
+        '''
+        CREATE TABLE IF NOT EXISTS slot_holds (
+            slot_date TEXT NOT NULL,
+            slot_time TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (slot_date, slot_time)
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_slot_holds_chat ON slot_holds (chat_id)",
+    ]),
+    (5, "индекс для просрочки оплат", [
+        "DROP INDEX IF EXISTS idx_appointments_status",
+        # get_pending_appointments, expire_overdue_payments
+        "CREATE INDEX IF NOT EXISTS idx_appointments_status "
+        "ON appointments (status, payment_status, created_at)",
+    ]),
+    (6, "журнал отправленных напоминаний", [
+        '''
+        CREATE TABLE IF NOT EXISTS reminder_log (
+            appointment_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (appointment_id, kind)
+        )
+        ''',
+    ]),
+    (7, "рассылки", [
+        '''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            message_text TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            last_chat_id INTEGER,
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            admin_chat_id INTEGER,
+            progress_message_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+        ''',
+    ]),
+    (8, "недоставленные сообщения", [
+        '''
+        CREATE TABLE IF NOT EXISTS dead_letters (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            message_text TEXT NOT NULL,
+            error TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    (9, "индекс для постраничного просмотра записей", [
+        # get_active_appointments_page: ключ (starts_at, id) только по активным записям
+        "CREATE INDEX IF NOT EXISTS idx_appointments_active_starts "
+        "ON appointments (starts_at, id) WHERE status IN ('pending', 'confirmed')",
+    ]),
+    (10, "полнотекстовый поиск и переписка с клиентом", [
+        # search_messages: FTS5-индекс поверх messages, синхронизируется триггерами
+        "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+        "message_text, content='messages', content_rowid='id', "
+        "tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+        "INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')",
+        "CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN "
+        "INSERT INTO messages_fts (rowid, message_text) VALUES (new.id, new.message_text); END",
+        "CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN "
+        "INSERT INTO messages_fts (messages_fts, rowid, message_text) "
+        "VALUES ('delete', old.id, old.message_text); END",
+        "CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF message_text ON messages BEGIN "
+        "INSERT INTO messages_fts (messages_fts, rowid, message_text) "
+        "VALUES ('delete', old.id, old.message_text); "
+        "INSERT INTO messages_fts (rowid, message_text) VALUES (new.id, new.message_text); END",
+        # get_messages_page для одного клиента: переписка в обе стороны
+        "CREATE INDEX IF NOT EXISTS idx_messages_client "
+        "ON messages (client_chat_id, created_at)",
+    ]),
+    (11, "нормализованные телефоны для поиска", [
+        "ALTER TABLE appointments ADD COLUMN phone_normalized TEXT",
+        # Цифры в обратном порядке: поиск по последним цифрам - это поиск по префиксу
+        "ALTER TABLE appointments ADD COLUMN phone_reversed TEXT",
+        lambda conn: _backfill_phones(conn),
+        # find_appointments_by_phone: поиск по началу и по концу номера
+        "CREATE INDEX IF NOT EXISTS idx_appointments_phone "
+        "ON appointments (phone_normalized)",
+        "CREATE INDEX IF NOT EXISTS idx_appointments_phone_reversed "
+        "ON appointments (phone_reversed)",
+    ]),
+    (12, "сводка по дням", [
+        # Счетчики по дню поддерживаются триггерами при любом изменении записей и выходных
+        '''
+        CREATE TABLE IF NOT EXISTS day_summary (
+            day TEXT PRIMARY KEY,
+            booked INTEGER NOT NULL DEFAULT 0,
+            pending INTEGER NOT NULL DEFAULT 0,
+            paid INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            closed INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+        ''',
+        lambda conn: _rebuild_day_summary(conn),
+        f"""
+        CREATE TRIGGER IF NOT EXISTS day_summary_appointment_insert AFTER INSERT ON appointments BEGIN
+            {_DAY_SUMMARY_ADD.format(row="new", sign="")}
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS day_summary_appointment_update
+        AFTER UPDATE OF status, payment_status, appointment_date ON appointments BEGIN
+            {_DAY_SUMMARY_ADD.format(row="old", sign="-")}
+            {_DAY_SUMMARY_ADD.format(row="new", sign="")}
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS day_summary_appointment_delete AFTER DELETE ON appointments BEGIN
+            {_DAY_SUMMARY_ADD.format(row="old", sign="-")}
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS day_summary_blocked_insert AFTER INSERT ON blocked_slots BEGIN
+            INSERT INTO day_summary (day, blocked, closed)
+            VALUES (new.blocked_date, new.is_all_day = 0, new.is_all_day != 0)
+            ON CONFLICT (day) DO UPDATE SET
+                blocked = blocked + excluded.blocked, closed = closed + excluded.closed;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS day_summary_blocked_delete AFTER DELETE ON blocked_slots BEGIN
+            UPDATE day_summary SET blocked = blocked - (old.is_all_day = 0), closed = closed - (old.is_all_day != 0)
+            WHERE day = old.blocked_date;
+        END
+        """,
+    ]),
+    (13, "состояние разговоров и user_data", [
+        '''
+        CREATE TABLE IF NOT EXISTS persistent_data (
+            kind TEXT NOT NULL,
+            key INTEGER NOT NULL,
+            data TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (kind, key)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS conversation_states (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            state TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (name, key)
+        ) WITHOUT ROWID
+        ''',
+    ]),
+    (14, "счетчики аналитики", [
+        # get_stats: сводка читается из ограниченного числа строк, без просмотра записей
+        '''
+        CREATE TABLE IF NOT EXISTS stats_counters (
+            dimension TEXT NOT NULL,
+            key TEXT NOT NULL,
+            booked INTEGER NOT NULL DEFAULT 0,
+            paid INTEGER NOT NULL DEFAULT 0,
+            expired INTEGER NOT NULL DEFAULT 0,
+            cancelled INTEGER NOT NULL DEFAULT 0,
+            lead_minutes INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (dimension, key)
+        ) WITHOUT ROWID
+        ''',
+        lambda conn: _rebuild_stats(conn),
+        f"""
+        CREATE TRIGGER IF NOT EXISTS stats_appointment_insert AFTER INSERT ON appointments BEGIN
+            {_stats_add("new", "")}
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS stats_appointment_update
+        AFTER UPDATE OF status, payment_status, appointment_date, appointment_time ON appointments
+        WHEN old.status IS NOT new.status OR old.payment_status IS NOT new.payment_status
+          OR old.appointment_date IS NOT new.appointment_date OR old.appointment_time IS NOT new.appointment_time
+        BEGIN
+            {_stats_add("old", "-")}
+            {_stats_add("new", "")}
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS stats_appointment_delete AFTER DELETE ON appointments BEGIN
+            {_stats_add("old", "-")}
+        END
+        """,
+    ]),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(conn):
+    """Текущая версия схемы БД"""
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def run_migrations(conn, migrations=MIGRATIONS):
+    """Применение недостающих миграций, каждая в своей транзакции"""
+    version = get_schema_version(conn)
+    if version >= migrations[-1][0]:
+        # Схема актуальна: обычный запуск, без транзакций и перебора шагов
+        return version
+    for number, description, steps in migrations:
+        if number <= version:
+            continue
+        try:
+            conn.execute("BEGIN")
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+            conn.execute(f"PRAGMA user_version = {int(number)}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            logger.error(f"❌ Ошибка миграции {number} ({description})")
+            raise
+        version = number
+        logger.info(f"✅ Применена миграция {number}: {description}")
+    return version
+
+
+def _parse_legacy_date(value, created_at):
+    """Дата "Пн 05.10" в ISO; год берется из даты создания строки"""
+    day, month = map(int, value.split(" ")[1].split("."))
+    try:
+        created = datetime.strptime(created_at, "%Y-%m-%d %H:%M:%S")
+    except (TypeError, ValueError):
+        created = datetime.now()
+    year = created.year + 1 if month < created.month else created.year
+    return f"{year:04d}-{month:02d}-{day:02d}"
+
+
+def _backfill_iso_dates(conn, table, column):
+    """Перевод дат таблицы из формата кнопок в ISO"""
+    rows = conn.execute(
+        f"SELECT id, {column}, created_at FROM {table} WHERE {column} NOT GLOB '[0-9][0-9][0-9][0-9]-*'"
+    ).fetchall()
+    updates = []
+    for row_id, value, created_at in rows:
+        try:
+            updates.append((_parse_legacy_date(value, created_at), row_id))
+        except (ValueError, IndexError):
+            logger.error(f"❌ Не удалось разобрать дату {value!r} ({table} #{row_id})")
+    conn.executemany(f"UPDATE {table} SET {column} = ? WHERE id = ?", updates)
+
+
+def normalize_phone(phone):
+    """Телефон в виде цифр E.164 без "+": "8 (999) 123-45-67" -> "79991234567" """
+    digits = "".join(ch for ch in phone or "" if ch.isdigit())
+    if len(digits) == 11 and digits.startswith("8"):
+        digits = "7" + digits[1:]
+    elif len(digits) == 10 and digits.startswith("9"):
+        digits = "7" + digits
+    return digits
+
+
+def _backfill_phones(conn):
+    """Заполнение нормализованных телефонов у существующих записей"""
+    rows = conn.execute("SELECT id, client_phone FROM appointments").fetchall()
+    updates = []
+    for row_id, phone in rows:
+        normalized = normalize_phone(phone)
+        updates.append((normalized, normalized[::-1], row_id))
+    conn.executemany(
+        "UPDATE appointments SET phone_normalized = ?, phone_reversed = ? WHERE id = ?", updates
+    )
+
+
+def _rebuild_day_summary(conn):
+    """Пересчет сводки по дням с нуля"""
+    conn.execute("DELETE FROM day_summary")
+    conn.execute(
+        """INSERT INTO day_summary (day, booked, pending, paid)
+           SELECT appointment_date,
+                  SUM(IFNULL(status IN ('pending', 'confirmed'), 0)),
+                  SUM(status IS 'pending'),
+                  SUM(status IS 'confirmed' AND payment_status IS 'paid')
+           FROM appointments
+           GROUP BY appointment_date"""
+    )
+    conn.execute(
+        """INSERT INTO day_summary (day, blocked, closed)
+           SELECT blocked_date, SUM(is_all_day = 0), SUM(is_all_day != 0)
+           FROM blocked_slots
+           WHERE true
+           GROUP BY blocked_date
+           ON CONFLICT (day) DO UPDATE SET blocked = excluded.blocked, closed = excluded.closed"""
+    )
+
+
+def _rebuild_stats(conn):
+    """Пересчет счетчиков аналитики с нуля"""
+    conn.execute("DELETE FROM stats_counters")
+    for dimension, key in _STATS_KEYS.items():
+        values = ", ".join(f"SUM({value.format(row='a')})" for value in _STATS_VALUES)
+        conn.execute(
+            f"""INSERT INTO stats_counters (dimension, key, booked, paid, expired, cancelled, lead_minutes)
+                SELECT '{dimension}', {key.format(row='a')}, {values}
+                FROM appointments a
+                WHERE {_STATS_ROW_FILTER.format(row='a')}
+                GROUP BY 2"""
+        )
+
+
+def _cancel_duplicate_bookings(conn):
+    """Разбор дублей активных записей на один слот.
+
+    Остается подтвержденная или оплаченная запись, при равенстве - самая
+    ранняя. Лишние неоплаченные заявки отменяются. Подтвержденные и
+    оплаченные дубли не трогаются: они помечаются double_booked (вне
+    уникального индекса), и бот при запуске сообщает о них мастеру.
+    """
+    rows = conn.execute(
+        """SELECT id, appointment_date, appointment_time, status = 'confirmed' OR payment_status = 'paid'
+           FROM (
+               SELECT *, ROW_NUMBER() OVER (
+                   PARTITION BY appointment_date, appointment_time
+                   ORDER BY (status = 'confirmed' OR payment_status = 'paid') DESC, created_at, id
+               ) AS position
+               FROM appointments
+               WHERE status IN ('pending', 'confirmed')
+           )
+           WHERE position > 1"""
+    ).fetchall()
+    cancelled, kept = [], []
+    for appointment_id, date, time_slot, settled in rows:
+        if settled:
+            logger.warning(f"⚠️ Подтвержденная запись #{appointment_id} дублирует слот {date} {time_slot}, нужна проверка мастера")
+            kept.append((appointment_id,))
+        else:
+            logger.warning(f"⚠️ Неоплаченная запись #{appointment_id} дублирует слот {date} {time_slot} и будет отменена")
+            cancelled.append((appointment_id,))
+    conn.executemany("UPDATE appointments SET status = 'cancelled' WHERE id = ?", cancelled)
+    conn.executemany("UPDATE appointments SET double_booked = 1 WHERE id = ?", kept)
+
+
+# ================== ЗАПИСИ ==================
+class AppointmentStatus(Enum):
+    PENDING = "pending"
+    CONFIRMED = "confirmed"
+    CANCELLED = "cancelled"
+    EXPIRED = "expired"
+
+
+# Колонки appointments, из которых собирается Appointment (в порядке полей)
+APPOINTMENT_COLUMNS = (
+    "id, client_name, client_phone, appointment_date, appointment_time, "
+    "created_at, status, client_chat_id, payment_status"
+)
+
+
+# Статус, которым считаются NULL и неизвестные старые значения: такая
+# запись не активна, по ней не шлются напоминания и не ждется оплата
+FALLBACK_STATUS = AppointmentStatus.CANCELLED
+_unknown_statuses = set()
+
+
+def _parse_status(value, appointment_id):
+    try:
+        return AppointmentStatus(value)
+    except ValueError:
+        if value not in _unknown_statuses:
+            _unknown_statuses.add(value)
+            logger.warning(
+                f"⚠️ Неизвестный статус {value!r} (первая - запись #{appointment_id}), "
+                f"считается {FALLBACK_STATUS.value}"
+            )
+        return FALLBACK_STATUS
+
+
+def _parse_datetime(value):
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class Appointment(namedtuple("Appointment", [
+    "id", "client_name", "client_phone", "date", "time", "created_at", "status", "chat_id", "paid", "starts",
+])):
+    """Запись клиента с разобранными при загрузке полями.
+
+    date и time - строки хранения (YYYY-MM-DD, HH:MM), starts - их
+    datetime, created_at - datetime в UTC, status - AppointmentStatus
+    (FALLBACK_STATUS для NULL и неизвестных значений), paid - оплачена
+    ли запись. starts и created_at равны None, если
+    значение в БД не разбирается.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_row(cls, cursor, row):
+        """Фабрика строк sqlite для выборки APPOINTMENT_COLUMNS"""
+        created_at = _parse_datetime(row[5])
+        return cls(
+            row[0], row[1], row[2], row[3], row[4],
+            created_at and created_at.replace(tzinfo=timezone.utc),
+            _parse_status(row[6], row[0]),
+            row[7],
+            row[8] == "paid",
+            _parse_datetime(f"{row[3]} {row[4]}"),
+        )
+
+
+def _select_appointments(conn, sql, params=()):
+    """Выполнение запроса, строки которого собираются в Appointment"""
+    cursor = conn.cursor()
+    cursor.row_factory = Appointment.from_row
+    return cursor.execute(sql, params)
+
+
+class WriteBehind:
+    """Буфер отложенной записи для некритичных данных.
+
+    Пользователи бота и журнал сообщений копятся в памяти и пишутся
+    одной транзакцией раз в interval секунд или при накоплении max_rows
+    строк. Повторные /start одного пользователя схлопываются в одну
+    строку буфера.
+    """
+
+    def __init__(self, db, interval=0.2, max_rows=200):
+        self.db = db
+        self.interval = interval
+        self.max_rows = max_rows
+        self._users = {}
+        self._messages = []
+        self._timer = None
+        self._flush_requested = False
+        self._flushing = None
+        self.flushes = 0
+        self.rows = 0
+
+    def __len__(self):
+        return len(self._users) + len(self._messages)
+
+    def add_user(self, chat_id, username, first_name, last_name):
+        self._users[chat_id] = (chat_id, username, first_name, last_name)
+        self._schedule()
+
+    def add_message(self, client_chat_id, client_name, message_text, is_from_client):
+        created_at = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        self._messages.append((client_chat_id, client_name, message_text, is_from_client, created_at))
+        self._schedule()
+
+    def _schedule(self):
+        loop = asyncio.get_running_loop()
+        if len(self) >= self.max_rows:
+            if not self._flush_requested:
+                self._flush_requested = True
+                loop.create_task(self.flush())
+        elif self._timer is None:
+            self._timer = loop.call_later(self.interval, lambda: loop.create_task(self.flush()))
+
+    def _take(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        self._flush_requested = False
+        users, messages = list(self._users.values()), self._messages
+        self._users, self._messages = {}, []
+        return users, messages
+
+    @staticmethod
+    def _write(conn, users, messages):
+        # Строка пользователя меняется, только если изменились имя или username
+        conn.executemany(
+            """INSERT INTO bot_users (chat_id, username, first_name, last_name) VALUES (?, ?, ?, ?)
+               ON CONFLICT (chat_id) DO UPDATE SET
+                   username = excluded.username,
+                   first_name = excluded.first_name,
+                   last_name = excluded.last_name
+               WHERE username IS NOT excluded.username
+                  OR first_name IS NOT excluded.first_name
+                  OR last_name IS NOT excluded.last_name""",
+            users
+        )
+        conn.executemany(
+            """INSERT INTO messages (client_chat_id, client_name, message_text, is_from_client, created_at)
+               VALUES (?, ?, ?, ?, ?)""",
+            messages
+        )
+
+    async def flush(self):
+        """Запись накопленного одной транзакцией"""
+        # Предыдущая запись должна закончиться раньше, чтобы сообщения легли по порядку
+        while self._flushing is not None:
+            await self._flushing
+        users, messages = self._take()
+        if not users and not messages:
+            return
+        self._flushing = asyncio.get_running_loop().create_future()
+        try:
+            await self.db.write(self._write, users, messages)
+            self.flushes += 1
+            self.rows += len(users) + len(messages)
+        except Exception as e:
+            logger.error(f"❌ Ошибка отложенной записи ({len(users)} польз., {len(messages)} сообщ.): {e}")
+        finally:
+            self._flushing.set_result(None)
+            self._flushing = None
+
+    def flush_sync(self):
+        """Запись остатка при закрытии БД (вне цикла событий)"""
+        users, messages = self._take()
+        if users or messages:
+            self.db._write_executor.submit(self.db._run_write, self._write, (users, messages)).result()
+
+
+class Database:
+    """Асинхронный доступ к SQLite через постоянные соединения.
+
+    Все запросы выполняются в отдельных потоках, поэтому обработчики
+    бота не блокируют цикл событий. Запись идет через одно соединение
+    (SQLite все равно допускает только одного писателя), чтение - через
+    небольшой пул соединений, которые в режиме WAL не мешают записи.
+    """
+
+    def __init__(self, path, readers=2):
+        self.path = path
+        self.readers = readers
+        self._writer = None
+        self._reader_pool = queue.Queue()
+        self._reader_conns = []
+        self._write_executor = None
+        self._read_executor = None
+        self._listeners = []
+        self.write_behind = WriteBehind(self)
+
+    # ---------- подписчики на изменения ----------
+    def add_listener(self, callback):
+        """Подписка на изменения слотов: callback(dates)"""
+        self._listeners.append(callback)
+
+    def _slots_changed(self, *dates):
+        dates = {date for date in dates if date}
+        if not dates:
+            return
+        for callback in self._listeners:
+            try:
+                callback(dates)
+            except Exception as e:
+                logger.error(f"Ошибка обработчика изменений БД: {e}")
+
+    # ---------- соединения ----------
+    def _connect(self):
+        """Открытие соединения с настройками для конкурентной работы"""
+        conn = sqlite3.connect(
+            self.path,
+            timeout=10,
+            check_same_thread=False,
+            cached_statements=256,
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=10000")
+        return conn
+
+    def open(self):
+        """Открытие соединений и пулов потоков"""
+        if self._writer is not None:
+            return
+        self._writer = self._connect()
+        for _ in range(self.readers):
+            conn = self._connect()
+            self._reader_conns.append(conn)
+            self._reader_pool.put(conn)
+        self._write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+        self._read_executor = ThreadPoolExecutor(max_workers=self.readers, thread_name_prefix="db-read")
+
+    def close(self):
+        """Закрытие соединений (вызывается при остановке бота)"""
+        if self._writer is None:
+            return
+        try:
+            self.write_behind.flush_sync()
+        except Exception as e:
+            logger.error(f"❌ Ошибка записи буфера при закрытии БД: {e}")
+        self._write_executor.shutdown(wait=True)
+        self._read_executor.shutdown(wait=True)
+        for conn in self._reader_conns:
+            conn.close()
+        self._writer.close()
+        self._writer = None
+        self._reader_conns = []
+        self._reader_pool = queue.Queue()
+        logger.info("✅ Соединения с БД закрыты")
+
+    def _run_read(self, fn, args):
+        conn = self._reader_pool.get()
+        try:
+            return fn(conn, *args)
+        finally:
+            self._reader_pool.put(conn)
+
+    def _run_write(self, fn, args):
+        try:
+            result = fn(self._writer, *args)
+            self._writer.commit()
+            return result
+        except Exception:
+            self._writer.rollback()
+            raise
+
+    async def read(self, fn, *args):
+        """Выполнение fn(conn, *args) на соединении для чтения"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._read_executor, self._run_read, fn, args)
+
+    async def write(self, fn, *args):
+        """Выполнение fn(conn, *args) в транзакции на соединении для записи"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._write_executor, self._run_write, fn, args)
+
+    async def _fetchall(self, sql, params=()):
+        return await self.read(lambda conn: conn.execute(sql, params).fetchall())
+
+    async def _fetchone(self, sql, params=()):
+        return await self.read(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def _fetch_appointments(self, sql, params=()):
+        return await self.read(lambda conn: _select_appointments(conn, sql, params).fetchall())
+
+    async def _fetch_appointment(self, sql, params=()):
+        return await self.read(lambda conn: _select_appointments(conn, sql, params).fetchone())
+
+    async def _execute(self, sql, params=()):
+        return await self.write(lambda conn: conn.execute(sql, params).lastrowid)
+
+    # ---------- схема ----------
+    def init_database(self):
+        """Инициализация базы данных"""
+        try:
+            self.open()
+            version = run_migrations(self._writer)
+            logger.info(f"✅ База данных инициализирована (версия схемы {version})")
+        except Exception as e:
+            logger.error(f"❌ Ошибка инициализации БД: {e}")
+
+    # ---------- пользователи ----------
+    async def save_bot_user(self, chat_id, username=None, first_name=None, last_name=None):
+        """Сохранение пользователя бота (отложенное, см. WriteBehind)"""
+        self.write_behind.add_user(chat_id, username, first_name, last_name)
+
+    async def get_all_bot_users(self):
+        """Получение всех пользователей бота"""
+        return await self._fetchall("SELECT * FROM bot_users")
+
+    # ---------- состояние бота (SQLitePersistence) ----------
+    async def load_persistent_data(self, kind, key):
+        """Сохраненные данные (JSON) для user_data/chat_data или None"""
+        row = await self._fetchone(
+            "SELECT data FROM persistent_data WHERE kind = ? AND key = ?", (kind, key)
+        )
+        return row[0] if row else None
+
+    async def get_conversation_states(self, name):
+        """Состояния разговоров обработчика name: [(ключ JSON, состояние JSON)]"""
+        return await self._fetchall(
+            "SELECT key, state FROM conversation_states WHERE name = ?", (name,)
+        )
+
+    async def save_persistent_state(self, data, conversations):
+        """Запись изменений одной транзакцией.
+
+        data - [(kind, key, JSON или None)], conversations - [(name, ключ,
+        состояние или None)]; None означает удаление строки.
+        """
+        def save(conn):
+            conn.executemany(
+                """INSERT INTO persistent_data (kind, key, data) VALUES (?, ?, ?)
+                   ON CONFLICT (kind, key) DO UPDATE SET data = excluded.data, updated_at = CURRENT_TIMESTAMP""",
+                [row for row in data if row[2] is not None]
+            )
+            conn.executemany(
+                "DELETE FROM persistent_data WHERE kind = ? AND key = ?",
+                [row[:2] for row in data if row[2] is None]
+            )
+            conn.executemany(
+                """INSERT INTO conversation_states (name, key, state) VALUES (?, ?, ?)
+                   ON CONFLICT (name, key) DO UPDATE SET state = excluded.state, updated_at = CURRENT_TIMESTAMP""",
+                [row for row in conversations if row[2] is not None]
+            )
+            conn.executemany(
+                "DELETE FROM conversation_states WHERE name = ? AND key = ?",
+                [row[:2] for row in conversations if row[2] is None]
+            )
+        await self.write(save)
+
+    # ---------- недоставленные сообщения ----------
+    async def save_dead_letter(self, chat_id, message_text, error, attempts):
+        """Сохранение сообщения, которое не удалось доставить"""
+        return await self._execute(
+            "INSERT INTO dead_letters (chat_id, message_text, error, attempts) VALUES (?, ?, ?, ?)",
+            (chat_id, message_text, error, attempts)
+        )
+
+    # ---------- рассылки ----------
+    async def create_broadcast(self, message_text, admin_chat_id):
+        """Создание рассылки по всем текущим пользователям бота"""
+        return await self._execute(
+            """INSERT INTO broadcasts (message_text, admin_chat_id, total)
+               VALUES (?, ?, (SELECT COUNT(*) FROM bot_users))""",
+            (message_text, admin_chat_id)
+        )
+
+    async def get_broadcast(self, broadcast_id):
+        """Рассылка по ID в виде словаря"""
+        def load(conn):
+            cursor = conn.execute("SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            return dict(zip([column[0] for column in cursor.description], row))
+        return await self.read(load)
+
+    async def get_running_broadcasts(self):
+        """ID незавершенных рассылок"""
+        rows = await self._fetchall("SELECT id FROM broadcasts WHERE status = 'running' ORDER BY id")
+        return [row[0] for row in rows]
+
+    async def get_broadcast_recipients(self, after_chat_id, limit):
+        """Следующая порция получателей рассылки (по возрастанию chat_id)"""
+        if after_chat_id is None:
+            rows = await self._fetchall("SELECT chat_id FROM bot_users ORDER BY chat_id LIMIT ?", (limit,))
+        else:
+            rows = await self._fetchall(
+                "SELECT chat_id FROM bot_users WHERE chat_id > ? ORDER BY chat_id LIMIT ?",
+                (after_chat_id, limit)
+            )
+        return [row[0] for row in rows]
+
+    async def set_broadcast_progress_message(self, broadcast_id, message_id):
+        """Сообщение админу, в котором показывается прогресс рассылки"""
+        await self._execute(
+            "UPDATE broadcasts SET progress_message_id = ? WHERE id = ?",
+            (message_id, broadcast_id)
+        )
+
+    async def save_broadcast_progress(self, broadcast):
+        """Сохранение позиции и счетчиков рассылки"""
+        await self._execute(
+            """UPDATE broadcasts SET last_chat_id = ?, sent = ?, failed = ?, blocked = ?
+               WHERE id = ?""",
+            (broadcast["last_chat_id"], broadcast["sent"], broadcast["failed"],
+             broadcast["blocked"], broadcast["id"])
+        )
+
+    async def finish_broadcast(self, broadcast_id):
+        """Отметка о завершении рассылки"""
+        await self._execute(
+            "UPDATE broadcasts SET status = 'done', finished_at = CURRENT_TIMESTAMP WHERE id = ?",
+            (broadcast_id,)
+        )
+
+    # ---------- записи ----------
+    async def save_appointment_to_db(self, name, phone, date, time_slot, chat_id):
+        """Сохранение записи в БД.
+
+        Запись создается одним условным INSERT: если слот занят, заблокирован
+        или удерживается другим клиентом, возвращается None.
+        """
+        normalized = normalize_phone(phone)
+
+        def insert(conn):
+            now = time.time()
+            try:
+                cursor = conn.execute(
+                    """INSERT INTO appointments (client_name, client_phone, appointment_date, appointment_time,
+                                                 client_chat_id, phone_normalized, phone_reversed)
+                       SELECT ?, ?, ?, ?, ?, ?, ?
+                       WHERE NOT EXISTS (
+                           SELECT 1 FROM slot_holds
+                           WHERE slot_date = ? AND slot_time = ? AND chat_id != ? AND expires_at > ?
+                       ) AND NOT EXISTS (
+                           SELECT 1 FROM blocked_slots
+                           WHERE blocked_date = ? AND (is_all_day = 1 OR blocked_time = ?)
+                       )""",
+                    (name, phone, date, time_slot, chat_id, normalized, normalized[::-1],
+                     date, time_slot, chat_id, now,
+                     date, time_slot)
+                )
+            except sqlite3.IntegrityError:
+                return None
+            if cursor.rowcount == 0:
+                return None
+            conn.execute("DELETE FROM slot_holds WHERE chat_id = ?", (chat_id,))
+            return cursor.lastrowid
+
+        appointment_id = await self.write(insert)
+        self._slots_changed(date)
+        return appointment_id
+
+    async def get_client_appointments(self, chat_id, since=""):
+        """Получение записей клиента, начиная с момента since (YYYY-MM-DD HH:MM)"""
+        return await self._fetch_appointments(
+            f"""SELECT {APPOINTMENT_COLUMNS} FROM appointments
+               WHERE client_chat_id = ? AND status IN ('pending', 'confirmed') AND starts_at >= ?
+               ORDER BY starts_at""",
+            (chat_id, since)
+        )
+
+    async def find_appointments_by_phone(self, digits, limit=50):
+        """История записей по телефону: номер начинается или заканчивается на digits.
+
+        Начало номера сравнивается с нормализованным телефоном, конец -
+        с развернутым; оба условия - диапазоны по индексам. Возвращаются
+        записи во всех статусах, новые первыми.
+        """
+        digits = "".join(ch for ch in digits if ch.isdigit())
+        prefix = normalize_phone(digits)
+        if len(prefix) < 11 and prefix.startswith("8"):
+            # Начало номера, набранное через 8
+            prefix = "7" + prefix[1:]
+        elif len(prefix) < 10 and prefix.startswith("9"):
+            # Начало номера без кода страны
+            prefix = "7" + prefix
+        suffix = digits[::-1]
+        return await self._fetch_appointments(
+            f"""SELECT {APPOINTMENT_COLUMNS} FROM appointments
+               WHERE (phone_normalized >= ? AND phone_normalized < ? || ':')
+                  OR (phone_reversed >= ? AND phone_reversed < ? || ':')
+               ORDER BY starts_at DESC
+               LIMIT ?""",
+            (prefix, prefix, suffix, suffix, limit)
+        )
+
+    async def get_active_appointments_page(self, since, cursor_id=None, backward=False, limit=10):
+        """Страница активных записей с момента since по ключу (starts_at, id).
+
+        Без cursor_id - первая страница; иначе записи после (или, при
+        backward, перед) записью cursor_id. Возвращает (записи по
+        возрастанию времени, есть ли еще записи в направлении листания).
+        """
+        if cursor_id is None:
+            anchor, params = "(?, 0)", [since]
+        else:
+            anchor, params = "(SELECT starts_at, id FROM appointments WHERE id = ?)", [cursor_id]
+        op, order = ("<", "DESC") if backward else (">", "ASC")
+        rows = await self._fetch_appointments(
+            # Без подсказки планировщик берет idx_appointments_starts и сортирует
+            # обе ветки status во временном B-дереве
+            f"""SELECT {APPOINTMENT_COLUMNS} FROM appointments INDEXED BY idx_appointments_active_starts
+                WHERE status IN ('pending', 'confirmed') AND starts_at >= ?
+                  AND (starts_at, id) {op} {anchor}
+                ORDER BY starts_at {order}, id {order}
+                LIMIT ?""",
+            [since] + params + [limit + 1]
+        )
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if backward:
+            rows.reverse()
+        return rows, has_more
+
+    async def get_appointment_by_id(self, appointment_id):
+        """Получение записи по ID"""
+        return await self._fetch_appointment(
+            f"SELECT {APPOINTMENT_COLUMNS} FROM appointments WHERE id = ?", (appointment_id,)
+        )
+
+    async def get_confirmed_appointments(self, since=""):
+        """Получение подтвержденных записей, начиная с момента since"""
+        return await self._fetch_appointments(
+            f"""SELECT {APPOINTMENT_COLUMNS} FROM appointments
+               WHERE status = 'confirmed' AND starts_at >= ?
+               ORDER BY starts_at""",
+            (since,)
+        )
+
+    async def _set_status(self, sql, params):
+        """Переход статуса одним UPDATE ... RETURNING.
+
+        Условие перехода - в WHERE самого UPDATE, поэтому повторный или
+        устаревший запрос ничего не меняет и возвращает None.
+        """
+        rows = await self.write(
+            lambda conn: _select_appointments(conn, f"{sql} RETURNING {APPOINTMENT_COLUMNS}", params).fetchall()
+        )
+        if not rows:
+            return None
+        self._slots_changed(rows[0].date)
+        return rows[0]
+
+    async def confirm_payment(self, appointment_id):
+        """Подтверждение оплаты записи, ожидающей оплаты (иначе None)"""
+        return await self._set_status(
+            "UPDATE appointments SET status = 'confirmed', payment_status = 'paid' WHERE id = ? AND status = 'pending'",
+            (appointment_id,)
+        )
+
+    async def cancel_appointment(self, appointment_id, chat_id=None):
+        """Отмена активной записи (иначе None); с chat_id - только записи этого клиента"""
+        sql = "UPDATE appointments SET status = 'cancelled' WHERE id = ? AND status IN ('pending', 'confirmed')"
+        if chat_id is None:
+            return await self._set_status(sql, (appointment_id,))
+        return await self._set_status(f"{sql} AND client_chat_id = ?", (appointment_id, chat_id))
+
+    async def expire_appointment(self, appointment_id):
+        """Просрочка записи, если она все еще ожидает оплаты (иначе None)"""
+        return await self._set_status(
+            """UPDATE appointments SET status = 'expired'
+               WHERE id = ? AND status = 'pending' AND payment_status = 'not_paid'""",
+            (appointment_id,)
+        )
+
+    async def expire_overdue_payments(self, timeout_seconds):
+        """Просрочка всех записей, не оплаченных за timeout_seconds, одним запросом"""
+        rows = await self.write(
+            lambda conn: _select_appointments(
+                conn,
+                f"""UPDATE appointments SET status = 'expired'
+                    WHERE status = 'pending' AND payment_status = 'not_paid'
+                      AND created_at <= datetime('now', ?)
+                    RETURNING {APPOINTMENT_COLUMNS}""",
+                (f"-{int(timeout_seconds)} seconds",)
+            ).fetchall()
+        )
+        self._slots_changed(*[row.date for row in rows])
+        return rows
+
+    async def get_pending_appointments(self):
+        """Получение ожидающих оплаты записей"""
+        return await self._fetch_appointments(
+            f"SELECT {APPOINTMENT_COLUMNS} FROM appointments WHERE status = 'pending' AND payment_status = 'not_paid'"
+        )
+
+    async def get_double_bookings(self):
+        """Активные записи на слоты, занятые больше одного раза (дубли до миграции 4)"""
+        return await self._fetch_appointments(
+            f"""SELECT {APPOINTMENT_COLUMNS} FROM appointments
+                WHERE status IN ('pending', 'confirmed') AND starts_at IN (
+                    SELECT starts_at FROM appointments
+                    WHERE status IN ('pending', 'confirmed')
+                    GROUP BY starts_at HAVING COUNT(*) > 1
+                )
+                ORDER BY starts_at, id"""
+        )
+
+    async def is_time_slot_taken(self, date, time_slot):
+        """Проверка занятости времени"""
+        row = await self._fetchone(
+            """SELECT COUNT(*) FROM appointments
+               WHERE appointment_date = ? AND appointment_time = ? AND status IN ('pending', 'confirmed')""",
+            (date, time_slot)
+        )
+        return row[0] > 0
+
+    async def get_day_summaries(self, dates):
+        """Сводка по дням: {дата: (booked, pending, paid, blocked, closed)}; дни без данных пропускаются"""
+        rows = await self._fetchall(
+            f"""SELECT day, booked, pending, paid, blocked, closed FROM day_summary
+                WHERE day IN ({", ".join("?" * len(dates))})""",
+            list(dates)
+        )
+        return {row[0]: row[1:] for row in rows}
+
+    async def get_stats(self, since, until):
+        """Счетчики аналитики: итог, дни недели, часы и дни с since до until (не включая).
+
+        Строки (измерение, ключ, booked, paid, expired, cancelled, lead_minutes);
+        их число не зависит от количества записей.
+        """
+        return await self._fetchall(
+            """SELECT dimension, key, booked, paid, expired, cancelled, lead_minutes FROM stats_counters
+               WHERE dimension IN ('total', 'weekday', 'hour')
+                  OR (dimension = 'day' AND key >= ? AND key < ?)""",
+            (since, until)
+        )
+
+    async def get_day_appointments(self, date):
+        """Активные записи на дату по времени"""
+        return await self._fetch_appointments(
+            f"""SELECT {APPOINTMENT_COLUMNS} FROM appointments
+               WHERE appointment_date = ? AND status IN ('pending', 'confirmed')
+               ORDER BY appointment_time""",
+            (date,)
+        )
+
+    async def get_occupancy(self, dates):
+        """Занятое и заблокированное время на набор дат.
+
+        Возвращает ({дата: {время}}, {дата: {время}}, {дата: срок}).
+        Удерживаемые слоты считаются занятыми; третий словарь - ближайший
+        срок окончания удержания на дату (timestamp). None во втором
+        множестве означает, что дата заблокирована целиком.
+        """
+        dates = list(dates)
+        if not dates:
+            return {}, {}, {}
+        marks = ", ".join("?" * len(dates))
+
+        def load(conn):
+            taken = {}
+            for date, time_slot in conn.execute(
+                f"""SELECT appointment_date, appointment_time FROM appointments
+                    WHERE appointment_date IN ({marks}) AND status IN ('pending', 'confirmed')""",
+                dates
+            ):
+                taken.setdefault(date, set()).add(time_slot)
+            holds_until = {}
+            for date, time_slot, expires_at in conn.execute(
+                f"""SELECT slot_date, slot_time, expires_at FROM slot_holds
+                    WHERE slot_date IN ({marks}) AND expires_at > ?""",
+                dates + [time.time()]
+            ):
+                taken.setdefault(date, set()).add(time_slot)
+                holds_until[date] = min(expires_at, holds_until.get(date, expires_at))
+            blocked = {}
+            for date, time_slot, is_all_day in conn.execute(
+                f"""SELECT blocked_date, blocked_time, is_all_day FROM blocked_slots
+                    WHERE blocked_date IN ({marks})""",
+                dates
+            ):
+                blocked.setdefault(date, set()).add(None if is_all_day else time_slot)
+            return taken, blocked, holds_until
+
+        return await self.read(load)
+
+    # ---------- напоминания ----------
+    async def get_due_reminders(self, kind, start, end):
+        """Подтвержденные записи с началом в (start, end], которым
+        напоминание kind еще не отправлялось"""
+        return await self._fetch_appointments(
+            f"""SELECT {APPOINTMENT_COLUMNS} FROM appointments a
+               WHERE a.status = 'confirmed' AND a.starts_at > ? AND a.starts_at <= ?
+                 AND NOT EXISTS (
+                     SELECT 1 FROM reminder_log r
+                     WHERE r.appointment_id = a.id AND r.kind = ?
+                 )
+               ORDER BY a.starts_at""",
+            (start, end, kind)
+        )
+
+    async def claim_reminders(self, appointment_ids, kind):
+        """Отметка напоминаний в журнале; возвращает ID, которые еще не были отмечены"""
+        def claim(conn):
+            claimed = set()
+            for appointment_id in appointment_ids:
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO reminder_log (appointment_id, kind) VALUES (?, ?)",
+                    (appointment_id, kind)
+                )
+                if cursor.rowcount:
+                    claimed.add(appointment_id)
+            return claimed
+        return await self.write(claim)
+
+    # ---------- удержание слотов ----------
+    async def hold_slot(self, date, time_slot, chat_id, seconds):
+        """Временное удержание слота клиентом на время оформления записи.
+
+        Предыдущее удержание клиента снимается. Возвращает False, если слот
+        занят, заблокирован или удерживается другим клиентом.
+        """
+        def hold(conn):
+            now = time.time()
+            released = conn.execute(
+                "DELETE FROM slot_holds WHERE chat_id = ? OR expires_at <= ? RETURNING slot_date",
+                (chat_id, now)
+            ).fetchall()
+            cursor = conn.execute(
+                """INSERT INTO slot_holds (slot_date, slot_time, chat_id, expires_at)
+                   SELECT ?, ?, ?, ?
+                   WHERE NOT EXISTS (
+                       SELECT 1 FROM appointments
+                       WHERE appointment_date = ? AND appointment_time = ? AND status IN ('pending', 'confirmed')
+                   ) AND NOT EXISTS (
+                       SELECT 1 FROM blocked_slots
+                       WHERE blocked_date = ? AND (is_all_day = 1 OR blocked_time = ?)
+                   )
+                   ON CONFLICT (slot_date, slot_time) DO NOTHING""",
+                (date, time_slot, chat_id, now + seconds,
+                 date, time_slot,
+                 date, time_slot)
+            )
+            return cursor.rowcount > 0, [row[0] for row in released]
+
+        held, released_dates = await self.write(hold)
+        self._slots_changed(date, *released_dates)
+        return held
+
+    async def release_hold(self, chat_id):
+        """Снятие удержания слота клиентом (отмена оформления)"""
+        rows = await self.write(
+            lambda conn: conn.execute(
+                "DELETE FROM slot_holds WHERE chat_id = ? RETURNING slot_date", (chat_id,)
+            ).fetchall()
+        )
+        self._slots_changed(*[row[0] for row in rows])
+
+    # ---------- заблокированные слоты ----------
+    async def add_blocked_slot(self, date, time_slot=None, reason=""):
+        """Добавление заблокированного слота"""
+        is_all_day = 1 if time_slot is None else 0
+        slot_id = await self._execute(
+            "INSERT INTO blocked_slots (blocked_date, blocked_time, is_all_day, reason) VALUES (?, ?, ?, ?)",
+            (date, time_slot, is_all_day, reason)
+        )
+        self._slots_changed(date)
+        return slot_id
+
+    async def get_blocked_slots(self, date=None):
+        """Получение заблокированных слотов"""
+        if date:
+            return await self._fetchall("SELECT * FROM blocked_slots WHERE blocked_date = ?", (date,))
+        return await self._fetchall("SELECT * FROM blocked_slots")
+
+    async def is_slot_blocked(self, date, time_slot):
+        """Проверка заблокирован ли слот"""
+        blocked_slots = await self.get_blocked_slots(date)
+        for slot in blocked_slots:
+            if slot[3]:  # is_all_day
+                return True
+            elif slot[2] == time_slot:
+                return True
+        return False
+
+    async def remove_blocked_slot(self, slot_id):
+        """Удаление заблокированного слота"""
+        row = await self.write(
+            lambda conn: conn.execute(
+                "DELETE FROM blocked_slots WHERE id = ? RETURNING blocked_date", (slot_id,)
+            ).fetchone()
+        )
+        if row:
+            self._slots_changed(row[0])
+
+    # ---------- сообщения ----------
+    async def save_message(self, client_chat_id, client_name, message_text, is_from_client):
+        """Сохранение сообщения (отложенное, см. WriteBehind)"""
+        self.write_behind.add_message(client_chat_id, client_name, message_text, is_from_client)
+
+    async def get_messages_page(self, client_chat_id=None, cursor_id=None, backward=False, limit=5):
+        """Страница сообщений, от новых к старым, по ключу (created_at, id).
+
+        Без client_chat_id - входящие сообщения всех клиентов; с ним -
+        переписка с клиентом в обе стороны. Без cursor_id - самые новые;
+        иначе сообщения старше (или, при backward, новее) сообщения
+        cursor_id. Возвращает (сообщения от новых к старым, есть ли еще
+        сообщения в направлении листания).
+        """
+        await self.write_behind.flush()
+        if client_chat_id is None:
+            condition, params = "is_from_client = 1", []
+        else:
+            condition, params = "client_chat_id = ?", [client_chat_id]
+        if cursor_id is not None:
+            op = ">" if backward else "<"
+            condition += f" AND (created_at, id) {op} (SELECT created_at, id FROM messages WHERE id = ?)"
+            params.append(cursor_id)
+        order = "ASC" if backward else "DESC"
+        rows = await self._fetchall(
+            f"""SELECT * FROM messages
+                WHERE {condition}
+                ORDER BY created_at {order}, id {order}
+                LIMIT ?""",
+            params + [limit + 1]
+        )
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if backward:
+            rows.reverse()
+        return rows, has_more
+
+    async def search_messages(self, text, limit=10):
+        """Поиск по тексту сообщений (FTS5), от новых к старым.
+
+        Каждое слово запроса ищется как префикс, в сообщении должны
+        встретиться все слова. К строке messages добавляется фрагмент
+        текста с найденными словами.
+        """
+        await self.write_behind.flush()
+        words = [word.replace('"', '""') for word in text.split()]
+        if not words:
+            return []
+        query = " ".join(f'"{word}"*' for word in words)
+        return await self._fetchall(
+            """SELECT m.*, snippet(messages_fts, 0, '«', '»', '…', 12)
+               FROM messages_fts
+               JOIN messages m ON m.id = messages_fts.rowid
+               WHERE messages_fts MATCH ?
+               ORDER BY messages_fts.rowid DESC
+               LIMIT ?""",
+            (query, limit)
+        )
+
+    # ---------- выгрузка ----------
+    async def _stream(self, sql, params, sink, chunk_size):
+        """Передача результата запроса в sink(колонки, строки) порциями.
+
+        Строки читаются курсором по chunk_size и сразу отдаются sink в
+        потоке БД, весь результат в памяти не собирается. sink вызывается
+        хотя бы один раз, даже без строк. Возвращает число строк.
+        """
+        def stream(conn):
+            cursor = conn.execute(sql, params)
+            columns = [column[0] for column in cursor.description]
+            rows = cursor.fetchmany(chunk_size)
+            sink(columns, rows)
+            count = len(rows)
+            while rows:
+                rows = cursor.fetchmany(chunk_size)
+                if rows:
+                    sink(columns, rows)
+                    count += len(rows)
+            return count
+        return await self.read(stream)
+
+    async def export_appointments(self, sink, date_from=None, date_to=None, status=None, chunk_size=500):
+        """Выгрузка записей за даты [date_from, date_to] (YYYY-MM-DD) со статусом status"""
+        conditions, params = [], []
+        if date_from:
+            conditions.append("appointment_date >= ?")
+            params.append(date_from)
+        if date_to:
+            conditions.append("appointment_date <= ?")
+            params.append(date_to)
+        if status:
+            conditions.append("status = ?")
+            params.append(status)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        return await self._stream(
+            # Порядок idx_appointments_slot: строки идут без сортировки во временном B-дереве
+            f"""SELECT id, appointment_date, appointment_time, client_name, client_phone, client_chat_id,
+                       status, payment_status, created_at
+                FROM appointments {where}
+                ORDER BY appointment_date, appointment_time""",
+            params, sink, chunk_size
+        )
+
+    async def export_users(self, sink, chunk_size=500):
+        """Выгрузка пользователей бота"""
+        await self.write_behind.flush()
+        return await self._stream(
+            "SELECT chat_id, username, first_name, last_name, created_at FROM bot_users ORDER BY id",
+            (), sink, chunk_size
+        )
+
+    async def export_messages(self, sink, date_from=None, date_to=None, chunk_size=500):
+        """Выгрузка переписки за даты [date_from, date_to] (по created_at, UTC)"""
+        await self.write_behind.flush()
+        conditions, params = [], []
+        if date_from:
+            conditions.append("created_at >= ?")
+            params.append(date_from)
+        if date_to:
+            conditions.append("created_at < date(?, '+1 day')")
+            params.append(date_to)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        return await self._stream(
+            f"""SELECT id, created_at, client_chat_id, client_name, is_from_client, message_text
+                FROM messages {where}
+                ORDER BY id""",
+            params, sink, chunk_size
+        )
+
+
+# Длительность и ошибки каждого публичного метода - в метриках (bot_db_call_seconds)
+for _name, _method in list(vars(Database).items()):
+    if not _name.startswith("_") and _name not in ("read", "write") and asyncio.iscoroutinefunction(_method):
+        setattr(Database, _name, timed(DB_SECONDS, DB_ERRORS, function=_name)(_method))
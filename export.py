@@ -0,0 +1,63 @@
+# export.py
+import io
+import csv
+import tempfile
+
+# Файл выгрузки держится в памяти до этого размера, дальше - на диске
+SPOOL_MAX_SIZE = 1024 * 1024
+
+
+class ExportWriter:
+    """Запись выгрузки во временный файл, порциями строк.
+
+    Экземпляр передается в Database.export_* как приемник: вызывается
+    из потока БД для каждой порции строк курсора, поэтому в памяти
+    держится не больше одной порции. XLSX требует openpyxl (импортируется
+    только для этого формата); если его нет - ImportError при создании.
+    """
+
+    def __init__(self, fmt="csv"):
+        self.format = fmt
+        self.rows = 0
+        self.file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE, mode="w+b")
+        if fmt == "xlsx":
+            from openpyxl import Workbook
+
+            # write_only: строки сразу уходят во временный XML, а не в дерево листа
+            self._workbook = Workbook(write_only=True)
+            self._sheet = self._workbook.create_sheet()
+            self._append = self._sheet.append
+        else:
+            # utf-8-sig: Excel открывает такой CSV с кириллицей без мастера импорта
+            self._text = io.TextIOWrapper(self.file, encoding="utf-8-sig", newline="")
+            self._append = csv.writer(self._text, delimiter=";").writerow
+        self._header = False
+
+    def __call__(self, columns, rows):
+        if not self._header:
+            self._append(columns)
+            self._header = True
+        for row in rows:
+            self._append(row)
+        self.rows += len(rows)
+
+    def finish(self):
+        """Завершение файла; возвращает его, перемотанным в начало"""
+        if self.format == "xlsx":
+            self._workbook.save(self.file)
+        else:
+            self._text.flush()
+            self._text.detach()
+        self.file.seek(0)
+        return self.file
+
+    def size(self):
+        """Размер готового файла в байтах"""
+        position = self.file.tell()
+        self.file.seek(0, io.SEEK_END)
+        size = self.file.tell()
+        self.file.seek(position)
+        return size
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,182 @@
+# metrics.py
+import time
+import bisect
+import functools
+
+# Все созданные метрики, в порядке создания
+REGISTRY = []
+
+# Границы корзин гистограмм, секунды
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter:
+    """Счетчик, только растет"""
+
+    kind = "counter"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        REGISTRY.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        for key, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+
+
+class Gauge:
+    """Текущее значение, вычисляется функцией в момент запроса метрик"""
+
+    kind = "gauge"
+
+    def __init__(self, name, help_text, read):
+        self.name = name
+        self.help = help_text
+        self.read = read
+        REGISTRY.append(self)
+
+    def render(self):
+        yield f"{self.name} {_format_value(self.read())}"
+
+
+class Histogram:
+    """Распределение длительностей по корзинам.
+
+    observe() - один bisect и два сложения; накопительные суммы по
+    корзинам считаются только при запросе метрик.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        REGISTRY.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        entry = self._values.get(key)
+        if entry is None:
+            # [счетчики корзин (последняя - +Inf), сумма]
+            entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def render(self):
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = bound if bound == "+Inf" else repr(float(bound))
+                yield f"{self.name}_bucket{_format_labels(self.labels, key, [('le', le)])} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labels, key)} {repr(total)}"
+            yield f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}"
+
+
+def render():
+    """Все метрики в текстовом формате Prometheus"""
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def timed(histogram, errors=None, **labels):
+    """Декоратор корутины: длительность в histogram, исключения в errors"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            except Exception:
+                if errors is not None:
+                    errors.inc(**labels)
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - started, **labels)
+        return wrapper
+    return decorator
+
+
+# ================== МЕТРИКИ БОТА ==================
+HANDLER_SECONDS = Histogram(
+    "bot_handler_seconds", "Длительность обработчиков апдейтов", ("handler", "state")
+)
+HANDLER_ERRORS = Counter(
+    "bot_handler_errors_total", "Исключения в обработчиках апдейтов", ("handler", "state")
+)
+DB_SECONDS = Histogram(
+    "bot_db_call_seconds", "Длительность вызовов методов Database", ("function",), buckets=DB_BUCKETS
+)
+DB_ERRORS = Counter("bot_db_errors_total", "Ошибки в методах Database", ("function",))
+TELEGRAM_SECONDS = Histogram(
+    "bot_telegram_request_seconds", "Длительность запросов к Telegram API (без ожидания лимита)", ("endpoint",)
+)
+TELEGRAM_ERRORS = Counter(
+    "bot_telegram_errors_total", "Ошибки запросов к Telegram API", ("endpoint", "error")
+)
+JOB_SECONDS = Histogram("bot_job_seconds", "Длительность фоновых задач", ("job",))
+JOB_ERRORS = Counter("bot_job_errors_total", "Исключения в фоновых задачах", ("job",))
+THROTTLED = Counter(
+    "bot_throttled_total", "Апдейты, отброшенные защитой от флуда", ("handler", "reason")
+)
+
+
+def instrument_handlers(application, state_names):
+    """Замер всех обработчиков приложения, включая шаги ConversationHandler.
+
+    state_names - {номер состояния: название} для метки state.
+    """
+    from telegram.ext import ConversationHandler
+
+    wrapped = set()
+
+    def wrap(handler, state):
+        if isinstance(handler, ConversationHandler):
+            for entry in handler.entry_points:
+                wrap(entry, "entry")
+            for state_id, state_handlers in handler.states.items():
+                for state_handler in state_handlers:
+                    wrap(state_handler, state_names.get(state_id, str(state_id)))
+            for fallback in handler.fallbacks:
+                wrap(fallback, "fallback")
+            return
+        if id(handler) in wrapped:
+            return
+        wrapped.add(id(handler))
+        handler.callback = timed(
+            HANDLER_SECONDS, HANDLER_ERRORS, handler=handler.callback.__name__, state=state
+        )(handler.callback)
+
+    for group in application.handlers.values():
+        for handler in group:
+            wrap(handler, "")
@@ -0,0 +1,242 @@
+# outbox.py
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+from collections import OrderedDict
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from metrics import TELEGRAM_ERRORS, TELEGRAM_SECONDS
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты исходящих запросов (меньше - важнее)
+PRIORITY_INTERACTIVE = 0  # ответы на действия пользователя
+PRIORITY_NOTIFY = 1  # уведомления клиентам и админу
+PRIORITY_BULK = 2  # рассылки
+
+
+class OutboundRateLimiter(BaseRateLimiter):
+    """Ограничитель всех запросов бота к Telegram API.
+
+    Запросы в чаты проходят через общий token bucket и bucket своего
+    чата; при нехватке токенов первыми их получают запросы с меньшим
+    приоритетом (rate_limit_args). Запросы без chat_id (getUpdates,
+    answerCallbackQuery и т.п.) не ограничиваются. При RetryAfter
+    отправка приостанавливается на указанное время и запрос повторяется.
+    """
+
+    def __init__(self, global_rate=25, chat_rate=1, chat_burst=3, group_rate=1 / 3,
+                 max_retries=3, max_chats=2000):
+        self.bucket = TokenBucket(global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        self._chat_buckets = OrderedDict()
+        self._waiting = []
+        self._seq = itertools.count()
+        self._dispatcher = None
+        self.retry_after_count = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            rate = self.group_rate if isinstance(chat_id, int) and chat_id < 0 else self.chat_rate
+            bucket = TokenBucket(rate, capacity=self.chat_burst)
+            self._chat_buckets[chat_id] = bucket
+            if len(self._chat_buckets) > self.max_chats:
+                self._chat_buckets.popitem(last=False)
+        else:
+            self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    async def _acquire_global(self, priority):
+        if not self._waiting and self.bucket.try_acquire():
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (priority, next(self._seq), future))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await future
+
+    async def _dispatch(self):
+        # Токены выдаются по одному самому приоритетному ожидающему запросу
+        while self._waiting:
+            await self.bucket.acquire()
+            while self._waiting:
+                _, _, future = heapq.heappop(self._waiting)
+                if not future.done():
+                    future.set_result(None)
+                    break
+
+    def queue_depth(self):
+        """Сколько запросов ждут общего токена"""
+        return len(self._waiting)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        priority = PRIORITY_INTERACTIVE if rate_limit_args is None else rate_limit_args
+        for attempt in range(self.max_retries + 1):
+            if chat_id is not None:
+                await self._chat_bucket(chat_id).acquire()
+                await self._acquire_global(priority)
+            started = time.perf_counter()
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                TELEGRAM_ERRORS.inc(endpoint=endpoint, error="RetryAfter")
+                self.retry_after_count += 1
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(f"⏳ Лимит Telegram ({endpoint}), пауза {e.retry_after} с")
+                self.bucket.pause(e.retry_after)
+                if chat_id is None:
+                    await asyncio.sleep(e.retry_after)
+            except Exception as e:
+                TELEGRAM_ERRORS.inc(endpoint=endpoint, error=type(e).__name__)
+                raise
+            finally:
+                # getUpdates - длинный опрос, его длительность ничего не говорит о задержках
+                if endpoint != "getUpdates":
+                    TELEGRAM_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint)
+
+
+class Outbox:
+    """Очередь исходящих уведомлений.
+
+    Обработчики ставят сообщение в очередь и сразу продолжают работу;
+    отправкой занимаются фоновые воркеры. Временные ошибки повторяются
+    с экспоненциальной задержкой, а сообщения, которые так и не удалось
+    доставить, сохраняются в таблицу dead_letters.
+    """
+
+    def __init__(self, db, workers=4, max_attempts=5, base_delay=1.0):
+        self.db = db
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.bot = None
+        self._queue = asyncio.PriorityQueue()
+        self._seq = itertools.count()
+        self._tasks = []
+        self._delayed = {}
+        self.sent = 0
+        self.retried = 0
+        self.dead = 0
+
+    def start(self, bot):
+        """Запуск воркеров"""
+        self.bot = bot
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    async def stop(self, timeout=10):
+        """Остановка: ждем отправки очереди, остаток - в dead_letters"""
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"⚠️ Очередь отправки не успела опустеть: {self._queue.qsize()}")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for handle, item in list(self._delayed.values()):
+            handle.cancel()
+            await self._dead_letter(item, "бот остановлен до повторной отправки")
+        self._delayed.clear()
+        while not self._queue.empty():
+            _, _, item = self._queue.get_nowait()
+            await self._dead_letter(item, "бот остановлен до отправки")
+
+    def qsize(self):
+        """Длина очереди"""
+        return self._queue.qsize()
+
+    def send_message(self, chat_id, text, priority=PRIORITY_NOTIFY, **kwargs):
+        """Постановка сообщения в очередь.
+
+        Возвращает future с отправленным Message (или None, если сообщение
+        не удалось доставить); ждать его не обязательно.
+        """
+        future = asyncio.get_running_loop().create_future()
+        item = {"chat_id": chat_id, "text": text, "kwargs": kwargs,
+                "priority": priority, "attempts": 0, "future": future}
+        self._queue.put_nowait((priority, next(self._seq), item))
+        return future
+
+    async def _worker(self):
+        while True:
+            _, _, item = await self._queue.get()
+            try:
+                await self._deliver(item)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка очереди отправки: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def _deliver(self, item):
+        item["attempts"] += 1
+        try:
+            message = await self.bot.send_message(
+                item["chat_id"], item["text"], rate_limit_args=item["priority"], **item["kwargs"]
+            )
+        except (Forbidden, BadRequest) as e:
+            await self._dead_letter(item, str(e))
+            return
+        except (NetworkError, RetryAfter) as e:
+            if item["attempts"] >= self.max_attempts:
+                await self._dead_letter(item, str(e))
+                return
+            self.retried += 1
+            delay = self.base_delay * 2 ** (item["attempts"] - 1)
+            if isinstance(e, RetryAfter):
+                delay = max(delay, e.retry_after)
+            handle = asyncio.get_running_loop().call_later(delay, self._requeue, item)
+            self._delayed[id(item)] = (handle, item)
+            return
+        except Exception as e:
+            await self._dead_letter(item, str(e))
+            return
+        self.sent += 1
+        if not item["future"].done():
+            item["future"].set_result(message)
+
+    def _requeue(self, item):
+        self._delayed.pop(id(item), None)
+        self._queue.put_nowait((item["priority"], next(self._seq), item))
+
+    async def _dead_letter(self, item, error):
+        self.dead += 1
+        logger.error(f"❌ Сообщение в чат {item['chat_id']} не доставлено: {error}")
+        if not item["future"].done():
+            item["future"].set_result(None)
+        try:
+            await self.db.save_dead_letter(item["chat_id"], item["text"], error, item["attempts"])
+        except Exception as e:
+            logger.error(f"Ошибка сохранения недоставленного сообщения: {e}")
+
+    def stats(self):
+        """Счетчики очереди"""
+        return {
+            "queued": self._queue.qsize(),
+            "delayed": len(self._delayed),
+            "sent": self.sent,
+            "retried": self.retried,
+            "dead": self.dead,
+        }
@@ -0,0 +1,139 @@
+# persistence.py
+import json
+import asyncio
+import logging
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+
+class SQLitePersistence(BasePersistence):
+    """Хранение состояний разговоров, user_data и chat_data в БД бота.
+
+    Данные пользователя читаются из БД при первом его обновлении после
+    запуска, а не все сразу. Application передает только изменившиеся
+    ключи; они копятся и пишутся одной транзакцией через write_delay
+    секунд (и при остановке - в flush). Данные хранятся в JSON, поэтому
+    в user_data можно класть только строки, числа, списки и словари.
+    """
+
+    def __init__(self, db, update_interval=10, write_delay=0.05):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=True, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.db = db
+        self.write_delay = write_delay
+        self._loaded = {}
+        self._data = {}
+        self._conversations = {}
+        self._timer = None
+        self._writing = None
+
+    # ---------- загрузка ----------
+    async def get_user_data(self):
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        rows = await self.db.get_conversation_states(name)
+        return {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+
+    async def _load(self, kind, key, data):
+        stored = await self.db.load_persistent_data(kind, key)
+        if stored:
+            # Ключи, появившиеся до загрузки, новее сохраненных
+            for name, value in json.loads(stored).items():
+                data.setdefault(name, value)
+
+    async def _refresh(self, kind, key, data):
+        # Одна загрузка на ключ: одновременные апдейты ждут одну и ту же задачу
+        loading = self._loaded.get((kind, key))
+        if loading is None:
+            loading = self._loaded[(kind, key)] = asyncio.ensure_future(self._load(kind, key, data))
+        try:
+            await asyncio.shield(loading)
+        except Exception:
+            # Следующий апдейт загрузит заново; до тех пор данные ключа не пишутся
+            if self._loaded.get((kind, key)) is loading:
+                del self._loaded[(kind, key)]
+            raise
+
+    def _is_loaded(self, kind, key):
+        """Сохраненные данные ключа прочитаны: запись не затрет их данными из памяти"""
+        loading = self._loaded.get((kind, key))
+        return loading is not None and loading.done() and not loading.cancelled() and loading.exception() is None
+
+    async def refresh_user_data(self, user_id, user_data):
+        await self._refresh("user", user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        await self._refresh("chat", chat_id, chat_data)
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    # ---------- запись ----------
+    def _stage(self, kind, key, data):
+        self._data[(kind, key)] = json.dumps(data, ensure_ascii=False) if data else None
+        self._schedule()
+
+    def _schedule(self):
+        if self._timer is None:
+            loop = asyncio.get_running_loop()
+            self._timer = loop.call_later(self.write_delay, lambda: loop.create_task(self.flush()))
+
+    async def update_user_data(self, user_id, data):
+        if self._is_loaded("user", user_id):
+            self._stage("user", user_id, data)
+
+    async def update_chat_data(self, chat_id, data):
+        if self._is_loaded("chat", chat_id):
+            self._stage("chat", chat_id, data)
+
+    async def drop_user_data(self, user_id):
+        self._stage("user", user_id, None)
+
+    async def drop_chat_data(self, chat_id):
+        self._stage("chat", chat_id, None)
+
+    async def update_conversation(self, name, key, new_state):
+        state = None if new_state is None else json.dumps(new_state)
+        self._conversations[(name, json.dumps(list(key)))] = state
+        self._schedule()
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def flush(self):
+        """Запись накопленных изменений"""
+        while self._writing is not None:
+            await self._writing
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        data = [(kind, key, value) for (kind, key), value in self._data.items()]
+        conversations = [(name, key, state) for (name, key), state in self._conversations.items()]
+        self._data, self._conversations = {}, {}
+        if not data and not conversations:
+            return
+        self._writing = asyncio.get_running_loop().create_future()
+        try:
+            await self.db.save_persistent_state(data, conversations)
+        except Exception as e:
+            logger.error(f"❌ Ошибка сохранения состояния бота: {e}")
+        finally:
+            self._writing.set_result(None)
+            self._writing = None
@@ -0,0 +1,83 @@
+# processor.py
+import asyncio
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка апдейтов с сохранением порядка внутри чата.
+
+    Апдейты разных чатов обрабатываются одновременно (не больше
+    max_concurrent_updates), апдейты одного чата - строго по очереди, в
+    порядке поступления, поэтому шаги ConversationHandler не
+    перемешиваются. Апдейт, ждущий предыдущего апдейта своего чата, не
+    занимает слот обработки. max_pending ограничивает число принятых,
+    но еще не обработанных апдейтов.
+    """
+
+    def __init__(self, max_concurrent_updates=16, max_pending=1000):
+        # Семафор базового класса ограничивает все принятые апдейты, а не только
+        # обрабатываемые: ожидание своей очереди в чате не должно занимать слот
+        super().__init__(max_pending)
+        self.limit = max_concurrent_updates
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._tails = {}
+        self.in_flight = 0
+        self.waiting = 0
+        self.processed = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @staticmethod
+    def _chat_key(update):
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat:
+            return update.effective_chat.id
+        if update.effective_user:
+            return update.effective_user.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        key = self._chat_key(update)
+        previous = self._tails.get(key) if key is not None else None
+        done = asyncio.get_running_loop().create_future()
+        if key is not None:
+            self._tails[key] = done
+        self.waiting += 1
+        started = False
+        try:
+            if previous is not None:
+                # asyncio.wait, а не await: отмена этого апдейта не должна отменять чужой future
+                await asyncio.wait([previous])
+            async with self._slots:
+                self.waiting -= 1
+                self.in_flight += 1
+                started = True
+                try:
+                    await coroutine
+                finally:
+                    self.in_flight -= 1
+                    self.processed += 1
+        finally:
+            if not started:
+                self.waiting -= 1
+                coroutine.close()
+            done.set_result(None)
+            if self._tails.get(key) is done:
+                del self._tails[key]
+
+    def stats(self):
+        """Счетчики обработки апдейтов"""
+        return {
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "chats": len(self._tails),
+            "processed": self.processed,
+        }
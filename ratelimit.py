@@ -0,0 +1,136 @@
+# ratelimit.py
+import time
+import asyncio
+from collections import Counter, OrderedDict
+
+
+class TokenBucket:
+    """Ограничитель частоты: rate токенов в секунду, запас до capacity.
+
+    acquire() ждет, пока появится токен. pause() останавливает выдачу
+    токенов на заданное время (например, после 429 от Telegram).
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, cost=1):
+        """Взять токены без ожидания; False, если их не хватает"""
+        now = time.monotonic()
+        if now < self.paused_until:
+            return False
+        self._refill(now)
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return True
+        return False
+
+    def delay(self, cost=1):
+        """Сколько секунд ждать до появления cost токенов"""
+        now = time.monotonic()
+        self._refill(now)
+        wait = max(self.paused_until - now, 0.0)
+        if self.tokens < cost:
+            wait = max(wait, (cost - self.tokens) / self.rate)
+        return wait
+
+    async def acquire(self, cost=1):
+        """Дождаться и взять токены"""
+        while not self.try_acquire(cost):
+            await asyncio.sleep(max(self.delay(cost), 0.001))
+
+    def pause(self, seconds):
+        """Приостановить выдачу токенов на seconds секунд"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+# Решения ChatThrottle.check()
+ALLOW = "allow"  # обработать
+COALESCED = "coalesced"  # повтор только что обработанного запроса, ответ уже отправлен
+LIMITED = "limited"  # токены кончились: чат уходит на паузу, ему отвечают один раз
+COOLDOWN = "cooldown"  # чат на паузе, апдейт молча отбрасывается
+
+
+class _ChatState:
+    __slots__ = ("bucket", "last_key", "last_at", "blocked_until", "throttled")
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.last_key = None
+        self.last_at = 0.0
+        self.blocked_until = 0.0
+        self.throttled = 0
+
+
+class ChatThrottle:
+    """Защита от флуда: у каждого чата свое ведро токенов.
+
+    Апдейт стоит cost токенов (дорогие обработчики - больше). Повтор того
+    же запроса (key) в пределах coalesce секунд после обработанного не
+    тратит токены и отбрасывается: ответ на первый уже отправлен. Когда
+    токенов не хватает, чат на cooldown секунд перестает обслуживаться.
+    Хранятся состояния не больше max_chats последних чатов.
+    """
+
+    def __init__(self, rate, capacity, cooldown, coalesce, max_chats=10000):
+        self.rate = rate
+        self.capacity = capacity
+        self.cooldown = cooldown
+        self.coalesce = coalesce
+        self.max_chats = max_chats
+        self._chats = OrderedDict()
+        self.counts = Counter()
+
+    def _state(self, chat_id):
+        state = self._chats.get(chat_id)
+        if state is None:
+            state = self._chats[chat_id] = _ChatState(TokenBucket(self.rate, self.capacity))
+            if len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return state
+
+    def check(self, chat_id, key=None, cost=1):
+        """Решение по апдейту чата: ALLOW, COALESCED, LIMITED или COOLDOWN"""
+        now = time.monotonic()
+        state = self._state(chat_id)
+        if now < state.blocked_until:
+            verdict = COOLDOWN
+        elif key is not None and key == state.last_key and now - state.last_at < self.coalesce:
+            verdict = COALESCED
+        elif state.bucket.try_acquire(cost):
+            state.last_key, state.last_at = key, now
+            verdict = ALLOW
+        else:
+            state.blocked_until = now + self.cooldown
+            verdict = LIMITED
+        if verdict is not ALLOW:
+            state.throttled += 1
+        self.counts[verdict] += 1
+        return verdict
+
+    def stats(self, top=5):
+        """Счетчики решений и чаты с наибольшим числом отброшенных апдейтов"""
+        now = time.monotonic()
+        offenders = sorted(
+            ((chat_id, state.throttled) for chat_id, state in self._chats.items() if state.throttled),
+            key=lambda item: item[1], reverse=True,
+        )
+        return {
+            "chats": len(self._chats),
+            "cooling": sum(1 for state in self._chats.values() if now < state.blocked_until),
+            "allowed": self.counts[ALLOW],
+            "coalesced": self.counts[COALESCED],
+            "limited": self.counts[LIMITED],
+            "cooldown": self.counts[COOLDOWN],
+            "top": offenders[:top],
+        }
@@ -0,0 +1,70 @@
+# serve.py
+"""Запуск на Render с быстрым холодным стартом.
+
+Порт открывается сразу, до импорта telegram и бота (это основная часть
+времени запуска): /health отвечает во время загрузки, а апдейт,
+разбудивший инстанс, ждет готовности бота, а не теряется. Импорт бота
+и проверка схемы БД идут в отдельном потоке.
+
+    python serve.py
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+import importlib
+from http import HTTPStatus
+
+from webserver import HttpServer
+
+logger = logging.getLogger(__name__)
+
+PORT = int(os.environ.get("PORT", 10000))
+
+
+def load_bot():
+    """Импорт бота и подготовка БД (выполняется в потоке)"""
+    bot = importlib.import_module("bot")
+    bot.db.init_database()
+    return bot
+
+
+async def serve():
+    started = time.monotonic()
+    state = {"application": None}
+    loop = asyncio.get_running_loop()
+    webhook = loop.create_future()
+
+    async def health(body, headers):
+        application = state["application"]
+        payload = {
+            "status": "ready" if application and application.running else "starting",
+            "uptime": round(time.monotonic() - started, 3),
+        }
+        return HTTPStatus.OK, "application/json", json.dumps(payload).encode()
+
+    async def early_update(body, headers):
+        # Апдейт до готовности бота: ждем обработчик вебхука из bot.py
+        return await (await asyncio.shield(webhook))(body, headers)
+
+    server = HttpServer()
+    server.route("GET", "/health", health)
+    token = os.environ.get("BOT_TOKEN", "")
+    server.route("POST", f"/{token}", early_update)
+    await server.start("0.0.0.0", PORT)
+
+    try:
+        bot = await loop.run_in_executor(None, load_bot)
+        application = state["application"] = bot.build_application()
+        webhook.set_result(bot.webhook_handler(application))
+        logger.info(f"⏱ Бот загружен за {time.monotonic() - started:.2f} с")
+        await bot.run_webhook(application, server)
+    finally:
+        if not webhook.done():
+            webhook.cancel()
+        await server.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(serve())
@@ -0,0 +1,18 @@
+# tests/conftest.py
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import Database  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path):
+    """Пустая БД со всеми миграциями"""
+    database = Database(str(tmp_path / "test.db"))
+    database.init_database()
+    yield database
+    database.close()
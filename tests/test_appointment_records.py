@@ -0,0 +1,20 @@
+# tests/test_appointment_records.py
+"""Сборка Appointment из строк с устаревшими значениями"""
+import asyncio
+
+from database import FALLBACK_STATUS, AppointmentStatus
+
+
+def test_unknown_status_falls_back(db):
+    db._writer.executemany(
+        """INSERT INTO appointments (client_name, client_phone, appointment_date, appointment_time, status)
+           VALUES ('Клиент', '+7 999 000 00 00', '2030-01-15', ?, ?)""",
+        [("10:00", None), ("11:00", "done"), ("12:00", "confirmed")],
+    )
+    db._writer.commit()
+
+    async def load():
+        return [await db.get_appointment_by_id(appointment_id) for appointment_id in (1, 2, 3)]
+
+    statuses = [appointment.status for appointment in asyncio.run(load())]
+    assert statuses == [FALLBACK_STATUS, FALLBACK_STATUS, AppointmentStatus.CONFIRMED]
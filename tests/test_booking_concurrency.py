@@ -0,0 +1,68 @@
+# tests/test_booking_concurrency.py
+"""Нагрузочная проверка бронирования: много одновременных попыток занять один слот"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from database import Database
+
+CLIENTS = 200
+DATE = "2030-01-15"
+TIME = "10:00"
+
+
+def test_concurrent_bookings_have_one_winner(db):
+    async def book():
+        return await asyncio.gather(*(
+            db.save_appointment_to_db(f"Клиент {chat_id}", "+7 999 000 00 00", DATE, TIME, chat_id)
+            for chat_id in range(1, CLIENTS + 1)
+        ))
+
+    results = asyncio.run(book())
+    winners = [appointment_id for appointment_id in results if appointment_id is not None]
+    assert len(winners) == 1
+    rows = db._writer.execute(
+        "SELECT id FROM appointments WHERE appointment_date = ? AND appointment_time = ?", (DATE, TIME)
+    ).fetchall()
+    assert rows == [(winners[0],)]
+
+
+def test_concurrent_holds_have_one_winner(db):
+    async def hold():
+        return await asyncio.gather(*(
+            db.hold_slot(DATE, TIME, chat_id, 600) for chat_id in range(1, CLIENTS + 1)
+        ))
+
+    results = asyncio.run(hold())
+    assert results.count(True) == 1
+    holder = results.index(True) + 1
+
+    async def book():
+        return await asyncio.gather(*(
+            db.save_appointment_to_db(f"Клиент {chat_id}", "+7 999 000 00 00", DATE, TIME, chat_id)
+            for chat_id in range(1, CLIENTS + 1)
+        ))
+
+    # Пока слот удержан, записаться может только удерживающий клиент
+    results = asyncio.run(book())
+    assert [chat_id for chat_id, appointment_id in enumerate(results, 1) if appointment_id] == [holder]
+
+
+def test_bookings_from_separate_connections_have_one_winner(db):
+    # Отдельные Database - отдельные соединения-писатели, как у нескольких процессов
+    instances = [Database(db.path) for _ in range(4)]
+    for instance in instances:
+        instance.open()
+
+    def book(chat_id):
+        instance = instances[chat_id % len(instances)]
+        return asyncio.run(
+            instance.save_appointment_to_db(f"Клиент {chat_id}", "+7 999 000 00 00", DATE, TIME, chat_id)
+        )
+
+    try:
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            results = list(pool.map(book, range(1, CLIENTS + 1)))
+    finally:
+        for instance in instances:
+            instance.close()
+    assert sum(appointment_id is not None for appointment_id in results) == 1
@@ -0,0 +1,31 @@
+# tests/test_listing_pages.py
+"""Страницы списков админа помещаются в одно сообщение Telegram"""
+import os
+from datetime import datetime
+
+os.environ.setdefault("BOT_TOKEN", "0:test")
+
+import bot  # noqa: E402
+from database import Appointment, AppointmentStatus  # noqa: E402
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+def test_appointments_page_fits_one_message():
+    # Имена и телефоны длиннее допустимого - как у записей, сохраненных до ограничения
+    appointments = [
+        Appointment(
+            id=10 ** 9 + i,
+            client_name="Я" * 400,
+            client_phone="9" * 400,
+            date="2030-12-31",
+            time="20:00",
+            created_at=datetime(2030, 12, 1),
+            status=AppointmentStatus.PENDING,
+            chat_id=10 ** 12,
+            paid=False,
+            starts=datetime(2030, 12, 31, 20, 0),
+        )
+        for i in range(bot.APPOINTMENTS_PAGE_SIZE)
+    ]
+    assert len(bot.format_appointments_page(appointments)) <= TELEGRAM_MESSAGE_LIMIT
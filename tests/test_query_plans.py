@@ -0,0 +1,37 @@
+# tests/test_query_plans.py
+"""Частые запросы идут по индексам: в EXPLAIN QUERY PLAN нет полного просмотра таблиц"""
+import asyncio
+
+import pytest
+
+HOT_QUERIES = {
+    "slot": lambda db: db.is_time_slot_taken("2030-01-15", "10:00"),
+    "client": lambda db: db.get_client_appointments(42, since="2030-01-01 00:00"),
+    "pending": lambda db: db.get_pending_appointments(),
+    "blocked": lambda db: db.is_slot_blocked("2030-01-15", "10:00"),
+    "messages": lambda db: db.get_messages_page(),
+    "client_messages": lambda db: db.get_messages_page(client_chat_id=42, cursor_id=1),
+}
+
+
+def capture_selects(db, call):
+    """SELECT-запросы, выполненные вызовом метода Database"""
+    statements = []
+    connections = [db._writer, *db._reader_conns]
+    for conn in connections:
+        conn.set_trace_callback(statements.append)
+    try:
+        asyncio.run(call(db))
+    finally:
+        for conn in connections:
+            conn.set_trace_callback(None)
+    return [sql for sql in statements if sql.lstrip().upper().startswith("SELECT")]
+
+
+@pytest.mark.parametrize("name", HOT_QUERIES)
+def test_hot_query_has_no_full_scan(db, name):
+    statements = capture_selects(db, HOT_QUERIES[name])
+    assert statements
+    for sql in statements:
+        plan = [row[3] for row in db._writer.execute(f"EXPLAIN QUERY PLAN {sql}")]
+        assert not [step for step in plan if step.startswith("SCAN")], (sql, plan)
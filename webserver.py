@@ -0,0 +1,90 @@
+# webserver.py
+import asyncio
+import logging
+from http import HTTPStatus
+
+logger = logging.getLogger(__name__)
+
+
+class HttpServer:
+    """Минимальный HTTP-сервер на asyncio: вебхук Telegram и служебные страницы.
+
+    Маршрут - (метод, путь) -> async handler(body, headers), который
+    возвращает (код, Content-Type, тело в байтах). Каждое соединение
+    обслуживает один запрос.
+    """
+
+    def __init__(self, max_body=1024 * 1024, timeout=10):
+        self.max_body = max_body
+        self.timeout = timeout
+        self.routes = {}
+        self._server = None
+
+    @property
+    def serving(self):
+        """Слушает ли сервер порт"""
+        return self._server is not None
+
+    def route(self, method, path, handler):
+        """Регистрация обработчика пути"""
+        self.routes[(method, path)] = handler
+
+    async def start(self, host, port):
+        """Запуск прослушивания"""
+        self._server = await asyncio.start_server(self._handle, host, port)
+        logger.info(f"🌐 HTTP-сервер слушает {host}:{port}")
+
+    async def stop(self):
+        """Остановка прослушивания"""
+        if self._server is None:
+            return
+        self._server.close()
+        await self._server.wait_closed()
+        self._server = None
+
+    async def _read_request(self, reader):
+        request_line = await reader.readline()
+        method, target, _ = request_line.decode("latin-1").split(" ", 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length") or 0)
+        if length > self.max_body:
+            raise OverflowError(length)
+        body = await reader.readexactly(length) if length else b""
+        return method, target.split("?", 1)[0], headers, body
+
+    async def _handle(self, reader, writer):
+        try:
+            try:
+                method, path, headers, body = await asyncio.wait_for(self._read_request(reader), self.timeout)
+            except OverflowError:
+                status, content_type, payload = HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "text/plain", b""
+            except (ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+                status, content_type, payload = HTTPStatus.BAD_REQUEST, "text/plain", b""
+            else:
+                handler = self.routes.get((method, path))
+                if handler is None:
+                    status, content_type, payload = HTTPStatus.NOT_FOUND, "text/plain", b""
+                else:
+                    try:
+                        status, content_type, payload = await handler(body, headers)
+                    except Exception as e:
+                        logger.error(f"Ошибка HTTP-обработчика {method} {path}: {e}")
+                        status, content_type, payload = HTTPStatus.INTERNAL_SERVER_ERROR, "text/plain", b""
+            status = HTTPStatus(status)
+            writer.write(
+                f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(payload)}\r\n"
+                f"Connection: close\r\n\r\n".encode("latin-1") + payload
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()